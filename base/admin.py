@@ -27,7 +27,7 @@ class TagAdmin(admin.ModelAdmin):
     search_fields = ['name']
     
 class UrlAdmin(admin.ModelAdmin):
-    list_display = ['id', 'value']
+    list_display = ['id', 'value', 'entry_count', 'public_entry_count']
     search_fields = ['value']
     
 class EntryAdmin(admin.ModelAdmin):
@@ -39,6 +39,14 @@ class EntryTagAdmin(admin.ModelAdmin):
     list_display = ['id', 'entry', 'tag', 'sequence_num']
     search_fields = ['tag']
 
+class TagCountAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'tag', 'count', 'public_count']
+    search_fields = ['tag__name']
+
+class SolrQueueAdmin(admin.ModelAdmin):
+    list_display = ['id', 'entry_id', 'action', 'attempts', 'date_queued']
+    list_filter = ['action', 'attempts']
+
 admin.site.register(m.GroupProfile, GroupProfileAdmin)
 admin.site.register(m.UserProfile, UserProfileAdmin)
 admin.site.register(m.Filter, FilterAdmin)
@@ -46,3 +54,5 @@ admin.site.register(m.Tag, TagAdmin)
 admin.site.register(m.Url, UrlAdmin)
 admin.site.register(m.Entry, EntryAdmin)
 admin.site.register(m.EntryTag, EntryTagAdmin)
+admin.site.register(m.TagCount, TagCountAdmin)
+admin.site.register(m.SolrQueue, SolrQueueAdmin)
@@ -0,0 +1,48 @@
+"""
+Model fields of our own.
+"""
+
+import zlib
+
+import psycopg2
+
+from django.db import models as m
+from django.utils.encoding import smart_str, smart_unicode
+
+
+def compress (text):
+    """
+    Return text zlib compressed, ready to go into a bytea column.
+    """
+    return psycopg2.Binary(zlib.compress(smart_str(text)))
+
+
+def decompress (data):
+    """
+    Return the text in data read back from a bytea column.
+    """
+    return smart_unicode(zlib.decompress(str(data)))
+
+
+class CompressedTextField (m.Field):
+    """
+    Text kept zlib compressed in a bytea column, for big values that are
+    rarely read and never searched on.  Comes back as unicode.
+    """
+    __metaclass__ = m.SubfieldBase
+
+    def db_type (self, connection=None):
+        return 'bytea'
+
+    def to_python (self, value):
+        # Only what comes from the database is a buffer
+        if isinstance(value, buffer):
+            return decompress(value)
+        if value is None:
+            return value
+        return smart_unicode(value)
+
+    def get_db_prep_value (self, value, connection=None, prepared=False):
+        if value is None:
+            return None
+        return compress(value)
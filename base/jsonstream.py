@@ -0,0 +1,179 @@
+"""
+Reads one big JSON object from a file a piece at a time, for dumps too
+big to json.load() comfortably.  Top-level members come out one by one,
+and a big array member can be passed over on the way through and its
+items read one at a time afterwards, so memory stays bounded by the
+biggest single item rather than by the file.
+"""
+
+import re
+
+import simplejson as json
+
+CHUNK_SIZE = 65536
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+SPECIAL = re.compile(r'["\[\]{}]')
+NUMBER_CHARS = '0123456789.eE+-'
+
+
+class JSONStream (object):
+    """
+    Decodes JSON values from a seekable file, reading chunk_size bytes
+    at a time and holding on to no more than the value being decoded.
+    """
+
+    def __init__ (self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.seek(f.tell())
+
+    def tell (self):
+        return self.offset + self.pos
+
+    def seek (self, offset):
+        self.f.seek(offset)
+        self.offset = offset
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def members (self, skip=()):
+        """
+        Yield (key, value) for each member of the object at the current
+        position.  Values of keys in skip are passed over without being
+        decoded; their file offset comes out instead, for items().
+        """
+        self._expect('{')
+        if self._next_char() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key in skip:
+                self._skip_ws()
+                offset = self.tell()
+                self._skip()
+                yield key, offset
+            else:
+                yield key, self._value()
+            if self._expect(',}') == '}':
+                return
+
+    def items (self, offset=None):
+        """
+        Yield the items of the array at offset, or at the current position,
+        one at a time.
+        """
+        if offset is not None:
+            self.seek(offset)
+        self._expect('[')
+        if self._next_char() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def _read (self):
+        """
+        Read more of the file onto the buffer, dropping what's been used.
+        Reads at least as much as is left over, so a value much bigger
+        than a chunk is only retried a few times.  False at the end.
+        """
+        if self.eof:
+            return False
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.f.read(max(self.chunk_size, len(self.buffer)))
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+    def _skip_ws (self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self._read():
+                return
+
+    def _next_char (self):
+        self._skip_ws()
+        if self.pos >= len(self.buffer):
+            raise ValueError('unexpected end of JSON at %s' % self.tell())
+        return self.buffer[self.pos]
+
+    def _expect (self, chars):
+        c = self._next_char()
+        if c not in chars:
+            raise ValueError('expected %s at %s, found %r' %
+                (' or '.join(chars), self.tell(), c))
+        self.pos += 1
+        return c
+
+    def _value (self):
+        self._skip_ws()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number cut off by the end of the buffer may go on
+                if self.eof or (end < len(self.buffer) and
+                    self.buffer[end] not in NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._read()
+
+    def _skip (self):
+        """
+        Move past one value, just matching up brackets and quotes.
+        """
+        if self._next_char() not in '[{':
+            self._value()
+            return
+        depth = 0
+        while True:
+            match = SPECIAL.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                if not self._read():
+                    raise ValueError('unexpected end of JSON at %s' %
+                        self.tell())
+                continue
+            self.pos = match.end()
+            c = match.group()
+            if c == '"':
+                self._skip_string()
+            elif c in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _skip_string (self):
+        """
+        Move past the rest of a string, from just past its opening quote.
+        """
+        while True:
+            end = self.buffer.find('"', self.pos)
+            if end == -1:
+                # Keep any backslashes at the end, which may escape a quote
+                self.pos = len(self.buffer.rstrip('\\'))
+                if not self._read():
+                    raise ValueError('unterminated string at %s' %
+                        self.tell())
+                continue
+            start = end
+            while start > 0 and self.buffer[start - 1] == '\\':
+                start -= 1
+            self.pos = end + 1
+            if (end - start) % 2 == 0:
+                return
@@ -0,0 +1,121 @@
+"""
+A small, thread-safe, bounded least-recently-used cache.
+"""
+
+import threading
+
+
+class LRUCache (object):
+    """
+    Maps keys to values, holding at most max_size of them; adding one more
+    drops whichever was used least recently.  Keeps hit and miss counts.
+    """
+
+    def __init__ (self, max_size=1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear (self):
+        self.lock.acquire()
+        try:
+            # key -> [prev, next, key, value] links in a circular list, with
+            # the root link sitting between the newest and the oldest.
+            self.map = {}
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+
+    def __len__ (self):
+        return len(self.map)
+
+    def get (self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.map.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def get_many (self, keys):
+        """
+        Return a dict of key to value for whichever of keys are cached.
+        """
+        found = {}
+        self.lock.acquire()
+        try:
+            for key in keys:
+                link = self.map.get(key)
+                if link is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self._unlink(link)
+                self._append(link)
+                found[key] = link[3]
+            return found
+        finally:
+            self.lock.release()
+
+    def set (self, key, value):
+        self.lock.acquire()
+        try:
+            self._set(key, value)
+        finally:
+            self.lock.release()
+
+    def set_many (self, mapping):
+        self.lock.acquire()
+        try:
+            for key, value in mapping.items():
+                self._set(key, value)
+        finally:
+            self.lock.release()
+
+    def delete (self, key):
+        self.lock.acquire()
+        try:
+            link = self.map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self.lock.release()
+
+    def stats (self):
+        return {'size': len(self.map), 'max_size': self.max_size,
+            'hits': self.hits, 'misses': self.misses}
+
+    def _set (self, key, value):
+        link = self.map.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[3] = value
+        else:
+            link = [None, None, key, value]
+            self.map[key] = link
+            if len(self.map) > self.max_size:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.map[oldest[2]]
+        self._append(link)
+
+    def _unlink (self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append (self, link):
+        last = self.root[0]
+        link[0] = last
+        link[1] = self.root
+        last[1] = link
+        self.root[0] = link
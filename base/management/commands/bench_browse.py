@@ -0,0 +1,158 @@
+import datetime
+import optparse
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries, transaction
+from django.http import HttpRequest
+
+from base import models as m
+from base import views
+from base.solrpool import solr_client
+
+PREFIX = 'bench'
+BACKENDS = ['db', 'solr']
+
+
+class Command(BaseCommand):
+    users_option = optparse.make_option('--users',
+        action='store', dest='users', type='int', default=50,
+        help='number of synthetic users to create')
+    entries_option = optparse.make_option('--entries',
+        action='store', dest='entries', type='int', default=20000,
+        help='number of synthetic entries to create')
+    tags_option = optparse.make_option('--tags',
+        action='store', dest='tags', type='int', default=500,
+        help='number of distinct synthetic tags')
+    content_option = optparse.make_option('--content-kb',
+        action='store', dest='content_kb', type='int', default=0,
+        help='kilobytes of page content to give each synthetic entry')
+    runs_option = optparse.make_option('--runs',
+        action='store', dest='runs', type='int', default=20,
+        help='times to load each page with each backend')
+    load_option = optparse.make_option('--load',
+        action='store_true', dest='load', default=False,
+        help='create and index the synthetic dataset first')
+    cleanup_option = optparse.make_option('--cleanup',
+        action='store_true', dest='cleanup', default=False,
+        help='remove the synthetic dataset from the database and solr')
+    option_list = BaseCommand.option_list + (users_option, entries_option,
+        tags_option, content_option, runs_option, load_option, 
+        cleanup_option)
+    help = "time browse pages from the database against solr, using " \
+        "synthetic '%s' users; run against a scratch database" % PREFIX
+
+    def handle(self, **options):
+        if options['cleanup']:
+            self.cleanup()
+            return
+        if options['load']:
+            self.load(options)
+        users = list(m.User.objects.filter(
+            username__startswith=PREFIX + '_'))
+        if not users:
+            raise CommandError('no synthetic data; run with --load first')
+        tag = m.Tag.objects.filter(name__startswith=PREFIX + '-')[0]
+        pages = [
+            ('index', {}),
+            ('user', {'requested_user': users[0]}),
+            ('tag', {'tag': tag}),
+            ('user_tag', {'requested_user': users[0], 'tag': tag}),
+            ]
+        print '%-10s %-10s %10s %10s %10s' % ('page', 'backend', 'first ms',
+            'later ms', 'older ms')
+        settings.BROWSE_BACKEND = 'db'
+        for name, kwargs in pages:
+            for backend in BACKENDS:
+                self.time_page(name, backend, kwargs, options['runs'])
+
+    def request(self, **params):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        request.GET.update(params)
+        return request
+
+    def browse(self, backend, request, kwargs):
+        if backend == 'solr':
+            # Straight to solr, so failures show instead of falling back
+            return views.solr_browse_page(request, **kwargs)
+        return views.browse_entries(request, **kwargs)
+
+    def time_page(self, name, backend, kwargs, runs):
+        """
+        Time the first page, and the page after it, with the search cache
+        emptied before each load so solr is really asked.
+        """
+        first = []
+        older = []
+        for i in range(runs):
+            views.SEARCH_CACHE.clear()
+            start = time.time()
+            page = self.browse(backend, self.request(), kwargs)
+            first.append(time.time() - start)
+            if page.has_next:
+                views.SEARCH_CACHE.clear()
+                start = time.time()
+                self.browse(backend, self.request(
+                    before=page.next_cursor()), kwargs)
+                older.append(time.time() - start)
+            reset_queries()
+        later = first[1:] or first
+        print '%-10s %-10s %10.1f %10.1f %10.1f' % (name, backend,
+            first[0] * 1000, 1000 * sum(later) / len(later),
+            older and 1000 * sum(older) / len(older) or 0)
+
+    @transaction.commit_on_success
+    def create(self, options):
+        users = []
+        for i in range(options['users']):
+            user, created = m.User.objects.get_or_create(
+                username='%s_%s' % (PREFIX, i))
+            users.append(user)
+        tags = ['%s-%s' % (PREFIX, i) for i in range(options['tags'])]
+        now = datetime.datetime.now()
+        content = ('<p>%s page content</p> ' % PREFIX * 
+            (52 * options['content_kb']))[:1024 * options['content_kb']]
+        ids = []
+        for i in range(options['entries']):
+            url, created = m.Url.objects.get_or_create(
+                value='http://%s.example.com/%s' % (PREFIX, i % 5000))
+            entry = m.Entry(user=random.choice(users), url=url,
+                title='%s entry %s' % (PREFIX, i),
+                is_private=random.random() < 0.1, content=content,
+                date_created=now - datetime.timedelta(minutes=i))
+            entry.save(solr_index=False)
+            entry.add_tags(random.sample(tags, random.randint(1, 5)))
+            ids.append(entry.id)
+            if i % 1000 == 0:
+                print 'created %s entries' % i
+                reset_queries()
+        return ids
+
+    def load(self, options):
+        ids = self.create(options)
+        solr = solr_client()
+        for i in range(0, len(ids), 500):
+            solr.add_many(m.Entry.solr_docs(ids[i:i+500]))
+            reset_queries()
+        solr.commit(timeout=None)
+        m.IndexMark.bump_generation()
+        print 'loaded and indexed %s entries' % len(ids)
+
+    @transaction.commit_on_success
+    def cleanup(self):
+        users = m.User.objects.filter(username__startswith=PREFIX + '_')
+        for entry in m.Entry.objects.filter(user__in=users):
+            entry.delete(solr_delete=False)
+        users.delete()
+        m.Tag.objects.filter(name__startswith=PREFIX + '-').delete()
+        m.Url.objects.filter(
+            value__startswith='http://%s.example.com/' % PREFIX).delete()
+        solr = solr_client()
+        solr.delete_query('user:%s_*' % PREFIX)
+        solr.commit(timeout=None)
+        m.IndexMark.bump_generation()
+        print 'removed synthetic data'
@@ -0,0 +1,122 @@
+import optparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import islice
+
+import simplejson as json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base.management.commands.import_zodb_json import BULK_BATCH_SIZE, \
+    read_user_dump
+
+MODES = ['load', 'stream']
+
+
+def read_load (path, batch_size):
+    """
+    Read a user's dump the way import_zodb_json used to, all at once.
+    """
+    old_user = json.load(open(path))
+    e_dicts = old_user['entries']
+    for i in range(0, len(e_dicts), batch_size):
+        yield e_dicts[i:i+batch_size]
+
+
+def read_stream (path, batch_size):
+    old_user, e_dicts = read_user_dump(path)
+    while True:
+        batch = list(islice(e_dicts, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    entries_option = optparse.make_option('--entries',
+        action='store', dest='entries', default='1000,4000,16000',
+        help='comma separated sizes of synthetic users, in entries')
+    content_option = optparse.make_option('--content-kb',
+        action='store', dest='content_kb', type='int', default=8,
+        help='kilobytes of page content in each entry')
+    batch_option = optparse.make_option('--batch-size',
+        action='store', dest='batch_size', type='int',
+        default=BULK_BATCH_SIZE,
+        help='entries to read per batch')
+    child_option = optparse.make_option('--child',
+        action='store', dest='child', help=optparse.SUPPRESS_HELP)
+    option_list = BaseCommand.option_list + (entries_option, content_option,
+        batch_option, child_option)
+    help = "measure peak memory reading synthetic user dumps all at once " \
+        "against streaming them, as import_zodb_json does"
+
+    def handle(self, *args, **options):
+        if options['child']:
+            self.child(options['child'], args[0], options['batch_size'])
+            return
+        try:
+            sizes = [int(n) for n in options['entries'].split(',')]
+        except ValueError:
+            raise CommandError('--entries takes numbers, like 1000,4000')
+        print '%-8s %10s %10s %10s %10s' % ('reader', 'entries', 'file MB',
+            'seconds', 'peak MB')
+        for size in sizes:
+            fd, path = tempfile.mkstemp(suffix='.json')
+            try:
+                self.write_dump(os.fdopen(fd, 'w'), size,
+                    options['content_kb'])
+                file_mb = os.path.getsize(path) / 1048576.0
+                for mode in MODES:
+                    seconds, rss = self.measure(mode, path,
+                        options['batch_size'])
+                    print '%-8s %10s %10.1f %10.1f %10.1f' % (mode, size,
+                        file_mb, seconds, rss)
+            finally:
+                os.remove(path)
+
+    def write_dump(self, f, size, content_kb):
+        """
+        Write a user's dump with size entries, one at a time.
+        """
+        content = ('<p>page content</p> ' * 52 * content_kb)[:1024 *
+            content_kb]
+        f.write('{"id": "bench", "new_password": "x", "groups": [], '
+            '"group_invites": [], "filters": [], "entries": [')
+        for i in range(size):
+            if i:
+                f.write(', ')
+            json.dump({'url': 'http://bench.example.com/%s' % i,
+                'title': 'bench entry %s' % i, 'comment': '',
+                'content': content, 'date': '2008-01-01T12:00:00Z',
+                'tags': ['bench', 'tag%s' % (i % 100)], 'groups': []}, f)
+        f.write(']}')
+        f.close()
+
+    def measure(self, mode, path, batch_size):
+        """
+        Read a dump in a fresh process, returning the seconds it took and
+        the process's peak RSS in MB.
+        """
+        proc = subprocess.Popen([sys.executable, sys.argv[0],
+            'bench_user_dump', '--child', mode, '--batch-size',
+            str(batch_size), path], stdout=subprocess.PIPE)
+        out = proc.stdout.read()
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        if status:
+            raise CommandError('%s reader failed' % mode)
+        # ru_maxrss is in kilobytes on linux, bytes on os x
+        if sys.platform == 'darwin':
+            rss = rusage.ru_maxrss / 1048576.0
+        else:
+            rss = rusage.ru_maxrss / 1024.0
+        return float(out), rss
+
+    def child(self, mode, path, batch_size):
+        readers = {'load': read_load, 'stream': read_stream}
+        start = time.time()
+        for batch in readers[mode](path, batch_size):
+            pass
+        print time.time() - start
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base import models as m
+
+class Command(BaseCommand):
+    help = "rebuild the per-user and site-wide tag counts"
+
+    def handle(self, **options):
+        print 'recounting tags for all users'
+        m.TagCount.recount()
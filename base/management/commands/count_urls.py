@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base import models as m
+
+class Command(BaseCommand):
+    help = "rebuild the per-url entry counts"
+
+    def handle(self, **options):
+        print 'recounting entries for all urls'
+        m.Url.recount()
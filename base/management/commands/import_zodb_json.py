@@ -2,8 +2,12 @@
 
 import optparse
 from optparse import OptionParser
+from itertools import islice
+from multiprocessing import Pool
+import hashlib
 import os
 import os.path
+import time
 import traceback
 
 import iso8601
@@ -11,14 +15,19 @@ import simplejson as json
 
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.models import User, Group
-from django.db import connection
+from django.db import connection, reset_queries, transaction
 
-from solr import SolrConnection
 from solr.core import UTC, utc_from_string
 
 from base import models as m
-from settings import SOLR_URL
+from base.fields import compress
+from base.jsonstream import JSONStream
+from base.lru import LRUCache
 
+BULK_BATCH_SIZE = 1000
+# Per process maps of url value and tag name to id, for --bulk
+URL_IDS = LRUCache(200000)
+TAG_IDS = LRUCache(50000)
 
 
 def add_user (old={}):
@@ -99,22 +108,328 @@ def add_entry (old={}):
     pass
 
 
-def main (options):
-    cursor = connection.cursor()
-    datadump_dir = options['directory']
-    print 'Loading data from %s' % datadump_dir
+def add_groups (datadump_dir):
     print 'Loading groups'
     old_groups = json.load(open('%s/group.json' % datadump_dir))
     print 'Found %s groups' % len(old_groups)
     for old_group_name, old_group in old_groups.items():
         new_group = add_group(old_group)
         print 'Saved new group %s from old group %s' % (new_group.id, new_group.name)
+
+
+def user_json_paths (datadump_dir):
+    return ['%s/users/%s' % (datadump_dir, user_json) 
+        for user_json in sorted(os.listdir('%s/users' % datadump_dir))
+        if user_json.endswith('.json')]
+
+
+def read_user_dump (path):
+    """
+    Return everything in a user's dump file but the entries, and a 
+    generator of the entries, read from the file one at a time as they 
+    are wanted.  Even a user with tens of thousands of entries full of 
+    page content only ever has a handful of them in memory.
+    """
+    stream = JSONStream(open(path, 'rb'))
+    old_user = dict(stream.members(skip=['entries']))
+    entries_at = old_user.pop('entries', None)
+    if entries_at is None:
+        return old_user, iter([])
+    return old_user, stream.items(entries_at)
+
+
+def url_ids (values):
+    """
+    Return a dict of url value to id for a list of values, creating any
+    missing urls, and commit.  The url table is locked while looking for
+    and creating missing ones, since urls aren't unique in the database
+    and workers running in parallel would otherwise make duplicates.
+    """
+    ids = {}
+    missing = []
+    for value in set(values):
+        url_id = URL_IDS.get(value)
+        if url_id is None:
+            missing.append(value)
+        else:
+            ids[value] = url_id
+    if not missing:
+        return ids
+    md5s = dict([(value, hashlib.md5(value.encode('utf8')).hexdigest()) 
+        for value in missing])
+    cursor = connection.cursor()
+    cursor.execute('LOCK TABLE base_url IN SHARE ROW EXCLUSIVE MODE')
+    for value, url_id in m.Url.objects.filter(
+        md5sum__in=md5s.values()).values_list('value', 'id'):
+        if value in md5s:
+            ids[value] = url_id
+    new = [value for value in missing if not value in ids]
+    if new:
+        params = []
+        for value in new:
+            params.extend([value, md5s[value]])
+        cursor.execute("""
+            INSERT INTO base_url (value, md5sum, entry_count, 
+                public_entry_count)
+            VALUES %s
+            RETURNING value, id
+            """ % ', '.join(['(%s, %s, 0, 0)'] * len(new)), params)
+        ids.update(dict(cursor.fetchall()))
+    transaction.commit()
+    for value in missing:
+        URL_IDS.set(value, ids[value])
+    return ids
+
+
+def tag_ids (names):
+    """
+    Return a dict of tag name to id for a list of names, creating any
+    missing tags in the current transaction.  If it rolls back, TAG_IDS
+    has to be cleared.
+    """
+    ids = {}
+    missing = []
+    for name in set(names):
+        tag_id = TAG_IDS.get(name)
+        if tag_id is None:
+            missing.append(name)
+        else:
+            ids[name] = tag_id
+    if missing:
+        # Always in the same order, so parallel workers creating some of 
+        # the same tags wait on each other instead of deadlocking
+        new = m.Tag.ids_for_names(sorted(missing))
+        for name, tag_id in new.items():
+            TAG_IDS.set(name, tag_id)
+        ids.update(new)
+    return ids
+
+
+def add_entries (user, e_dicts, group_ids, index=False):
+    """
+    Write a batch of a user's entries, with their content, urls, groups 
+    and tags, in a fixed number of statements, and return their 
+    date_created strings.  Tag and url counts are left for a recount 
+    afterwards.
+    """
+    rows = []
+    for e_dict in e_dicts:
+        date_str = date_string(get_iso_date(e_dict['date']))
+        rows.append({'title': e_dict.get('title', '') or '',
+            'comment': e_dict.get('comment', '') or '',
+            'content': e_dict.get('content', '') or '',
+            'url': unicode(e_dict.get('url', '') or '')[:500],
+            'is_private': bool(e_dict.get('is_private', False)),
+            'date': date_str,
+            'groups': e_dict.get('groups', []) or [],
+            'tags': m.clean_tags(e_dict.get('tags', []) or [])})
+    urls = url_ids([row['url'] for row in rows])
+    tags = tag_ids([name for row in rows for name in row['tags']])
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval('base_entry_id_seq') "
+        "FROM generate_series(1, %s)", [len(rows)])
+    entry_ids = [r[0] for r in cursor.fetchall()]
+    params = []
+    content_params = []
+    group_params = []
+    tag_params = []
+    for entry_id, row in zip(entry_ids, rows):
+        # Dates go in directly; save() would stamp date_modified with now
+        params.extend([entry_id, user.id, row['title'], urls[row['url']],
+            row['comment'], row['is_private'], row['date'], row['date']])
+        if row['content']:
+            content_params.extend([entry_id, compress(row['content'])])
+        for name in row['groups']:
+            group_params.extend([entry_id, group_ids[name]])
+        for i, name in enumerate(row['tags']):
+            tag_params.extend([entry_id, tags[name], i])
+    cursor.execute("""
+        INSERT INTO base_entry (id, user_id, title, url_id, comment, 
+            is_private, date_created, date_modified)
+        VALUES %s
+        """ % ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(rows)), 
+        params)
+    if content_params:
+        cursor.execute("""
+            INSERT INTO base_entrycontent (entry_id, data)
+            VALUES %s
+            """ % ', '.join(['(%s, %s)'] * (len(content_params) / 2)), 
+            content_params)
+    if group_params:
+        cursor.execute("""
+            INSERT INTO base_entry_groups (entry_id, group_id)
+            VALUES %s
+            """ % ', '.join(['(%s, %s)'] * (len(group_params) / 2)), 
+            group_params)
+    if tag_params:
+        cursor.execute("""
+            INSERT INTO base_entrytag (entry_id, tag_id, sequence_num)
+            VALUES %s
+            """ % ', '.join(['(%s, %s, %s)'] * (len(tag_params) / 3)), 
+            tag_params)
+    if index:
+        cursor.execute("""
+            INSERT INTO base_solrqueue (entry_id, action, attempts, 
+                date_queued)
+            SELECT id, 'add', 0, now() FROM base_entry WHERE id IN (%s)
+            """ % ', '.join(['%s'] * len(entry_ids)), entry_ids)
+    return [row['date'] for row in rows]
+
+
+@transaction.commit_manually
+def bulk_add_user (path, group_ids, index, batch_size):
+    """
+    Import one user's file, committing every batch_size entries.  Returns
+    the number of entries imported.
+
+    A user left half imported by an earlier run is finished off:  the
+    user and their groups and filters went in together, and each batch
+    after that went in whole and in file order, so the entries already
+    there are the first ones in the file and are skipped.
+    """
+    try:
+        old_user, e_dicts = read_user_dump(path)
+        try:
+            new_user = User.objects.get(username=old_user['id'])
+        except User.DoesNotExist:
+            new_user = None
+        if new_user is None:
+            new_user = add_user(old_user)
+            profile = new_user.get_profile()
+            if old_user['groups']:
+                new_user.groups.add(*[group_ids[g] 
+                    for g in old_user['groups']])
+            if old_user['group_invites']:
+                profile.group_invites.add(*[group_ids[g] 
+                    for g in old_user['group_invites']])
+            for f in old_user['filters']:
+                m.Filter.objects.create(user=new_user, attr_name=f['attr'], 
+                    is_active=f['is_active'], is_exact=f['is_exact'], 
+                    value=f['value'])
+            transaction.commit()
+        else:
+            profile = new_user.get_profile()
+            done = new_user.entries.count()
+            print 'Resuming %s after %s entries' % (new_user.username, done)
+            e_dicts = islice(e_dicts, done, None)
+
+        count = 0
+        while True:
+            batch = list(islice(e_dicts, batch_size))
+            if not batch:
+                break
+            count += len(add_entries(new_user, batch, group_ids, index))
+            transaction.commit()
+            reset_queries()
+
+        first_dates = new_user.entries.order_by('date_created').values_list(
+            'date_created', flat=True)[:1]
+        if first_dates:
+            new_user.date_joined = first_dates[0]
+            new_user.save()
+        profile.save()
+        transaction.commit()
+        m.touch_feeds([('site',), ('user', new_user.username)])
+        return count
+    except:
+        transaction.rollback()
+        # The maps may hold ids that just rolled back
+        URL_IDS.clear()
+        TAG_IDS.clear()
+        raise
+
+
+def init_worker ():
+    """
+    Each worker process gets its own db connection.
+    """
+    connection.close()
+
+
+def import_user (args):
+    """
+    Import one user's file for --bulk, returning (file name, number of 
+    entries, seconds taken, error or None).
+    """
+    path, group_ids, index, batch_size = args
+    name = os.path.basename(path)[:-5]
+    start = time.time()
+    try:
+        count = bulk_add_user(path, group_ids, index, batch_size)
+    except Exception, e:
+        traceback.print_exc()
+        return (name, 0, time.time() - start, e)
+    return (name, count, time.time() - start, None)
+
+
+def main_bulk (options):
+    """
+    Import with each user's entries written in large batches, and users 
+    spread across worker processes.
+    """
+    datadump_dir = options['directory']
+    print 'Loading data from %s' % datadump_dir
+    start = time.time()
+    add_groups(datadump_dir)
+    group_ids = dict(Group.objects.values_list('name', 'id'))
+    jobs = [(path, group_ids, options['index'], options['batch_size'])
+        for path in user_json_paths(datadump_dir)]
+    print 'Found %s users' % len(jobs)
+
+    if options['processes'] > 1:
+        connection.close()
+        pool = Pool(options['processes'], init_worker)
+        results = pool.imap_unordered(import_user, jobs)
+    else:
+        pool = None
+        results = (import_user(job) for job in jobs)
+
+    users = 0
+    entries = 0
+    failed = []
+    for name, count, seconds, error in results:
+        if error:
+            print 'FAILED %s: %s' % (name, error)
+            failed.append(name)
+            continue
+        users += 1
+        entries += count
+        elapsed = max(time.time() - start, 0.001)
+        print 'Imported %s: %s entries in %.1f seconds; %s total, ' \
+            '%.1f entries/sec' % (name, count, seconds, entries, 
+            entries / elapsed)
+    if pool:
+        pool.close()
+        pool.join()
+
+    print 'Recounting urls and tags'
+    m.Url.recount()
+    m.TagCount.recount()
+    for group in m.Group.objects.all():
+        fix_group_dates(group)
+
+    elapsed = max(time.time() - start, 0.001)
+    print 'Imported %s users, %s entries in %.1f seconds, ' \
+        '%.1f entries/sec' % (users, entries, elapsed, entries / elapsed)
+    if failed:
+        # Batches already committed for these stay in the database, and
+        # running again picks up where they left off
+        print 'FAILED USERS:', ' '.join(failed)
+
+
+def main (options):
+    cursor = connection.cursor()
+    datadump_dir = options['directory']
+    print 'Loading data from %s' % datadump_dir
+    add_groups(datadump_dir)
     
     for user_json in os.listdir('%s/users' % datadump_dir):
         if not user_json.endswith('.json'):
             continue
         print 'Loading %s' % user_json[:-5]
-        old_user = json.load(open('%s/users/%s' % (datadump_dir, user_json)))
+        old_user, e_dicts = read_user_dump('%s/users/%s' % (datadump_dir, 
+            user_json))
         new_user = add_user(old_user)
         print 'Saved new user %s from old user %s' % \
             (new_user.id, new_user.username)
@@ -134,7 +449,7 @@ def main (options):
                 is_exact=f['is_exact'], 
                 value=f['value'])
             new_filter.save()
-        for e_dict in old_user['entries']:
+        for e_dict in e_dicts:
             e = m.Entry(user=new_user)
             for attr in ['title', 'comment', 'content']:
                 setattr(e, attr, e_dict.get(attr, '') or '')
@@ -170,8 +485,9 @@ def main (options):
                 WHERE id=%s
                 """ % (date_str, date_str, e.id))
 
+            # Left for solr_worker, as --bulk does
             if options['index']:
-                e.solr_index()
+                m.SolrQueue.enqueue(e.id)
             
         # A lovely little cheat
         new_user.date_joined = new_user.entries.iterator().next().date_created
@@ -193,9 +509,20 @@ class Command(BaseCommand):
         help='Reset (empty) data in tables before starting')
     index_option = optparse.make_option('--index',
         action='store_true', dest='index', default=False,
-        help='Index imported entries in Solr')
+        help='Queue imported entries for solr_worker to index')
+    bulk_option = optparse.make_option('--bulk',
+        action='store_true', dest='bulk', default=False,
+        help='write entries in large batches, and recount tags and urls '
+            'at the end')
+    processes_option = optparse.make_option('--processes',
+        action='store', dest='processes', type='int', default=1,
+        help='number of worker processes for --bulk')
+    batch_option = optparse.make_option('--batch-size',
+        action='store', dest='batch_size', type='int', 
+        default=BULK_BATCH_SIZE,
+        help='entries to write per transaction with --bulk')
     option_list = BaseCommand.option_list + (directory_option, reset_option,
-        index_option)
+        index_option, bulk_option, processes_option, batch_option)
     help = 'import a directory of json data from a zodb dump'
 
     def handle(self, **options):
@@ -214,4 +541,7 @@ class Command(BaseCommand):
                 g.delete()
             
     
-        main(options)
+        if options['bulk']:
+            main_bulk(options)
+        else:
+            main(options)
@@ -1,67 +1,326 @@
+import datetime
 import optparse
 import os.path
-
-from solr import SolrConnection
+import time
+import traceback
+from multiprocessing import Pool
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, reset_queries
+from django.db.models import Max, Min, Q
 
 from base import models as m
-from settings import SOLR_URL
+from base.solrpool import solr_client
+
+MAX_DOCS_PER_ADD = 500
+RANGE_SIZE = 10000
+# Commit (and checkpoint) after this many ranges are done
+COMMIT_FREQUENCY = 10
+# Delta runs look back this far past the last mark, to catch changes from
+# transactions that were still open when the last run started
+DELTA_OVERLAP = datetime.timedelta(minutes=10)
+DELTA_MARK = 'delta'
+# No %f before python 2.6; the delta overlap more than covers the rounding
+CHECKPOINT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def merge_ranges (ranges):
+    """
+    Merge [lo, hi) pairs into the fewest sorted ones covering the same ids.
+    """
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def is_covered (lo, hi, merged):
+    """
+    Whether merged ranges cover every id in [lo, hi).
+    """
+    for done_lo, done_hi in merged:
+        if done_lo <= lo and hi <= done_hi:
+            return True
+    return False
+
+
+def entry_ids (lo, hi, user_id=None, batch_size=MAX_DOCS_PER_ADD):
+    """
+    Stream entry ids in [lo, hi) in batches, through a server-side cursor
+    so a big range never has to fit in memory.
+    """
+    connection.cursor()
+    cursor = connection.connection.cursor('index_%s_%s' % (lo, hi))
+    sql = 'SELECT id FROM base_entry WHERE id >= %s AND id < %s'
+    params = [lo, hi]
+    if user_id:
+        sql += ' AND user_id = %s'
+        params.append(user_id)
+    cursor.execute(sql + ' ORDER BY id', params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [row[0] for row in rows]
+    finally:
+        cursor.close()
+
+
+def post_docs (solr, docs):
+    """
+    Add docs to solr in one request.  If that fails, retry them one at a
+    time and return the ids of the ones that still won't go.
+    """
+    try:
+        solr.add_many(docs)
+        return []
+    except:
+        pass
+    failed = []
+    for doc in docs:
+        try:
+            solr.add(**doc)
+        except:
+            traceback.print_exc()
+            failed.append(doc['id'])
+    return failed
+
+
+def init_worker ():
+    """
+    Each worker process gets its own db connection (and solr_client() its
+    own solr pool).
+    """
+    connection.close()
+
+
+def index_range (args):
+    """
+    Index all entries (or one user's) with ids in [lo, hi).  Returns
+    (lo, hi, number indexed, failed ids).
+    """
+    lo, hi, user_id, batch_size = args
+    count = 0
+    failed = []
+    for ids in entry_ids(lo, hi, user_id, batch_size):
+        docs = m.Entry.solr_docs(ids)
+        failed.extend(post_docs(solr_client(), docs))
+        count += len(docs)
+        reset_queries()
+    connection.connection.commit()
+    return (lo, hi, count, failed)
 
-MAX_DOCS_PER_ADD = 5
-COMMIT_FREQUENCY = 50
 
 class Command(BaseCommand):
     user_option = optparse.make_option('--user',
         action='store', dest='user',
-        help='name of user whose entries to purge')
-    option_list = BaseCommand.option_list + (user_option,)
+        help='name of user whose entries to index')
+    processes_option = optparse.make_option('--processes',
+        action='store', dest='processes', type='int', default=1,
+        help='number of worker processes')
+    batch_option = optparse.make_option('--batch-size',
+        action='store', dest='batch_size', type='int',
+        default=MAX_DOCS_PER_ADD,
+        help='number of docs to send to solr at a time')
+    range_option = optparse.make_option('--range-size',
+        action='store', dest='range_size', type='int', default=RANGE_SIZE,
+        help='number of entry ids handed to a worker at a time')
+    checkpoint_option = optparse.make_option('--checkpoint',
+        action='store', dest='checkpoint',
+        help='file recording when the run started and the id ranges it '
+            'finished, to resume it if interrupted')
+    delta_option = optparse.make_option('--delta',
+        action='store_true', dest='delta', default=False,
+        help='only index entries and users changed since the last run')
+    option_list = BaseCommand.option_list + (user_option, processes_option,
+        batch_option, range_option, checkpoint_option, delta_option)
     help = "index all or user-specific entries in solr"
     args = 'an optional username'
 
     def handle(self, *args, **options):
-        self.solr = SolrConnection(SOLR_URL)
-        self.cursor = connection.cursor()
+        self.solr = solr_client()
+        if options['delta'] and options['checkpoint']:
+            raise CommandError('--checkpoint is for full runs, not --delta')
+        if options['delta']:
+            self.index_delta(options)
+            return
+        user_id = None
         if options['user']:
             print "indexing user"
-            self.index_entries(user=options['user'])
+            try:
+                user_id = m.User.objects.get(username=options['user']).id
+            except m.User.DoesNotExist:
+                raise CommandError('no such user: %s' % options['user'])
         else:
             print 'indexing everything'
-            self.index_entries()
+        started = self.index_entries(user_id, options)
         print 'committing'
-        self.solr.commit()
+        self.solr.commit(timeout=None)
+        m.IndexMark.bump_generation()
+        if not user_id:
+            m.IndexMark.set(DELTA_MARK, started)
         print 'optimizing'
-        self.solr.optimize()
+        self.solr.optimize(timeout=None)
+
+    def index_delta(self, options):
+        """
+        Reindex entries modified since the last mark, plus all entries of
+        users whose profile changed (privacy, or is_active, which touches
+        the profile) since then, and remove entries deleted since then,
+        which Entry.delete() queues.  Records a new mark when done.
+        """
+        since = m.IndexMark.get(DELTA_MARK)
+        if not since:
+            raise CommandError('no previous index run recorded; '
+                'run a full index first')
+        since = since - DELTA_OVERLAP
+        started = datetime.datetime.now()
+        print 'indexing changes since', since
+        qs = m.Entry.objects.filter(Q(date_modified__gte=since) |
+            Q(user__userprofile__date_modified__gte=since))
+        ids = list(qs.order_by('id').values_list('id', flat=True))
+        print 'entry count:', len(ids)
+        batch_size = options['batch_size']
+        failed = []
+        start = time.time()
+        for i in range(0, len(ids), batch_size):
+            docs = m.Entry.solr_docs(ids[i:i+batch_size])
+            failed.extend(post_docs(self.solr, docs))
+            reset_queries()
+        deleted = set(m.SolrQueue.objects.filter(action='delete',
+            date_queued__gte=since).values_list('entry_id', flat=True))
+        deleted = list(deleted - set(m.Entry.objects.filter(
+            id__in=deleted).values_list('id', flat=True)))
+        print 'deleted count:', len(deleted)
+        for i in range(0, len(deleted), batch_size):
+            self.solr.delete_query('id:(%s)' % ' OR '.join(
+                [str(entry_id) for entry_id in deleted[i:i+batch_size]]))
+        print 'committing'
+        self.solr.commit(timeout=None)
+        m.IndexMark.bump_generation()
+        m.IndexMark.set(DELTA_MARK, started)
+        elapsed = max(time.time() - start, 0.001)
+        print 'indexed %s docs in %.1f seconds, %.1f docs/sec' % (len(ids),
+            elapsed, len(ids) / elapsed)
+        if failed:
+            print 'BAD RECORDS:', failed
+
+    def read_checkpoint(self, path):
+        """
+        Return when the checkpointed run started, or None; what it was
+        indexing (see checkpoint_scope); and the id ranges it finished, as
+        sorted, merged [lo, hi) pairs.
+        """
+        started = None
+        scope = None
+        done = []
+        if path and os.path.exists(path):
+            for line in open(path):
+                fields = line.split()
+                if len(fields) >= 3 and fields[0] == 'started':
+                    started = datetime.datetime.strptime(' '.join(
+                        fields[1:3]), CHECKPOINT_DATE_FORMAT)
+                    scope = ' '.join(fields[3:])
+                elif len(fields) == 2:
+                    done.append((int(fields[0]), int(fields[1])))
+        return started, scope, merge_ranges(done)
 
-    def index_entries(self, user=''):
+    def checkpoint_scope(self, user_id):
+        """
+        What a full run indexes, as recorded in its checkpoint, so ranges
+        finished for one user aren't skipped when indexing everyone, or
+        the other way round.
+        """
+        if user_id:
+            return 'full user=%s' % user_id
+        return 'full all'
+
+    def index_entries(self, user_id, options):
+        """
+        Index all entries, or one user's, a range of ids at a time, and 
+        return when the run started.  A run resumed from a checkpoint 
+        started when the first attempt did.
+        """
+        range_size = options['range_size']
+        checkpoint = options['checkpoint']
+        scope = self.checkpoint_scope(user_id)
+        started, recorded_scope, done = self.read_checkpoint(checkpoint)
+        if started is None:
+            started = datetime.datetime.now()
+            if checkpoint:
+                f = open(checkpoint, 'a')
+                f.write('started %s %s\n' % (started.strftime(
+                    CHECKPOINT_DATE_FORMAT), scope))
+                f.close()
+        elif recorded_scope != scope:
+            raise CommandError('%s is the checkpoint of a different run '
+                '(%s, not %s); remove it or give another' % (checkpoint,
+                recorded_scope or 'unrecorded', scope))
+        qs = m.Entry.objects.all()
+        if user_id:
+            qs = qs.filter(user=user_id)
+        bounds = qs.aggregate(Min('id'), Max('id'))
+        if bounds['id__min'] is None:
+            print 'no entries to index'
+            return started
+        ranges = [(lo, lo + range_size, user_id, options['batch_size'])
+            for lo in range(bounds['id__min'], bounds['id__max'] + 1,
+                range_size)]
+        todo = [r for r in ranges if not is_covered(r[0], r[1], done)]
+        print 'id ranges: %s to index, %s already done' % (len(todo),
+            len(ranges) - len(todo))
+        ranges = todo
+
+        if options['processes'] > 1:
+            connection.close()
+            pool = Pool(options['processes'], init_worker)
+            results = pool.imap_unordered(index_range, ranges)
+        else:
+            pool = None
+            results = (index_range(r) for r in ranges)
+
+        start = time.time()
         counter = 0
-        entries = m.Entry.objects.all()
-        if user:
-            entries = entries.filter(user__username=user)
-        docs = []
-        print 'entry count:', entries.count()
-        SLICE_SIZE = MAX_DOCS_PER_ADD * COMMIT_FREQUENCY 
-        slices = [x for x in range(entries.count()) \
-            if x % SLICE_SIZE == 0]
-        for s in slices:
-            print 'indexing %s to %s...' % (s, s+SLICE_SIZE)
-            entry_slice = entries[s:s+SLICE_SIZE]
-            for entry in entry_slice:
-                counter += 1
-                docs.append(entry.solr_doc)
-                if len(docs) == MAX_DOCS_PER_ADD:
-                    try:
-                        self.solr.add_many(docs)
-                    except:
-                        print 'BAD RECORD:', [d['id'] for d in docs]
-                    del(docs)
-                    docs = []
-                    reset_queries()
-                    if counter % (COMMIT_FREQUENCY * MAX_DOCS_PER_ADD) == 0:
-                        print 'committing at count:', counter
-                        self.solr.commit()
-        # Don't miss the leftovers
-        self.solr.add_many(docs)
-                
-            
+        failed = []
+        finished = []
+        for lo, hi, count, range_failed in results:
+            counter += count
+            failed.extend(range_failed)
+            finished.append((lo, hi))
+            elapsed = max(time.time() - start, 0.001)
+            print 'indexed %s to %s: %s docs, %s total, %.1f docs/sec' % \
+                (lo, hi, count, counter, counter / elapsed)
+            if len(finished) == COMMIT_FREQUENCY:
+                self.commit_checkpoint(checkpoint, finished)
+                finished = []
+        self.commit_checkpoint(checkpoint, finished)
+        if pool:
+            pool.close()
+            pool.join()
+
+        elapsed = max(time.time() - start, 0.001)
+        print 'indexed %s docs in %.1f seconds, %.1f docs/sec' % (counter,
+            elapsed, counter / elapsed)
+        if failed:
+            print 'BAD RECORDS:', failed
+        return started
+
+    def commit_checkpoint(self, checkpoint, finished):
+        """
+        Commit solr, and only then record the finished ranges, so a resumed
+        run never skips anything solr didn't keep.
+        """
+        if not finished:
+            return
+        print 'committing at range: %s to %s' % max(finished)
+        self.solr.commit(timeout=None)
+        m.IndexMark.bump_generation()
+        if checkpoint:
+            f = open(checkpoint, 'a')
+            for lo, hi in finished:
+                f.write('%s %s\n' % (lo, hi))
+            f.close()
@@ -0,0 +1,99 @@
+import datetime
+import optparse
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries, transaction, DatabaseError
+
+from base.fields import compress
+
+BATCH_SIZE = 500
+PAUSE = 0.5
+
+
+class Command(BaseCommand):
+    batch_option = optparse.make_option('--batch-size',
+        action='store', dest='batch_size', type='int', default=BATCH_SIZE,
+        help='number of entries to move at a time')
+    pause_option = optparse.make_option('--pause',
+        action='store', dest='pause', type='float', default=PAUSE,
+        help='seconds to rest between batches, to go easy on the site')
+    status_option = optparse.make_option('--status',
+        action='store_true', dest='status', default=False,
+        help='report what is left to move and the table sizes, and exit')
+    option_list = BaseCommand.option_list + (batch_option, pause_option,
+        status_option)
+    help = "move entry content from base_entry.content into the " \
+        "compressed base_entrycontent table, a batch at a time"
+
+    def handle(self, **options):
+        if options['status']:
+            self.print_status()
+            return
+        start = time.time()
+        after_id = 0
+        moved = 0
+        while True:
+            ids = self.move(after_id, options['batch_size'])
+            if not ids:
+                break
+            after_id = ids[-1]
+            moved += len(ids)
+            elapsed = max(time.time() - start, 0.001)
+            print '%s moved %s entries, through id %s, %.1f/sec' % (
+                datetime.datetime.now(), moved, after_id, moved / elapsed)
+            reset_queries()
+            time.sleep(options['pause'])
+        print 'moved %s entries; see UPGRADING in README.txt for what ' \
+            'comes next' % moved
+
+    @transaction.commit_on_success
+    def move(self, after_id, batch_size):
+        """
+        Move the content of the next batch of entries that still have
+        some, and return their ids.  The rows stay locked until the move
+        commits, so an edit in the meantime waits and then wins.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT id, content FROM base_entry
+            WHERE id > %s AND content <> ''
+            ORDER BY id LIMIT %s
+            FOR UPDATE
+            """, [after_id, batch_size])
+        rows = cursor.fetchall()
+        if not rows:
+            return []
+        params = []
+        for entry_id, content in rows:
+            params.extend([entry_id, compress(content)])
+        # Content stored since, by an edit, is newer
+        cursor.execute("""
+            INSERT INTO base_entrycontent (entry_id, data)
+            SELECT new.entry_id, new.data
+            FROM (VALUES %s) AS new (entry_id, data)
+            WHERE NOT EXISTS (SELECT 1 FROM base_entrycontent
+                WHERE base_entrycontent.entry_id=new.entry_id)
+            """ % ', '.join(['(%s, %s)'] * len(rows)), params)
+        ids = [row[0] for row in rows]
+        cursor.execute("""
+            UPDATE base_entry SET content='' WHERE id IN (%s)
+            """ % ', '.join(['%s'] * len(ids)), ids)
+        return ids
+
+    def print_status(self):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT COUNT(*) FROM base_entry "
+                "WHERE content <> ''")
+            print 'left to move:', cursor.fetchone()[0]
+        except DatabaseError:
+            transaction.rollback_unless_managed()
+            print 'left to move: none, base_entry.content is gone'
+        for table in ['base_entry', 'base_entrycontent']:
+            cursor.execute("""
+                SELECT pg_size_pretty(pg_relation_size(%s)),
+                    pg_size_pretty(pg_total_relation_size(%s))
+                """, [table, table])
+            print '%s: %s, %s with toast and indexes' % ((table,) +
+                cursor.fetchone())
@@ -0,0 +1,178 @@
+import datetime
+import optparse
+import time
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries, transaction
+from django.db.models import F, Min
+
+from solr import SolrException
+
+from base import models as m
+from base.solrpool import SOLR_ERRORS, solr_client
+
+BATCH_SIZE = 500
+COMMIT_INTERVAL = 10
+POLL_INTERVAL = 2
+# Changes that failed SolrQueue.MAX_ATTEMPTS times are given up on; --status
+# reports these so they can be looked at and requeued by hand.
+MAX_ATTEMPTS = m.SolrQueue.MAX_ATTEMPTS
+# While solr is down, wait longer and longer between tries, up to this
+MAX_BACKOFF = 60
+
+class Command(BaseCommand):
+    batch_option = optparse.make_option('--batch-size',
+        action='store', dest='batch_size', type='int', default=BATCH_SIZE,
+        help='number of queued changes to read at a time')
+    commit_option = optparse.make_option('--commit-interval',
+        action='store', dest='commit_interval', type='int',
+        default=COMMIT_INTERVAL,
+        help='seconds to wait between solr commits')
+    poll_option = optparse.make_option('--poll-interval',
+        action='store', dest='poll_interval', type='int',
+        default=POLL_INTERVAL,
+        help='seconds to sleep when the queue is empty')
+    once_option = optparse.make_option('--once',
+        action='store_true', dest='once', default=False,
+        help='drain the queue, commit, and exit')
+    status_option = optparse.make_option('--status',
+        action='store_true', dest='status', default=False,
+        help='report queue depth and lag, and exit')
+    option_list = BaseCommand.option_list + (batch_option, commit_option,
+        poll_option, once_option, status_option)
+    help = "drain the solr queue, sending batched changes to solr"
+
+    def handle(self, **options):
+        if options['status']:
+            self.print_status()
+            return
+        self.solr = solr_client()
+        self.batch_size = options['batch_size']
+        self.commit_interval = options['commit_interval']
+        # Queue rows already sent to solr, to be removed once solr commits.
+        self.sent = []
+        self.first_sent = None
+        after_id = 0
+        backoff = options['poll_interval']
+        while True:
+            rows = self.next_rows(after_id)
+            if rows:
+                try:
+                    self.send(rows)
+                except SOLR_ERRORS:
+                    # Solr is down, not turning these particular changes 
+                    # down, so nothing counts against them; the same batch
+                    # goes again once solr answers
+                    traceback.print_exc()
+                    if options['once']:
+                        raise CommandError('solr is unavailable')
+                    print '%s solr unavailable, trying again in %s ' \
+                        'seconds' % (datetime.datetime.now(), backoff)
+                    transaction.commit_unless_managed()
+                    reset_queries()
+                    time.sleep(backoff)
+                    backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+                    continue
+                backoff = options['poll_interval']
+                after_id = rows[-1].id
+            elif not self.sent:
+                # Start over from the top next time, to pick up changes
+                # from transactions that committed out of id order.
+                after_id = 0
+                if options['once']:
+                    break
+            if self.sent and (not rows and options['once'] or
+                time.time() - self.first_sent >= self.commit_interval):
+                self.commit()
+                after_id = 0
+            transaction.commit_unless_managed()
+            reset_queries()
+            if not rows and not options['once']:
+                time.sleep(options['poll_interval'])
+
+    def next_rows(self, after_id):
+        qs = m.SolrQueue.objects.filter(id__gt=after_id,
+            attempts__lt=MAX_ATTEMPTS)
+        return list(qs.order_by('id')[:self.batch_size])
+
+    def send(self, rows):
+        """
+        Send one batch of queued changes to solr, coalescing repeated
+        changes to the same entry so only the last one counts.  A document
+        solr rejects on its own has the attempt counted against it; if 
+        solr can't be reached at all, the error goes up to the caller and
+        nothing is counted.
+        """
+        actions = {}
+        for row in rows:
+            actions[row.entry_id] = row.action
+        add_ids = [i for i, action in actions.items() if action == 'add']
+        docs = m.Entry.solr_docs(add_ids)
+        # Entries deleted since they were queued just get deleted
+        found_ids = set([doc['id'] for doc in docs])
+        delete_ids = [i for i, action in actions.items()
+            if action == 'delete' or i not in found_ids]
+        failed_ids = set()
+        if docs:
+            try:
+                self.solr.add_many(docs)
+            except SolrException:
+                # Try them one at a time so one bad doc doesn't sink the 
+                # rest, and to find out which it was
+                for doc in docs:
+                    try:
+                        self.solr.add(**doc)
+                    except SolrException:
+                        print 'BAD RECORD:', doc['id']
+                        traceback.print_exc()
+                        failed_ids.add(doc['id'])
+        if delete_ids:
+            self.solr.delete_query('id:(%s)' %
+                ' OR '.join([str(i) for i in delete_ids]))
+        if failed_ids:
+            m.SolrQueue.objects.filter(id__in=[row.id for row in rows],
+                entry_id__in=failed_ids).update(attempts=F('attempts') + 1)
+        sent = [row.id for row in rows if row.entry_id not in failed_ids]
+        if sent and not self.first_sent:
+            self.first_sent = time.time()
+        self.sent.extend(sent)
+        print '%s sent %s adds, %s deletes from %s queued (%s failed)' % \
+            (datetime.datetime.now(), len(docs) - len(failed_ids & found_ids),
+            len(delete_ids), len(rows), len(failed_ids))
+
+    def commit(self):
+        """
+        Commit solr, then drop the queue rows it now covers.  If the commit
+        fails they stay queued and get sent again, which is harmless.
+        """
+        try:
+            self.solr.commit(timeout=None)
+        except SOLR_ERRORS:
+            print 'FAILED COMMIT'
+            traceback.print_exc()
+            self.sent = []
+            self.first_sent = None
+            return
+        m.IndexMark.bump_generation()
+        for i in range(0, len(self.sent), self.batch_size):
+            m.SolrQueue.objects.filter(
+                id__in=self.sent[i:i+self.batch_size]).delete()
+        print '%s committed %s queued changes' % (datetime.datetime.now(),
+            len(self.sent))
+        self.sent = []
+        self.first_sent = None
+
+    def print_status(self):
+        qs = m.SolrQueue.objects.all()
+        print 'queued:', qs.filter(attempts__lt=MAX_ATTEMPTS).count()
+        print 'failing:', qs.filter(attempts__gt=0,
+            attempts__lt=MAX_ATTEMPTS).count()
+        print 'given up:', qs.filter(attempts__gte=MAX_ATTEMPTS).count()
+        oldest = qs.filter(attempts__lt=MAX_ATTEMPTS).aggregate(
+            Min('date_queued'))['date_queued__min']
+        if oldest:
+            lag = datetime.datetime.now() - oldest
+            print 'lag: %s seconds' % (lag.days * 86400 + lag.seconds)
+        else:
+            print 'lag: 0 seconds'
@@ -4,9 +4,8 @@ import sys
 
 from django.core.management.base import BaseCommand, CommandError
 
-from solr import SolrConnection
-
-from settings import SOLR_URL
+from base import models as m
+from base.solrpool import solr_client
 
 class Command(BaseCommand):
     user_option = optparse.make_option('--user',
@@ -17,9 +16,10 @@ class Command(BaseCommand):
     args = 'an optional username'
 
     def handle(self, **options):
-        solr = SolrConnection(SOLR_URL)
+        solr = solr_client()
         if options['user']:
             solr.delete_query('user:%s' % options['user'])
         else:
             solr.delete_query('id:[* TO *]')
-        solr.commit()
+        solr.commit(timeout=None)
+        m.IndexMark.bump_generation()
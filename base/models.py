@@ -1,14 +1,22 @@
 from datetime import datetime
 import hashlib
 import re
-
-from solr import SolrConnection
+import threading
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import User, Group
-from django.db import connection, reset_queries, models as m
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db import connection, reset_queries, transaction, models as m
+from django.db import IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, post_delete
 from django.forms import ModelForm
+from django.utils.functional import wraps
+
+from base.fields import CompressedTextField
+from base.namecache import NameCache
+from base.solrpool import solr_client
 
 
 class GroupProfile (m.Model):
@@ -23,6 +31,12 @@ class GroupProfile (m.Model):
     class Meta:
         ordering = ['group']
 
+# Group privacy decides who sees the group's feed
+def group_profile_post_save_touch_feeds (sender, **kwargs):
+    touch_feeds([('group', kwargs['instance'].group.name)])
+
+post_save.connect(group_profile_post_save_touch_feeds, GroupProfile)
+
 # Duckpunch Group to offer up profile like User's get_profile just
 # because it looks weird to use User.get_profile and Group.profile
 def get_profile (group):
@@ -39,6 +53,33 @@ def user_post_save_create_profile (sender, **kwargs):
     
 post_save.connect(user_post_save_create_profile, User)
 
+# Activating or deactivating a user shows or hides their tags site-wide, so
+# note the state each user was loaded in and adjust the counts after a save
+# that changes it.
+def user_post_init_note_active (sender, **kwargs):
+    user = kwargs['instance']
+    user._was_active = None
+    if user.id:
+        user._was_active = user.is_active
+
+def user_post_save_adjust_tag_counts (sender, **kwargs):
+    user = kwargs['instance']
+    was_active = getattr(user, '_was_active', None)
+    user._was_active = user.is_active
+    if was_active is None or was_active == user.is_active:
+        return
+    if UserProfile.objects.filter(user=user, is_private=False).count():
+        SiteTagCount.adjust_user(user.id, user.is_active and 1 or -1)
+    # Touch the profile so delta reindexing picks up is_active_user
+    UserProfile.objects.filter(user=user).update(
+        date_modified=datetime.now())
+    for profile in UserProfile.objects.filter(user=user):
+        profile.solr_reindex()
+    touch_user_feeds(user)
+
+post_init.connect(user_post_init_note_active, User)
+post_save.connect(user_post_save_adjust_tag_counts, User)
+
 class UserProfile (m.Model):
     user = m.OneToOneField(User)
     is_private = m.BooleanField(default=False, db_index=True)
@@ -48,40 +89,56 @@ class UserProfile (m.Model):
     tz = m.CharField(blank=True, max_length=6)
     group_invites = m.ManyToManyField(Group, related_name='invitees', blank=True)
     date_modified = m.DateTimeField(auto_now=True)
+
+    def __init__ (self, *args, **kwargs):
+        super(UserProfile, self).__init__(*args, **kwargs)
+        self._was_private = self.is_private
+
+    def save (self, *args, **kwargs):
+        """
+        Going private hides this user's tags from the site-wide counts; 
+        going public shows them again.
+        """
+        super(UserProfile, self).save(*args, **kwargs)
+        if self.is_private != self._was_private and self.user.is_active:
+            SiteTagCount.adjust_user(self.user_id, 
+                self.is_private and -1 or 1)
+        if self.is_private != self._was_private:
+            touch_user_feeds(self.user)
+        self._was_private = self.is_private
     
     def solr_reindex (self):
         """
-        Reindex all entries.  Used when switching to/from "private" status.
-        """
-        solr_conn = SolrConnection(settings.SOLR_URL)
-        # Start by deleting 'em all
-        solr_conn.delete_query('user:%s' % self.user.id)
-        entries = Entry.objects.filter(user=self.user)
-        docs = []
-        # Arbitrary assignment of a constant, here.
-        SLICE_SIZE = 50
-        slices = [x for x in range(entries.count()) \
-            if x % SLICE_SIZE == 0]
-        for s in slices:
-            entry_slice = entries[s:s+SLICE_SIZE]
-            for entry in entry_slice:
-                docs.append(entry.solr_doc)
-                if len(docs) == SLICE_SIZE:
-                    try:
-                        solr_conn.add_many(docs)
-                    except:
-                        # should log appropriately, huh
-                        pass
-                    del(docs)
-                    docs = []
-        # Don't miss the leftovers
-        solr_conn.add_many(docs)
-        solr_conn.commit()
-        solr_conn.optimize()
-        
-        
-    
-    
+        Queue all entries for reindexing.  Used when switching to/from 
+        "private" status, or when the user is activated or deactivated.
+        Going public, the solr worker replaces each doc in place, so none 
+        of them ever go missing from search along the way.  Going private
+        or inactive, the docs are deleted from solr right away, so they're
+        never public while the queue catches up; if solr can't be reached,
+        this raises and the change doesn't go through.
+        """
+        if self.is_private or not self.user.is_active:
+            solr = solr_client()
+            solr.delete_query('user_id:%s' % self.user_id)
+            solr.commit()
+            IndexMark.bump_generation()
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO base_solrqueue (entry_id, action, attempts, date_queued)
+            SELECT id, 'add', 0, %s FROM base_entry WHERE user_id=%s
+            """, [datetime.now(), self.user_id])
+        transaction.commit_unless_managed()
+
+    def solr_reindex_pending (self):
+        """
+        How many of this user's entries are still waiting to be reindexed.
+        """
+        qs = SolrQueue.objects.filter(attempts__lt=SolrQueue.MAX_ATTEMPTS)
+        qs = qs.filter(entry_id__in=Entry.objects.filter(
+            user=self.user_id).values('id'))
+        return qs.count()
+
+
 class UserProfileForm (ModelForm):
     class Meta:
         model = UserProfile
@@ -104,6 +161,14 @@ class Filter (m.Model):
     date_modified = m.DateTimeField(auto_now=True)
     
 
+# A viewer's own filters change what their feeds show them
+def filter_changed_touch_feeds (sender, **kwargs):
+    touch_feeds([('filters', kwargs['instance'].user_id)])
+
+post_save.connect(filter_changed_touch_feeds, Filter)
+post_delete.connect(filter_changed_touch_feeds, Filter)
+
+
 class FilterForm (ModelForm):
     class Meta:
         model = Filter
@@ -113,12 +178,72 @@ class FilterForm (ModelForm):
 BAD_CHARS = """ ~`@#$%^&*()?\/,<>;!\"'"""
 RE_BAD_CHARS = re.compile(r'[%s]' % BAD_CHARS)
 
+def clean_tags (tags_orig):
+    """
+    Return a list of tags from a string or list, in order, skipping 
+    repeats and bad tags, for bad chars or too lengthy.
+    """
+    # the import script sends a list, not a string, so check type
+    if isinstance(tags_orig, basestring):
+        # split up, being sure to clear out whitespace
+        tags_orig = tags_orig.split()
+    seen = set()
+    tag_list = []
+    for tag_str in tags_orig:
+        if tag_str in seen or RE_BAD_CHARS.search(tag_str) \
+            or len(tag_str) > 30:
+            continue
+        seen.add(tag_str)
+        tag_list.append(tag_str)
+    return tag_list
+
 class Tag (m.Model):
     name = m.CharField(max_length=50, unique=True)
     
     def __unicode__ (self):
         return self.name
 
+    @classmethod
+    def ids_for_names (cls, names):
+        """
+        Return a dict of tag name to id for a list of names, creating any
+        missing tags in one statement.  If another transaction creates
+        some of the same tags first, pick those up and try again.
+        """
+        ids = dict([(name, tag.id) for name, tag in 
+            TAG_CACHE.get_many(names).items()])
+        for attempt in range(3):
+            missing = [name for name in names if not name in ids]
+            if not missing:
+                return ids
+            sid = transaction.savepoint()
+            try:
+                cursor = connection.cursor()
+                cursor.execute("""
+                    INSERT INTO base_tag (name)
+                    SELECT v.name FROM (VALUES %s) AS v (name)
+                    WHERE NOT EXISTS (SELECT 1 FROM base_tag 
+                        WHERE base_tag.name=v.name)
+                    RETURNING name, id
+                    """ % ', '.join(['(%s)'] * len(missing)), missing)
+                # Not cached yet, in case the transaction rolls back
+                ids.update(dict(cursor.fetchall()))
+                transaction.savepoint_commit(sid)
+                transaction.commit_unless_managed()
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+            # Tags another transaction committed since the lookup above are
+            # passed over by the insert, so read them back
+            missing = [name for name in missing if not name in ids]
+            if missing:
+                ids.update(dict(cls.objects.filter(
+                    name__in=missing).values_list('name', 'id')))
+        missing = [name for name in names if not name in ids]
+        if missing:
+            raise IntegrityError('could not create tags: %s' % 
+                ' '.join(missing))
+        return ids
+
 
 class EntryTag (m.Model):
     entry = m.ForeignKey('Entry', related_name='tags', db_index=True)
@@ -134,46 +259,257 @@ class EntryTag (m.Model):
         """
         Get a list of most frequently used tags (and counts), either for the
         whole site, or for a particular user.  Filter out tags used with private
-        entries.
+        entries.  Reads the materialized counts in TagCount/SiteTagCount.
         """
+        qs = TagCount.visible(user, request_user)
+        order_by = ['-tag_count', 'tag__name']
+        if order == 'alpha':
+            order_by = ['tag__name', 'tag_count']
+        elif order == 'recent':
+            order_by = ['-tag', 'tag__name']
+        qs = qs.order_by(*order_by)
+        return [(row['tag_count'], row['tag__name'], row['tag']) 
+            for row in qs.values('tag_count', 'tag__name', 'tag')]
+
+
+class TagCount (m.Model):
+    """
+    Materialized count of one user's entries with one tag, kept in step by
+    Entry.add_tags(), Entry.clear_tags(), Entry.save() and Entry.delete().
+    Rebuild with 'manage.py count_tags'.
+    """
+    user = m.ForeignKey(User, related_name='tag_counts')
+    tag = m.ForeignKey(Tag, related_name='user_counts')
+    count = m.IntegerField(default=0)
+    public_count = m.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ['user', 'tag']
+
+    @classmethod
+    def visible(cls, user=None, request_user=None):
+        """
+        Return a queryset of tag counts for the whole site, or for one user, 
+        as seen by request_user.  Each row has its count as 'tag_count'.
+        """
+        if not user:
+            qs = SiteTagCount.objects.filter(count__gt=0)
+            return qs.extra(select={'tag_count': 'base_sitetagcount.count'})
+        qs = cls.objects.filter(user=user)
         if user == request_user:
-            private_clause = ''
+            count_column = 'base_tagcount.count'
+            qs = qs.filter(count__gt=0)
         else:
-            # NOTE: postgresql-specific value
-            private_clause = 'AND base_entry.is_private IS FALSE'
+            count_column = 'base_tagcount.public_count'
+            qs = qs.filter(public_count__gt=0)
+        return qs.extra(select={'tag_count': count_column})
 
-        if user:
-            user_clause = 'AND base_entry.user_id=%s' % user.id
-        else: 
-            user_clause = ''
-        order_clause = 'ORDER BY COUNT(tag_id) DESC, name'
+    @classmethod
+    def adjust(cls, user_id, tag_ids, is_private, delta):
+        """
+        Add delta to one user's counts for some tags, and to the site-wide
+        counts if the entry and the user are visible to everyone.
+        """
+        if not tag_ids:
+            return
+        ensure_rows(cls, [{'user': user_id, 'tag': tag_id} 
+            for tag_id in tag_ids])
+        counts = {'count': F('count') + delta}
+        if not is_private:
+            counts['public_count'] = F('public_count') + delta
+        cls.objects.filter(user=user_id, tag__in=tag_ids).update(**counts)
+        if not is_private and is_visible_user(user_id):
+            SiteTagCount.adjust(tag_ids, delta)
 
-        if order == 'alpha':
-            order_clause = 'ORDER BY name, COUNT(tag_id)'
-        elif order == 'recent':
-            order_clause = 'ORDER BY tag_id DESC, name'
-
-        sql = """
-            SELECT COUNT(tag_id), name, tag_id
-            FROM base_entrytag, base_entry, base_tag, auth_user
-            WHERE base_entry.id=base_entrytag.entry_id 
-            AND base_tag.id=base_entrytag.tag_id 
-            AND auth_user.id=base_entry.user_id
+    @classmethod
+    @transaction.commit_on_success
+    def recount(cls):
+        """
+        Rebuild all per-user and site-wide tag counts from scratch.
+        """
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM base_sitetagcount")
+        cursor.execute("DELETE FROM base_tagcount")
+        cursor.execute("""
+            INSERT INTO base_tagcount (user_id, tag_id, count, public_count)
+            SELECT base_entry.user_id, base_entrytag.tag_id, COUNT(*),
+                SUM(CASE WHEN base_entry.is_private THEN 0 ELSE 1 END)
+            FROM base_entrytag, base_entry
+            WHERE base_entry.id=base_entrytag.entry_id
+            GROUP BY base_entry.user_id, base_entrytag.tag_id
+            """)
+        cursor.execute("""
+            INSERT INTO base_sitetagcount (tag_id, count)
+            SELECT base_tagcount.tag_id, SUM(base_tagcount.public_count)
+            FROM base_tagcount, auth_user, base_userprofile
+            WHERE auth_user.id=base_tagcount.user_id
+            AND base_userprofile.user_id=base_tagcount.user_id
             AND auth_user.is_active IS TRUE
-            %s
-            %s
-            GROUP BY tag_id, name 
-            %s
-            """ % (private_clause, user_clause, order_clause)
+            AND base_userprofile.is_private IS FALSE
+            GROUP BY base_tagcount.tag_id
+            """)
+        transaction.set_dirty()
+
+
+class SiteTagCount (m.Model):
+    """
+    Materialized count of public entries from public, active users with one 
+    tag; this is what the site-wide tags page shows.
+    """
+    tag = m.OneToOneField(Tag, related_name='site_count')
+    count = m.IntegerField(default=0)
+
+    @classmethod
+    def adjust(cls, tag_ids, delta):
+        ensure_rows(cls, [{'tag': tag_id} for tag_id in tag_ids])
+        cls.objects.filter(tag__in=tag_ids).update(count=F('count') + delta)
+
+    @classmethod
+    def adjust_user(cls, user_id, sign):
+        """
+        Add (sign=1) or remove (sign=-1) all of one user's public tag counts
+        to the site-wide counts, for when a user becomes visible or hidden.
+        """
+        tag_ids = TagCount.objects.filter(user=user_id, 
+            public_count__gt=0).values_list('tag', flat=True)
+        ensure_rows(cls, [{'tag': tag_id} for tag_id in tag_ids])
         cursor = connection.cursor()
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-        return rows        
+        cursor.execute("""
+            UPDATE base_sitetagcount 
+            SET count=base_sitetagcount.count + %s * base_tagcount.public_count
+            FROM base_tagcount
+            WHERE base_tagcount.tag_id=base_sitetagcount.tag_id
+            AND base_tagcount.user_id=%s
+            AND base_tagcount.public_count > 0
+            """, [sign, user_id])
+        transaction.commit_unless_managed()
+
+
+def ensure_rows (model, keys):
+    """
+    Create any missing rows of a counter model, one for each dict of 
+    field values in keys, in one statement.  If another transaction 
+    creates some of the same rows first, try again.
+    """
+    if not keys:
+        return
+    fields = keys[0].keys()
+    values = sorted(set([tuple([k[field] for field in fields]) 
+        for k in keys]))
+    key_columns = [model._meta.get_field(field).column for field in fields]
+    # The database knows nothing of the model's defaults, so pass them in
+    others = [f for f in model._meta.local_fields 
+        if not f.primary_key and not f.name in fields]
+    table = model._meta.db_table
+    sql = """
+        INSERT INTO %s (%s)
+        SELECT %s FROM (VALUES %s) AS v (%s)
+        WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s)
+        """ % (table, ', '.join(key_columns + [f.column for f in others]),
+            ', '.join(['v.%s' % c for c in key_columns] + ['%s'] * len(others)),
+            ', '.join(['(%s)' % ', '.join(['%s'] * len(fields))] * len(values)),
+            ', '.join(key_columns), table, 
+            ' AND '.join(['%s.%s=v.%s' % (table, c, c) for c in key_columns]))
+    params = [f.get_default() for f in others]
+    for row in values:
+        params.extend(row)
+    for attempt in range(3):
+        sid = transaction.savepoint()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            transaction.savepoint_commit(sid)
+            return
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+    raise IntegrityError('could not create %s rows' % table)
+
+
+def is_visible_user (user_id):
+    """
+    Are this user's public entries visible to everyone?
+    """
+    return User.objects.filter(id=user_id, is_active=True, 
+        userprofile__is_private=False).count() > 0
+
+
+# Atom feeds are validated and cached against "feed stamps":  the time of
+# the last write to anything in a scope, like ('site',), ('user', username),
+# ('tag', name), ('url', md5sum) or ('group', name).  Stamps live in the 
+# django cache; one that has been evicted just starts over at now.
+FEED_STAMP_SECONDS = 7 * 86400
+_pending_feed_touches = threading.local()
+
+def feed_stamp_key (scope):
+    scope = u':'.join([unicode(part) for part in scope])
+    return 'feed_stamp:%s' % hashlib.md5(scope.encode('utf8')).hexdigest()
+
+def feed_stamps (scopes):
+    """
+    Return the stamps for a list of scopes, in order.
+    """
+    keys = [feed_stamp_key(scope) for scope in scopes]
+    stamps = cache.get_many(keys)
+    missing = [key for key in keys if key not in stamps]
+    if missing:
+        now = time.time()
+        cache.set_many(dict([(key, now) for key in missing]), 
+            FEED_STAMP_SECONDS)
+        stamps.update(dict([(key, now) for key in missing]))
+    return [stamps[key] for key in keys]
+
+def touch_feeds (scopes):
+    """
+    Mark every feed in these scopes as changed.
+    """
+    if not scopes:
+        return
+    now = time.time()
+    cache.set_many(dict([(feed_stamp_key(scope), now) for scope in scopes]),
+        FEED_STAMP_SECONDS)
+    pending = getattr(_pending_feed_touches, 'scopes', None)
+    if pending is not None:
+        pending.update(scopes)
+
+def touch_feeds_after_commit (func):
+    """
+    Decorator for views that write inside a transaction:  touch the feeds 
+    again once it's over, so a feed polled before the commit can't leave 
+    its old body cached under the new stamps.  Goes outside 
+    transaction.commit_on_success.
+    """
+    def inner (*args, **kwargs):
+        _pending_feed_touches.scopes = set()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            scopes = _pending_feed_touches.scopes
+            _pending_feed_touches.scopes = None
+            touch_feeds(list(scopes))
+    return wraps(func)(inner)
+
+def touch_user_feeds (user):
+    """
+    Mark every feed any of a user's entries show up in as changed, for when
+    the user goes private or public, or is deactivated or reactivated.
+    """
+    scopes = [('site',), ('user', user.username)]
+    scopes.extend([('tag', name) for name in TagCount.objects.filter(
+        user=user, count__gt=0).values_list('tag__name', flat=True)])
+    scopes.extend([('url', md5sum) for md5sum in Entry.objects.filter(
+        user=user).values_list('url__md5sum', flat=True).distinct()])
+    scopes.extend([('group', name) for name in Group.objects.filter(
+        entries__user=user).values_list('name', flat=True).distinct()])
+    touch_feeds(scopes)
 
 
 class Url (m.Model):
     value = m.CharField(max_length=500)
     md5sum = m.CharField(max_length=32, db_index=True)
+    # Denormalized counts of entries using this url, maintained by
+    # Entry.save() and Entry.delete(); rebuild with 'manage.py count_urls'
+    entry_count = m.IntegerField(default=0)
+    public_entry_count = m.IntegerField(default=0)
 
     def __unicode__(self):
         return '<Url %s: %s>' % (self.id, self.value)
@@ -191,70 +527,427 @@ class Url (m.Model):
         """
         self.md5sum = self.md5
         super(Url, self).save(force_insert, force_update, **kwargs)
+
+    @classmethod
+    def get_or_create_by_value(cls, value):
+        """
+        Like get_or_create(value=value), but through URL_CACHE, so a url 
+        saved before usually costs no query.  What comes back when cached
+        carries only id, value and md5sum.
+        """
+        url = URL_CACHE.get(cls(value=value).md5)
+        if url is not None and url.value == value:
+            return (url, False)
+        # Not cached when created, in case the transaction rolls back
+        return cls.objects.get_or_create(value=value)
+
+    @classmethod
+    def adjust_counts(cls, url_id, is_private, delta):
+        """
+        Add delta to the entry counts for a url, in the database, so 
+        concurrent writers don't step on each other.
+        """
+        counts = {'entry_count': F('entry_count') + delta}
+        if not is_private:
+            counts['public_entry_count'] = F('public_entry_count') + delta
+        cls.objects.filter(id=url_id).update(**counts)
+
+    @classmethod
+    def recount(cls):
+        """
+        Rebuild the entry counts for every url from scratch.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE base_url SET
+            entry_count=(SELECT COUNT(*) FROM base_entry 
+                WHERE base_entry.url_id=base_url.id),
+            public_entry_count=(SELECT COUNT(*) FROM base_entry 
+                WHERE base_entry.url_id=base_url.id
+                AND base_entry.is_private IS FALSE)
+            """)
+        transaction.commit_unless_managed()
         
         
 
+class FilterSet (object):
+    """
+    A user's active filters, resolved to the ids of the users, tags and 
+    urls they exclude, so pages can apply them as plain id predicates 
+    instead of one substring join per filter.  Kept in the django cache
+    under the user's ('filters', id) feed stamp, so editing a filter starts
+    a new one; users, tags and urls created since it was built get matched
+    and added on the next use.  A filter matching more than MAX_MATCHES 
+    rows keeps None instead of its ids, and is applied as a subquery.
+    """
+    CACHE_SECONDS = 86400
+    # A row's id is handed out when it's inserted, but the row only shows
+    # up once its transaction commits, maybe after rows with higher ids.
+    # So each refresh looks back this many ids below the last high-water
+    # mark as well, to catch rows that committed late, and every so often
+    # the filters are matched against everything again, to catch any that
+    # committed later still.
+    RESCAN_WINDOW = 1000
+    FULL_RESCAN_SECONDS = 3600
+    # Keeps a broad filter's ids well clear of memcached's 1MB item limit
+    MAX_MATCHES = 1000
+    # Which model, and which field of it, each kind of filter matches
+    TARGETS = {
+        'user': (User, 'username'),
+        'tag': (Tag, 'name'),
+        'url': (Url, 'value'),
+        }
+
+    def __init__ (self, filters):
+        self.filters = [(f.attr_name, f.value, f.is_exact) for f in filters]
+        # For each filter, the ids it matches, mapped to the matching 
+        # username, tag name or url, which is what search filters on; or
+        # None if it matches too many
+        self.matches = [{} for f in self.filters]
+        self.high_water = {'user': 0, 'tag': 0, 'url': 0}
+        self.scanned = 0
+
+    @classmethod
+    def for_user (cls, user):
+        stamp = feed_stamps([('filters', user.id)])[0]
+        key = 'filter_set:%s:%r' % (user.id, stamp)
+        state = cache.get(key)
+        if state is None:
+            filter_set = cls(Filter.objects.filter(user=user, 
+                is_active=True))
+        else:
+            filter_set = cls([])
+            filter_set.__dict__.update(state)
+        changed = state is None
+        if filter_set.filters:
+            changed = filter_set.refresh() or changed
+        if changed:
+            cache.set(key, filter_set.__dict__, cls.CACHE_SECONDS)
+        return filter_set
+
+    def targets (self, kind, value, is_exact):
+        """
+        The rows of this kind a filter matches.
+        """
+        model, field = self.TARGETS[kind]
+        lookup = is_exact and field or '%s__icontains' % field
+        return model.objects.filter(**{lookup: value})
+
+    def ids (self, kind):
+        ids = set()
+        for (filter_kind, value, is_exact), matches in zip(self.filters, 
+            self.matches):
+            if filter_kind == kind and matches is not None:
+                ids.update(matches.keys())
+        return list(ids)
+
+    user_ids = property(lambda self: self.ids('user'))
+    tag_ids = property(lambda self: self.ids('tag'))
+    url_ids = property(lambda self: self.ids('url'))
+
+    def subqueries (self, kind):
+        """
+        For the filters of this kind too broad to keep their ids, querysets
+        of the ids they match.
+        """
+        return [self.targets(filter_kind, value, is_exact).values('id')
+            for (filter_kind, value, is_exact), matches in zip(self.filters,
+            self.matches) if filter_kind == kind and matches is None]
+
+    def __nonzero__ (self):
+        return bool([matches for matches in self.matches 
+            if matches is None or matches])
+
+    def refresh (self):
+        """
+        Match any users, tags and urls newer than the last refresh, and
+        any that committed late just below it, against the filters; or 
+        everything, if FULL_RESCAN_SECONDS have passed since that was last
+        done.  Returns True if anything changed.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT (SELECT MAX(id) FROM auth_user),
+                (SELECT MAX(id) FROM base_tag),
+                (SELECT MAX(id) FROM base_url)
+            """)
+        latest = dict(zip(['user', 'tag', 'url'], 
+            [i or 0 for i in cursor.fetchone()]))
+        now = time.time()
+        full = now - self.scanned > self.FULL_RESCAN_SECONDS
+        changed = full
+        for i, (kind, value, is_exact) in enumerate(self.filters):
+            qs = self.targets(kind, value, is_exact).filter(
+                id__lte=latest[kind])
+            if not full:
+                if self.matches[i] is None \
+                    or latest[kind] <= self.high_water[kind]:
+                    continue
+                qs = qs.filter(id__gt=max(self.high_water[kind] - 
+                    self.RESCAN_WINDOW, 0))
+            field = self.TARGETS[kind][1]
+            matches = {}
+            if not full:
+                matches = self.matches[i]
+            matches.update(qs.values_list('id', field)[:self.MAX_MATCHES + 1])
+            if len(matches) > self.MAX_MATCHES:
+                matches = None
+            self.matches[i] = matches
+        if full:
+            self.scanned = now
+        for kind in latest:
+            if latest[kind] > self.high_water[kind]:
+                self.high_water[kind] = latest[kind]
+                changed = True
+        return changed
+
+
+class IndexMark (m.Model):
+    """
+    A named high-water mark for solr indexing runs:  everything modified
+    before date_marked is known to be in the index.
+    """
+    name = m.CharField(max_length=50, unique=True)
+    date_marked = m.DateTimeField()
+
+    @classmethod
+    def get(cls, name):
+        try:
+            return cls.objects.get(name=name).date_marked
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def set(cls, name, date_marked):
+        mark, created = cls.objects.get_or_create(name=name, 
+            defaults={'date_marked': date_marked})
+        if not created:
+            mark.date_marked = date_marked
+            mark.save()
+
+    # The time of the last solr commit serves as the index generation; 
+    # cached search results are keyed on it.
+    COMMIT = 'commit'
+
+    @classmethod
+    def generation(cls):
+        return cls.get(cls.COMMIT)
+
+    @classmethod
+    def bump_generation(cls):
+        """
+        Call after every solr commit.
+        """
+        cls.set(cls.COMMIT, datetime.now())
+        touch_feeds([('search',)])
+
+
+class SolrQueue (m.Model):
+    """
+    Outbox of pending solr index changes.  Rows are written in the same 
+    transaction as the entry change they stand for, and drained in batches
+    by 'manage.py solr_worker'.  Only the entry id is queued; the worker
+    indexes whatever the entry looks like when it gets there, so replaying
+    a row is always safe.
+    """
+    ACTION_CHOICES = [
+        ('add', 'add'),
+        ('delete', 'delete'),
+        ]
+    # The worker gives up retrying a queued change after this many failures
+    MAX_ATTEMPTS = 5
+    entry_id = m.IntegerField(db_index=True)
+    action = m.CharField(max_length=10, choices=ACTION_CHOICES, 
+        default='add')
+    attempts = m.SmallIntegerField(default=0)
+    date_queued = m.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    @classmethod
+    def enqueue(cls, entry_id, action='add'):
+        cls.objects.create(entry_id=entry_id, action=action)
+
+
 class Entry (m.Model):
     user = m.ForeignKey(User, related_name='entries')
     title = m.TextField()
     url = m.ForeignKey(Url, related_name='entries')
     comment = m.TextField(blank=True)
     is_private = m.BooleanField(default=False, db_index=True)
-    content = m.TextField(blank=True)
     groups = m.ManyToManyField(Group, related_name='entries')
     date_created = m.DateTimeField(db_index=True)
-    date_modified = m.DateTimeField(auto_now=True)
+    # Also drives delta reindexing; see 'manage.py index --delta'
+    date_modified = m.DateTimeField(auto_now=True, db_index=True)
     
+    def __init__ (self, *args, **kwargs):
+        # Set first, since a content= argument goes through the property
+        self._content = None
+        self._content_changed = False
+        super(Entry, self).__init__(*args, **kwargs)
+        self._remember_counted_state()
+
     def __unicode__ (self):
         return '<Entry: %s (%s)>' % (self.id, self.user.username)
         
     class Meta:
         verbose_name_plural = 'entries'
+
+    def _get_content(self):
+        """
+        The page content, kept in EntryContent and only read from there the
+        first time it's wanted, so listings never pay for it.
+        """
+        if self._content is None:
+            if self.id:
+                self._content = EntryContent.for_entries([self.id]).get(
+                    self.id, u'')
+            else:
+                self._content = u''
+        return self._content
+
+    def _set_content(self, value):
+        self._content = value or u''
+        self._content_changed = True
+
+    content = property(_get_content, _set_content)
         
     def add_tags(self, tags_orig=''):
         """
         Add one or more tags, in order.  Does nothing if there are none.
+        Takes the same few queries however many tags there are.
         """
-        # the import script sends a list, not a string, so check type
-        if tags_orig.__class__ == u''.__class__:
-            # split up, being sure to clear out whitespace
-            tag_list = tags_orig.split()
-        else:
-            tag_list = tags_orig
-            
-        # Remove bad tags, for bad chars or too lengthy
-        for tag_str in tag_list:
-            # Remove repeats
-            while tag_list.count(tag_str) > 1:
-                tag_list.remove(tag_str)
-
-            # Keep 'em cleanish and shortish
-            if RE_BAD_CHARS.search(tag_str) \
-                or len(tag_str) > 30:
-                tag_list.remove(tag_str)
-        
-        for i in range(len(tag_list)):
-            tag, created = Tag.objects.get_or_create(name=tag_list[i])
-            et = EntryTag(entry=self, tag=tag, sequence_num=i)
-            et.save()
+        tag_list = clean_tags(tags_orig)
+        if not tag_list:
+            return
+
+        ids = Tag.ids_for_names(tag_list)
+        tag_ids = [ids[name] for name in tag_list]
+        rows = []
+        for i, tag_id in enumerate(tag_ids):
+            rows.extend([self.id, tag_id, i])
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO base_entrytag (entry_id, tag_id, sequence_num)
+            VALUES %s
+            """ % ', '.join(['(%s, %s, %s)'] * len(tag_ids)), rows)
+        transaction.commit_unless_managed()
+        # Tag counts follow the entry as last saved; save() moves them
+        # along if privacy changes later.
+        if self._counted_state:
+            TagCount.adjust(self.user_id, tag_ids, self._counted_state[1], 1)
+        touch_feeds([('tag', name) for name in tag_list])
+
+    def clear_tags(self):
+        """
+        Remove all tags, keeping tag counts in step.
+        """
+        if self._counted_state:
+            TagCount.adjust(self.user_id, self.tag_ids(), 
+                self._counted_state[1], -1)
+        touch_feeds([('tag', name) for name in EntryTag.objects.filter(
+            entry=self).values_list('tag__name', flat=True)])
+        EntryTag.objects.filter(entry=self).delete()
+
+    def tag_ids(self):
+        return list(EntryTag.objects.filter(entry=self).values_list('tag', 
+            flat=True))
         
     @property
-    def other_count(self, public_only=True):
+    def other_count(self):
         """
-        Return the number of other entries that use the same URL.  Available
-        as a property to count public_only entries for easy use in templates.
+        Return the number of other public entries that use the same URL.
+        Read from the url's counts, so it costs nothing extra if the url
+        is already loaded.
         """
-        qs = self.__class__.objects.filter(url=self.url)
-        qs = qs.exclude(id=self.id)
-        if public_only:
-            qs.filter(is_private=False)
-        return qs.count()
+        count = self.url.public_entry_count
+        if not self.is_private:
+            count -= 1
+        return max(count, 0)
+
+    def feed_scopes(self):
+        """
+        The feed scopes this entry shows up in; see touch_feeds().
+        """
+        scopes = [('site',), ('user', self.user.username), 
+            ('url', self.url.md5sum)]
+        scopes.extend([('tag', name) for name in EntryTag.objects.filter(
+            entry=self).values_list('tag__name', flat=True)])
+        if self.id:
+            scopes.extend([('group', name) for name in 
+                self.groups.values_list('name', flat=True)])
+        return scopes
+
+    def _remember_counted_state(self):
+        """
+        Keep track of the url and privacy as last saved, to know which 
+        url and tag counts to adjust on the next save.
+        """
+        if self.id:
+            self._counted_state = (self.url_id, self.is_private)
+        else:
+            self._counted_state = None
+
+    def _update_counts(self):
+        new_state = (self.url_id, self.is_private)
+        old_state = self._counted_state
+        if old_state == new_state:
+            return
+        if old_state:
+            Url.adjust_counts(old_state[0], old_state[1], -1)
+            if old_state[1] != new_state[1]:
+                tag_ids = self.tag_ids()
+                TagCount.adjust(self.user_id, tag_ids, old_state[1], -1)
+                TagCount.adjust(self.user_id, tag_ids, new_state[1], 1)
+        Url.adjust_counts(new_state[0], new_state[1], 1)
+        self._counted_state = new_state
 
     @property
     def solr_doc(self):
         """
-        Returns a dict representation suitable for solr indexing.  Note limits
-        on how much text data is allowed to be indexed for comment and content.
+        Returns a dict representation suitable for solr indexing.  To build
+        docs for many entries at once, use Entry.solr_docs() instead.
+        """
+        return self._solr_doc(self.user.get_profile().is_private,
+            [entry_tag.tag.name for entry_tag in 
+                self.tags.select_related('tag')],
+            [g.name for g in self.groups.all()])
+
+    @classmethod
+    def solr_docs(cls, entry_ids):
+        """
+        Returns solr index dicts for a list or queryset of entry ids, in id
+        order, using a fixed handful of queries however many there are.
+        """
+        entries = list(cls.objects.filter(id__in=entry_ids).select_related(
+            'user', 'url').order_by('id'))
+        if not entries:
+            return []
+        ids = [e.id for e in entries]
+        contents = EntryContent.for_entries(ids)
+        for e in entries:
+            e._content = contents.get(e.id, u'')
+        private_users = set(UserProfile.objects.filter(
+            user__in=set([e.user_id for e in entries]),
+            is_private=True).values_list('user', flat=True))
+        tag_names = {}
+        qs = EntryTag.objects.filter(entry__in=ids)
+        qs = qs.order_by('entry', 'sequence_num')
+        for entry_id, tag_name in qs.values_list('entry', 'tag__name'):
+            tag_names.setdefault(entry_id, []).append(tag_name)
+        group_names = {}
+        qs = cls.groups.through.objects.filter(entry__in=ids)
+        for entry_id, group_name in qs.values_list('entry', 'group__name'):
+            group_names.setdefault(entry_id, []).append(group_name)
+        return [e._solr_doc(e.user_id in private_users, 
+            tag_names.get(e.id, []), group_names.get(e.id, [])) 
+            for e in entries]
+
+    def _solr_doc(self, is_private_user, tag_names, group_names):
+        """
+        Note limits on how much text data is allowed to be indexed for 
+        comment and content.
         """
         # Weird date machinations are for varying index-time date value states
         date_created = self.date_created
@@ -268,7 +961,7 @@ class Entry (m.Model):
             'user': self.user.username, 
             'user_id': self.user.id,
             'is_private_entry': self.is_private,
-            'is_private_user': self.user.get_profile().is_private,
+            'is_private_user': is_private_user,
             'is_active_user': self.user.is_active,
             'title': self.title,
             'url': self.url.value,
@@ -276,8 +969,8 @@ class Entry (m.Model):
             'content': self.content[:50000], # not indexing more than this
             'date_created': date_created,
             #'date_modified': self.date_modified,
-            'tag': [entry_tag.tag.name for entry_tag in self.tags.all()],
-            'group': [g.name for g in self.groups.all()],
+            'tag': tag_names,
+            'group': group_names,
             }
         return d
 
@@ -285,33 +978,158 @@ class Entry (m.Model):
         """
         Write out to solr
         """
-        solr_conn = SolrConnection(settings.SOLR_URL, persistent=False)
+        solr_conn = solr_client()
         solr_conn.add(**self.solr_doc)
         solr_conn.commit()
+        IndexMark.bump_generation()
 
     def solr_delete(self):
         """
         Remove from solr index
         """
-        solr_conn = SolrConnection(settings.SOLR_URL, persistent=False)
+        solr_conn = solr_client()
         solr_conn.delete_query('id:%s' % self.id)
         solr_conn.commit()
+        IndexMark.bump_generation()
 
     def save(self, force_insert=False, force_update=False, solr_index=True):
         """
-        Override the built-in save() to write out to solr.
+        Override the built-in save() to queue a write out to solr.
         """
         # Write out the to db
+        old_state = self._counted_state
         super(Entry, self).save(force_insert, force_update)
+        # Nothing to store for a new entry without content
+        if self._content_changed and (self._content or old_state):
+            EntryContent.store(self.id, self._content)
+        self._content_changed = False
+        self._update_counts()
+        scopes = self.feed_scopes()
+        if old_state and old_state[0] != self.url_id:
+            scopes.extend([('url', md5sum) for md5sum in Url.objects.filter(
+                id=old_state[0]).values_list('md5sum', flat=True)])
+        touch_feeds(scopes)
         if solr_index:
-            self.solr_index()
+            SolrQueue.enqueue(self.id)
 
     def delete(self, solr_delete=True):
         """
-        Override the built-in delete() to delete from solr.
+        Override the built-in delete() to queue a delete from solr.
         """
-        # Delete from solr first, or lose your self 
+        # Queue the solr delete first, or lose your self 
         if solr_delete:
-            self.solr_delete()
+            SolrQueue.enqueue(self.id, 'delete')
+        if self._counted_state:
+            Url.adjust_counts(self._counted_state[0], self._counted_state[1], 
+                -1)
+            TagCount.adjust(self.user_id, self.tag_ids(), 
+                self._counted_state[1], -1)
+        touch_feeds(self.feed_scopes())
+        EntryContent.store(self.id, u'')
         super(Entry, self).delete()
 
+
+class EntryContent (m.Model):
+    """
+    An entry's page content, which can run to hundreds of kilobytes, kept
+    apart from the entry and compressed.  It's only wanted when the entry
+    is edited or indexed; see Entry.content.
+    """
+    entry = m.OneToOneField(Entry, primary_key=True, 
+        related_name='stored_content')
+    data = CompressedTextField()
+
+    @classmethod
+    def for_entries(cls, entry_ids):
+        """
+        Return a dict of entry id to content for a list of entry ids, in one
+        query.  Entries without any are left out.  With LEGACY_ENTRY_CONTENT
+        on, content not moved over yet is read from base_entry.content.
+        """
+        contents = dict([(c.entry_id, c.data) 
+            for c in cls.objects.filter(entry__in=entry_ids)])
+        missing = [i for i in entry_ids if not i in contents]
+        if missing and settings.LEGACY_ENTRY_CONTENT:
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT id, content FROM base_entry 
+                WHERE id IN (%s) AND content <> ''
+                """ % ', '.join(['%s'] * len(missing)), missing)
+            contents.update(dict(cursor.fetchall()))
+        return contents
+
+    @classmethod
+    def store(cls, entry_id, content):
+        """
+        Replace an entry's content, dropping it if there's none.
+        """
+        cursor = connection.cursor()
+        if content:
+            cls(entry_id=entry_id, data=content).save()
+        else:
+            # Without loading the old content, as delete() would
+            cursor.execute("DELETE FROM base_entrycontent WHERE entry_id=%s", 
+                [entry_id])
+        if settings.LEGACY_ENTRY_CONTENT:
+            # So the old content can't show through
+            cursor.execute("""
+                UPDATE base_entry SET content='' 
+                WHERE id=%s AND content <> ''
+                """, [entry_id])
+        transaction.commit_unless_managed()
+
+
+# Name lookups cached per process; see base/namecache.py
+NAME_CACHE_SIZE = getattr(settings, 'NAME_CACHE_SIZE', 10000)
+NAME_CACHE_SECONDS = getattr(settings, 'NAME_CACHE_SECONDS', 300)
+TAG_CACHE = NameCache(Tag, 'name', ('id', 'name'), NAME_CACHE_SIZE,
+    NAME_CACHE_SECONDS)
+USER_CACHE = NameCache(User, 'username', ('id', 'username', 'is_active'), 
+    NAME_CACHE_SIZE, NAME_CACHE_SECONDS)
+GROUP_CACHE = NameCache(Group, 'name', ('id', 'name'), NAME_CACHE_SIZE,
+    NAME_CACHE_SECONDS)
+URL_CACHE = NameCache(Url, 'md5sum', ('id', 'md5sum', 'value'), 
+    NAME_CACHE_SIZE, NAME_CACHE_SECONDS)
+NAME_CACHES = {Tag: TAG_CACHE, User: USER_CACHE, Group: GROUP_CACHE, 
+    Url: URL_CACHE}
+
+# Note the cached fields each row was loaded with, so a save that leaves 
+# them alone, like the last_login update on every login, costs nothing here
+def name_post_init_note_old (sender, **kwargs):
+    instance = kwargs['instance']
+    instance._old_name_record = None
+    if instance.id:
+        instance._old_name_record = NAME_CACHES[sender].record(instance)
+
+# A rename has to drop the old name as well as the new one.  A new row 
+# can't be cached anywhere yet, since misses aren't.
+def name_post_save_forget (sender, **kwargs):
+    instance = kwargs['instance']
+    name_cache = NAME_CACHES[sender]
+    old = getattr(instance, '_old_name_record', None)
+    record = name_cache.record(instance)
+    instance._old_name_record = record
+    if kwargs['created'] or old == record:
+        return
+    keys = [record[name_cache.key_index]]
+    if old is not None:
+        keys.append(old[name_cache.key_index])
+    name_cache.forget(*keys)
+
+def name_post_delete_forget (sender, **kwargs):
+    instance = kwargs['instance']
+    name_cache = NAME_CACHES[sender]
+    keys = [getattr(instance, name_cache.key)]
+    old = getattr(instance, '_old_name_record', None)
+    if old is not None:
+        keys.append(old[name_cache.key_index])
+    name_cache.forget(*keys)
+
+for model in NAME_CACHES:
+    post_init.connect(name_post_init_note_old, model)
+    post_save.connect(name_post_save_forget, model)
+    post_delete.connect(name_post_delete_forget, model)
+
+def name_cache_stats ():
+    return dict([(model._meta.object_name, name_cache.stats()) 
+        for model, name_cache in NAME_CACHES.items()])
@@ -0,0 +1,130 @@
+"""
+Per-process caches of name lookups:  tag name, username, group name or url
+md5sum to the row's id and name, so the hottest of them stop costing a
+database round trip each.
+
+What comes back is a lightweight model instance with only those fields
+filled in, good for filtering, comparing, reversing urls and following
+relations, but not for saving or for reading any other field.  Changing
+one of those fields on a row, or deleting it, through the ORM (see
+models.py) bumps a stamp kept in the django cache, and every process
+stops using what it cached under the old stamp.  That takes a
+CACHE_BACKEND the processes share; either way, nothing is kept longer
+than NAME_CACHE_SECONDS.  Nothing read inside a transaction that has
+written anything is cached, since it might not be committed yet and 
+mustn't outlive a rollback.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404
+
+from lru import LRUCache
+
+
+class NameCache (object):
+    """
+    Looks up one model's rows by one unique field, keeping the values of
+    fields (which should include 'id' and the key field) for the
+    max_size most recently used.
+    """
+
+    def __init__ (self, model, key, fields, max_size=10000, timeout=300):
+        self.model = model
+        self.key = key
+        self.fields = fields
+        self.key_index = list(fields).index(key)
+        self.timeout = timeout
+        self.stamp_key = 'name_cache:%s' % model._meta.db_table
+        # Keyed by (stamp, value), so a new stamp leaves the old entries to
+        # age out unused
+        self.cache = LRUCache(max_size)
+
+    def record (self, obj):
+        return tuple([getattr(obj, field) for field in self.fields])
+
+    def instance (self, record):
+        return self.model(**dict(zip(self.fields, record)))
+
+    def cacheable (self):
+        return not (transaction.is_managed() and transaction.is_dirty())
+
+    def stamp (self):
+        return cache.get(self.stamp_key)
+
+    def fresh (self, cached):
+        return cached is not None and cached[0] > time.time()
+
+    def get (self, value):
+        """
+        Return the row whose key field is value, or None.
+        """
+        stamp = self.stamp()
+        cached = self.cache.get((stamp, value))
+        if self.fresh(cached):
+            return self.instance(cached[1])
+        rows = list(self.model.objects.filter(
+            **{self.key: value}).values_list(*self.fields)[:1])
+        if not rows:
+            return None
+        record = rows[0]
+        if self.cacheable():
+            self.cache.set((stamp, value), (time.time() + self.timeout, 
+                record))
+        return self.instance(record)
+
+    def get_or_404 (self, value):
+        obj = self.get(value)
+        if obj is None:
+            raise Http404('No %s matches the given query.' %
+                self.model._meta.object_name)
+        return obj
+
+    def get_many (self, values):
+        """
+        Return a dict of value to row for whichever of values exist,
+        looking up all the ones not cached in one query.
+        """
+        stamp = self.stamp()
+        records = dict([(key[1], cached[1]) for key, cached in 
+            self.cache.get_many([(stamp, value) for value in values]).items()
+            if self.fresh(cached)])
+        missing = [value for value in values if not value in records]
+        if missing:
+            fetched = dict([(record[self.key_index], record) for record in 
+                self.model.objects.filter(**{'%s__in' % self.key:
+                missing}).values_list(*self.fields)])
+            if self.cacheable():
+                expires = time.time() + self.timeout
+                self.cache.set_many(dict([((stamp, value), (expires, record))
+                    for value, record in fetched.items()]))
+            records.update(fetched)
+        return dict([(value, self.instance(record)) 
+            for value, record in records.items()])
+
+    def remember (self, obj):
+        """
+        Cache a row fetched some other way.  Not for rows created in a
+        transaction that hasn't committed yet.
+        """
+        if self.cacheable():
+            self.cache.set((self.stamp(), getattr(obj, self.key)), 
+                (time.time() + self.timeout, self.record(obj)))
+
+    def forget (self, *values):
+        """
+        Drop rows by key value, here and, by bumping the shared stamp, in 
+        every other process.
+        """
+        stamp = self.stamp()
+        for value in values:
+            self.cache.delete((stamp, value))
+        cache.set(self.stamp_key, time.time(), 86400)
+
+    def clear (self):
+        self.cache.clear()
+
+    def stats (self):
+        return self.cache.stats()
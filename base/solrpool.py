@@ -0,0 +1,186 @@
+"""
+A small pool of persistent solr connections, safe to share between threads.
+
+Everything that talks to solr should go through solr_client(), which hands
+back the pool for this process:
+
+    from base.solrpool import solr_client
+    solr_client().add_many(docs)
+    solr_client().commit()
+
+Each call checks a connection out of the pool for its own thread, makes the
+request over a kept-alive http connection, and puts it back.  Connections
+that fail are thrown away rather than reused.
+"""
+
+import httplib
+import os
+import Queue
+import socket
+import threading
+
+from solr import SolrConnection, SolrException
+
+from django.conf import settings
+
+
+class SolrPoolTimeout (Exception):
+    """
+    No connection came free in time.
+    """
+    pass
+
+
+# What a call raises when solr is down, slow or unhappy, as opposed to a
+# bug; pages that can get by without solr catch these and no more
+SOLR_ERRORS = (SolrException, SolrPoolTimeout, socket.error, 
+    httplib.HTTPException)
+
+
+class SolrPool (object):
+    """
+    At most size persistent connections to one solr url.  connect_timeout
+    covers opening a connection; read_timeout (or timeout=, per call)
+    covers waiting on a response.
+    """
+
+    def __init__ (self, url, size=4, connect_timeout=2, read_timeout=10,
+        checkout_timeout=10):
+        self.url = url
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.checkout_timeout = checkout_timeout
+        self.idle = Queue.Queue(size)
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def checkout (self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self.lock.acquire()
+        try:
+            if self.created < self.size:
+                self.created += 1
+                can_create = True
+            else:
+                can_create = False
+        finally:
+            self.lock.release()
+        if can_create:
+            try:
+                return self._connect()
+            except:
+                self._forget()
+                raise
+        try:
+            return self.idle.get(True, self.checkout_timeout)
+        except Queue.Empty:
+            raise SolrPoolTimeout('no solr connection free after %s seconds'
+                % self.checkout_timeout)
+
+    def _connect (self):
+        conn = SolrConnection(self.url, persistent=True,
+            timeout=self.connect_timeout)
+        # solrpy retries a failed request after _reconnect(), which may
+        # open a new http connection under the connect timeout; put the
+        # call's read timeout back on it before the retry goes out.
+        reconnect = getattr(conn, '_reconnect', None)
+        if reconnect is not None:
+            def _reconnect ():
+                reconnect()
+                self._set_read_timeout(conn, conn._pool_read_timeout)
+            conn._reconnect = _reconnect
+        return conn
+
+    def checkin (self, conn, broken=False):
+        if broken:
+            try:
+                conn.close()
+            except:
+                pass
+            self._forget()
+        else:
+            self.idle.put_nowait(conn)
+
+    def _forget (self):
+        self.lock.acquire()
+        try:
+            self.created -= 1
+        finally:
+            self.lock.release()
+
+    def call (self, method, *args, **kwargs):
+        """
+        Call one SolrConnection method on a checked-out connection.
+        """
+        timeout = kwargs.pop('timeout', self.read_timeout)
+        conn = self.checkout()
+        try:
+            self._set_read_timeout(conn, timeout)
+            result = getattr(conn, method)(*args, **kwargs)
+        except:
+            self.checkin(conn, broken=True)
+            raise
+        self.checkin(conn)
+        return result
+
+    def _set_read_timeout (self, conn, timeout):
+        # Open the socket under the connect timeout, then wait on the
+        # response under the read timeout
+        conn._pool_read_timeout = timeout
+        http_conn = getattr(conn, 'conn', None)
+        if http_conn is None:
+            return
+        if http_conn.sock is None:
+            http_conn.timeout = self.connect_timeout
+            http_conn.connect()
+        http_conn.sock.settimeout(timeout)
+        http_conn.timeout = timeout
+
+    def query (self, *args, **kwargs):
+        return self.call('query', *args, **kwargs)
+
+    def add (self, *args, **kwargs):
+        return self.call('add', *args, **kwargs)
+
+    def add_many (self, *args, **kwargs):
+        return self.call('add_many', *args, **kwargs)
+
+    def delete_query (self, *args, **kwargs):
+        return self.call('delete_query', *args, **kwargs)
+
+    def commit (self, *args, **kwargs):
+        return self.call('commit', *args, **kwargs)
+
+    def optimize (self, *args, **kwargs):
+        return self.call('optimize', *args, **kwargs)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def solr_client (url=None):
+    """
+    Return this process's pool for url (settings.SOLR_URL by default).
+    Pools are never shared across a fork.
+    """
+    url = url or settings.SOLR_URL
+    key = (os.getpid(), url)
+    pool = _pools.get(key)
+    if pool is None:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = SolrPool(url,
+                    size=getattr(settings, 'SOLR_POOL_SIZE', 4),
+                    connect_timeout=getattr(settings,
+                        'SOLR_CONNECT_TIMEOUT', 2),
+                    read_timeout=getattr(settings, 'SOLR_READ_TIMEOUT', 10))
+                _pools[key] = pool
+        finally:
+            _pools_lock.release()
+    return pool
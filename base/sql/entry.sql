@@ -0,0 +1,3 @@
+-- Run by syncdb after creating base_entry.  Listings page newest first by
+-- (date_created, id); see pagify_entries() in views.py.
+CREATE INDEX base_entry_date_created_id ON base_entry (date_created, id);
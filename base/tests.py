@@ -9,12 +9,63 @@ so that you don't stomp on your real production solr.
 """
 
 import datetime
+import os
+import shutil
+import socket
+import tempfile
+from StringIO import StringIO
 
 from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest
+from django.db import transaction
+from django.core.management.base import CommandError
 from django.test import TestCase, Client
 from django.utils import simplejson as json
 
+from solr import SolrException
+
 from unalog2.base import models as m
+from unalog2.base import views
+
+
+class StubSolr (object):
+    """
+    Stands in for solr_client(), keeping what would have been sent.  Adds
+    of the ids in fail raise, as a bad document would, and everything 
+    raises while down is set.
+    """
+    def __init__(self, fail=(), down=False):
+        self.fail = set(fail)
+        self.down = down
+        self.added = []
+        self.rejected = []
+        self.deleted = []
+        self.deleted_queries = []
+        self.commits = 0
+
+    def add_many(self, docs):
+        if self.down:
+            raise socket.error('connection refused')
+        if [doc for doc in docs if doc['id'] in self.fail]:
+            self.rejected.append([doc['id'] for doc in docs])
+            raise SolrException(400, 'bad document')
+        self.added.extend(docs)
+
+    def add(self, **doc):
+        self.add_many([doc])
+
+    def delete_query(self, query):
+        if self.down:
+            raise socket.error('connection refused')
+        if query.startswith('id:('):
+            self.deleted.extend([int(i) for i in query[4:-1].split(' OR ')])
+        else:
+            self.deleted_queries.append(query)
+
+    def commit(self, timeout=None):
+        self.commits += 1
+
 
 class UnalogTests(TestCase):
     fixtures = ['test_account.json']
@@ -30,6 +81,11 @@ class UnalogTests(TestCase):
         'submit':       None
     }
 
+    def setUp(self):
+        # Each test's rows roll back, so names cached by the last are gone
+        for name_cache in m.NAME_CACHES.values():
+            name_cache.clear()
+
     def test_add_entry(self):
         client = Client()
         self.assertTrue(client.login(username='unalog', password='unalog'))
@@ -117,3 +173,577 @@ class UnalogTests(TestCase):
         self.assertEqual(response.content, 'There was a problem with your JSON:\n\n  url: This field is required.')
         self.assertEqual(m.Entry.objects.all().count(), 0)
 
+
+    def test_preload_entries(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        client.post('/entry/new', dict(self.test_entry, submit='Save anyway'))
+        request = HttpRequest()
+        request.user = m.User.objects.get(username='unalog')
+        entries = views.preload_entries(request, m.Entry.objects.all())
+        self.assertEqual(len(entries), 2)
+        for entry in entries:
+            self.assertEqual(entry.tag_names, ['unalog', 'yeah'])
+            self.assertEqual(entry.group_list, [])
+            self.assertEqual(entry.other_count, 1)
+        doc = {'id': str(entries[0].id), 'user_id': '1', 'user': u'unalog',
+            'url': u'http://example.com/', 'title': u'from solr',
+            'is_private_entry': False, 
+            'date_created': entries[0].date_created}
+        self.assertEqual(views.entries_from_solr(request, 
+            [doc])[0].other_count, 1)
+
+    def test_url_counts(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        client.post('/entry/new', dict(self.test_entry, submit='Save anyway'))
+        url = m.Url.objects.get(value='http://example.com/')
+        self.assertEqual(url.entry_count, 2)
+        self.assertEqual(url.public_entry_count, 2)
+        entry = url.entries.all()[0]
+        entry.is_private = True
+        entry.save(solr_index=False)
+        url = m.Url.objects.get(id=url.id)
+        self.assertEqual(url.entry_count, 2)
+        self.assertEqual(url.public_entry_count, 1)
+        m.Entry.objects.get(id=entry.id).delete(solr_delete=False)
+        url = m.Url.objects.get(id=url.id)
+        self.assertEqual(url.entry_count, 1)
+        self.assertEqual(url.public_entry_count, 1)
+        m.Url.objects.filter(id=url.id).update(entry_count=0)
+        m.Url.recount()
+        url = m.Url.objects.get(id=url.id)
+        self.assertEqual(url.entry_count, 1)
+        self.assertEqual(url.public_entry_count, 1)
+
+    def test_tag_counts(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        client.post('/entry/new', dict(self.test_entry, tags='unalog', 
+            submit='Save anyway'))
+        user = m.User.objects.get(username='unalog')
+        self.assertEqual(m.EntryTag.count(), 
+            [(2, 'unalog', m.Tag.objects.get(name='unalog').id),
+             (1, 'yeah', m.Tag.objects.get(name='yeah').id)])
+        entry = user.entries.get(tags__tag__name='yeah')
+        entry.is_private = True
+        entry.save(solr_index=False)
+        self.assertEqual([row[:2] for row in m.EntryTag.count()], 
+            [(1, 'unalog')])
+        self.assertEqual([row[:2] for row in m.EntryTag.count(user, user)], 
+            [(2, 'unalog'), (1, 'yeah')])
+        m.TagCount.recount()
+        self.assertEqual([row[:2] for row in m.EntryTag.count(user, user)], 
+            [(2, 'unalog'), (1, 'yeah')])
+        entry.delete(solr_delete=False)
+        self.assertEqual([row[:2] for row in m.EntryTag.count(user, user)], 
+            [(1, 'unalog')])
+        # With filters, the site-wide cloud is counted entry by entry
+        other = m.User.objects.create_user('other', 'other@example.com', 'x')
+        m.Filter.objects.create(user=other, attr_name='user', value='other',
+            is_exact=True)
+        request = HttpRequest()
+        request.user = other
+        self.assertEqual([(t['tag__name'], t['tag_count']) 
+            for t in views.tag_counts(request)], [('unalog', 1)])
+        solr_client = m.solr_client
+        m.solr_client = lambda: StubSolr()
+        try:
+            user.is_active = False
+            user.save()
+        finally:
+            m.solr_client = solr_client
+        self.assertEqual(list(views.tag_counts(request)), [])
+
+    def test_solr_queue(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        entry = m.Entry.objects.get(url__value='http://example.com/')
+        entry_id = entry.id
+        self.assertEqual(list(m.SolrQueue.objects.values_list('entry_id', 
+            'action')), [(entry_id, 'add')])
+        entry.delete()
+        self.assertEqual(list(m.SolrQueue.objects.values_list('entry_id', 
+            'action')), [(entry_id, 'add'), (entry_id, 'delete')])
+
+    def test_solr_docs(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        client.post('/entry/new', dict(self.test_entry, tags='yeah unalog', 
+            submit='Save anyway'))
+        entries = m.Entry.objects.order_by('id')
+        docs = m.Entry.solr_docs(entries.values_list('id', flat=True))
+        self.assertEqual(docs, [e.solr_doc for e in entries])
+        self.assertEqual(docs[1]['tag'], ['yeah', 'unalog'])
+        self.assertEqual(docs[1]['is_private_user'], False)
+
+    def test_privacy_reindex_queued(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        m.SolrQueue.objects.all().delete()
+        solr = StubSolr()
+        solr_client = m.solr_client
+        m.solr_client = lambda: solr
+        try:
+            response = client.post('/prefs/', {'is_private': 'on', 
+                'url': ''})
+        finally:
+            m.solr_client = solr_client
+        self.assertEqual(response.status_code, 302)
+        profile = m.User.objects.get(username='unalog').get_profile()
+        self.assertEqual(profile.is_private, True)
+        self.assertEqual(profile.solr_reindex_pending(), 1)
+        self.assertEqual(m.SolrQueue.objects.filter(action='delete').count(), 
+            0)
+        # Gone from search at once, not once the worker gets to them
+        self.assertEqual(solr.deleted_queries, ['user_id:%s' % 
+            profile.user_id])
+        self.assertEqual(solr.commits, 1)
+
+    def test_keyset_pagination(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        client.post('/entry/new', dict(self.test_entry, submit='Save anyway'))
+        newer, older = m.Entry.objects.order_by('-date_created', '-id')
+        request = HttpRequest()
+        request.user = newer.user
+        request.GET['before'] = views.encode_cursor(newer)
+        page = views.pagify_entries(request, m.Entry.objects.all())
+        self.assertEqual([e.id for e in page.object_list], [older.id])
+        self.assertEqual((page.has_previous, page.has_next), (True, False))
+        self.assertEqual(views.decode_cursor(views.encode_cursor(older)),
+            (older.date_created, older.id))
+        response = client.get('/', {'p': '1'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['location'], 'http://testserver/')
+
+    def test_feed_conditional_get(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        anon = Client()
+        response = anon.get('/user/unalog/feed/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = anon.get('/user/unalog/feed/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        client.post('/entry/new', dict(self.test_entry, submit='Save anyway'))
+        response = anon.get('/user/unalog/feed/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_feed_user_goes_private(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        anon = Client()
+        response = anon.get('/tag/yeah/feed/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        profile = m.User.objects.get(username='unalog').get_profile()
+        profile.is_private = True
+        profile.save()
+        response = anon.get('/tag/yeah/feed/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_filter_set(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        user = m.User.objects.get(username='unalog')
+        m.Filter.objects.create(user=user, attr_name='tag', value='YEAH')
+        filter_set = m.FilterSet.for_user(user)
+        self.assertEqual(filter_set.matches[0].values(), [u'yeah'])
+        client.post('/entry/new', dict(self.test_entry, submit='Save anyway',
+            url='http://example.org/', tags='oh-yeah'))
+        filter_set = m.FilterSet.for_user(user)
+        self.assertEqual(sorted(filter_set.matches[0].values()), 
+            [u'oh-yeah', u'yeah'])
+        request = HttpRequest()
+        request.user = user
+        self.assertEqual(views.constrained_entries(request).count(), 0)
+        # A tag committed after the high-water mark passed its id
+        late = m.Tag.objects.create(name='late-yeah')
+        filter_set.high_water['tag'] = late.id
+        m.Tag.objects.create(name='newer')
+        self.assertTrue(filter_set.refresh())
+        self.assertTrue(late.id in filter_set.tag_ids)
+        # One later still, below the window, waits for the next full rescan
+        later = m.Tag.objects.create(name='later-yeah')
+        filter_set.high_water['tag'] = later.id + m.FilterSet.RESCAN_WINDOW
+        filter_set.scanned = 0
+        self.assertTrue(filter_set.refresh())
+        self.assertTrue(later.id in filter_set.tag_ids)
+        # A filter matching too many keeps no ids and becomes a subquery
+        max_matches = m.FilterSet.MAX_MATCHES
+        m.FilterSet.MAX_MATCHES = 2
+        try:
+            filter_set.scanned = 0
+            filter_set.refresh()
+        finally:
+            m.FilterSet.MAX_MATCHES = max_matches
+        self.assertEqual(filter_set.matches[0], None)
+        self.assertEqual(filter_set.tag_ids, [])
+        self.assertTrue(filter_set)
+        self.assertEqual(views.apply_filter_set(m.Entry.objects.all(),
+            filter_set).count(), 0)
+
+    def test_search_filters(self):
+        user = m.User.objects.get(username='unalog')
+        m.Filter.objects.create(user=user, attr_name='user', value='unalog',
+            is_exact=True)
+        request = HttpRequest()
+        request.user = user
+        fqs = views.search_filters(request)
+        self.assertEqual(fqs[0], 'is_active_user:true')
+        self.assertTrue(fqs[1].startswith('user:"unalog" OR '))
+        self.assertEqual(fqs[2], '-user_id:(%s)' % user.id)
+        # Browse pages other than your own don't show your private entries
+        self.assertEqual(views.search_filters(request, see_own=False)[1],
+            'is_private_entry:false AND is_private_user:false')
+        self.assertEqual(views.search_filters(request, see_private=True)[1],
+            fqs[2])
+        self.assertEqual(views.solr_wildcard(u'Oh Yeah'), 
+            '*Oh\\ Yeah* OR *oh\\ yeah*')
+
+    def test_tag_facets(self):
+        class Response:
+            facet_counts = {'facet_fields': {'tag': {u'b': 2, u'a': 2, 
+                u'c': 5}}}
+        self.assertEqual([f['name'] for f in views.tag_facets(Response())],
+            [u'c', u'a', u'b'])
+        self.assertEqual(views.tag_facets(object()), [])
+        self.assertEqual(views.drill_down_param(u'x y', tags=[u'a']),
+            'q=x+y&tag=a&')
+
+    def test_search_keeps_solr_order(self):
+        # Most relevant first, which here is the older one
+        docs = [{'id': '7', 'user_id': '1', 'user': u'unalog',
+            'url': u'http://example.org/', 'title': u'older one',
+            'comment': u'', 'is_private_entry': False,
+            'date_created': datetime.datetime(2009, 1, 1, 12, 0)},
+            {'id': '9', 'user_id': '1', 'user': u'unalog',
+            'url': u'http://example.com/', 'title': u'newer one',
+            'comment': u'', 'is_private_entry': False,
+            'date_created': datetime.datetime(2009, 1, 2, 12, 0)}]
+        class Response:
+            numFound = len(docs)
+            results = docs
+            facet_counts = {}
+        class Solr:
+            def query(self, q, **params):
+                return Response()
+        request = HttpRequest()
+        request.user = m.User.objects.get(username='unalog')
+        self.assertEqual([e.id for e in views.entries_from_solr(request,
+            docs)], [7, 9])
+        solr_client = views.solr_client
+        views.solr_client = lambda: Solr()
+        views.SEARCH_CACHE.clear()
+        try:
+            response = Client().get('/search/', {'q': 'one'})
+        finally:
+            views.solr_client = solr_client
+        self.assertTrue('older one' in response.content)
+        self.assertTrue(response.content.index('older one') <
+            response.content.index('newer one'))
+
+    def test_browse_tag_cloud(self):
+        timeouts = []
+        class Response:
+            numFound = 0
+            results = []
+            facet_counts = {'facet_fields': {'tag': {u'yeah': 3}}}
+        class Solr:
+            error = None
+            def query(self, q, **params):
+                timeouts.append(params.get('timeout'))
+                if self.error:
+                    raise self.error
+                return Response()
+        solr = Solr()
+        request = HttpRequest()
+        request.user = m.User.objects.get(username='unalog')
+        solr_client = views.solr_client
+        views.solr_client = lambda: solr
+        try:
+            t = m.Tag.objects.create(name='cloudy')
+            for i in range(2):
+                views.SEARCH_CACHE.clear()
+                self.assertEqual(views.browse_tag_cloud(request, tag=t),
+                    [{'name': u'yeah', 'count': 3}])
+            self.assertEqual(timeouts, [2])
+            # Solr being down costs the cloud; anything else is a bug
+            solr.error = socket.error('connection refused')
+            t = m.Tag.objects.create(name='stormy')
+            self.assertEqual(views.browse_tag_cloud(request, tag=t), [])
+            solr.error = KeyError('facet_fields')
+            t = m.Tag.objects.create(name='windy')
+            self.assertRaises(KeyError, views.browse_tag_cloud, request, 
+                tag=t)
+        finally:
+            views.solr_client = solr_client
+
+    def test_browse_backend(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', self.test_entry)
+        request = HttpRequest()
+        request.user = m.User.objects.get(username='unalog')
+        settings.BROWSE_BACKEND = 'db'
+        page = views.browse_entries(request)
+        self.assertEqual([e.id for e in page.object_list],
+            [e.id for e in views.constrained_entries(request)])
+        self.assertEqual(views.SolrEntryPage(None).estimated_count(), 0)
+
+    def test_add_tags(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        client.post('/entry/new', dict(self.test_entry, 
+            tags='yeah b&d unalog yeah new-one'))
+        entry = m.Entry.objects.get()
+        self.assertEqual([et.tag.name for et in 
+            entry.tags.order_by('sequence_num')], 
+            [u'yeah', u'unalog', u'new-one'])
+        ids = m.Tag.ids_for_names([u'yeah', u'another'])
+        self.assertEqual(ids[u'yeah'], m.Tag.objects.get(name='yeah').id)
+        self.assertEqual(m.Tag.objects.filter(name='another').count(), 1)
+
+    def test_solr_worker(self):
+        from unalog2.base.management.commands import solr_worker
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        for url in ['http://example.com/', 'http://example.org/', 
+            'http://example.net/']:
+            client.post('/entry/new', dict(self.test_entry, url=url))
+        kept = m.Entry.objects.get(url__value='http://example.com/')
+        kept.save()
+        bad = m.Entry.objects.get(url__value='http://example.org/')
+        gone = m.Entry.objects.get(url__value='http://example.net/')
+        gone_id = gone.id
+        gone.delete()
+        solr = StubSolr(fail=[bad.id], down=True)
+        options = {'status': False, 'once': True, 'batch_size': 500,
+            'commit_interval': 10, 'poll_interval': 0}
+        solr_client = solr_worker.solr_client
+        solr_worker.solr_client = lambda: solr
+        try:
+            # An outage counts against nothing
+            self.assertRaises(CommandError, solr_worker.Command().handle,
+                **options)
+            self.assertEqual(m.SolrQueue.objects.filter(
+                attempts__gt=0).count(), 0)
+            solr.down = False
+            solr_worker.Command().handle(**options)
+            # Two adds of one entry go as one; an add then a delete, as a
+            # delete.  Rows are dropped once committed, except the failure.
+            self.assertEqual([doc['id'] for doc in solr.added], [kept.id])
+            self.assertEqual(solr.deleted, [gone_id])
+            self.assertEqual(solr.commits, 1)
+            self.assertEqual(list(m.SolrQueue.objects.values_list(
+                'entry_id', 'attempts')), [(bad.id, 2)])
+            # Given up on after MAX_ATTEMPTS tries
+            m.SolrQueue.objects.update(
+                attempts=solr_worker.MAX_ATTEMPTS - 1)
+            solr_worker.Command().handle(**options)
+            tries = len(solr.rejected)
+            solr_worker.Command().handle(**options)
+            self.assertEqual(len(solr.rejected), tries)
+            self.assertEqual(m.SolrQueue.objects.get().attempts, 
+                solr_worker.MAX_ATTEMPTS)
+        finally:
+            solr_worker.solr_client = solr_client
+
+    def test_index_delta(self):
+        from unalog2.base.management.commands import index
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        since = datetime.datetime.now() - datetime.timedelta(hours=1)
+        m.IndexMark.set(index.DELTA_MARK, since)
+        client.post('/entry/new', self.test_entry)
+        client.post('/entry/new', dict(self.test_entry, 
+            url='http://example.org/'))
+        kept = m.Entry.objects.get(url__value='http://example.com/')
+        dropped = m.Entry.objects.get(url__value='http://example.org/')
+        dropped_id = dropped.id
+        dropped.delete()
+        command = index.Command()
+        command.solr = StubSolr()
+        command.index_delta({'batch_size': 500})
+        self.assertEqual([doc['id'] for doc in command.solr.added], 
+            [kept.id])
+        self.assertEqual(command.solr.deleted, [dropped_id])
+        self.assertEqual(command.solr.commits, 1)
+        self.assertTrue(m.IndexMark.get(index.DELTA_MARK) > since)
+        # A resumed full run keeps the first attempt's start as its mark
+        fd, path = tempfile.mkstemp()
+        os.write(fd, 'started 2009-01-02 03:04:05 full user=7\n'
+            '21 31\n1 11\n11 21\n')
+        os.close(fd)
+        try:
+            self.assertEqual(command.read_checkpoint(path), 
+                (datetime.datetime(2009, 1, 2, 3, 4, 5), 'full user=7', 
+                [(1, 31)]))
+            # and won't resume a run over a different set of entries
+            self.assertRaises(CommandError, command.index_entries, None,
+                {'range_size': 10, 'checkpoint': path, 'batch_size': 500,
+                'processes': 1})
+        finally:
+            os.remove(path)
+        # Only ranges done in full are skipped, whatever the range size
+        done = index.merge_ranges([(1, 11), (21, 31), (11, 16)])
+        self.assertEqual(done, [(1, 16), (21, 31)])
+        self.assertTrue(index.is_covered(5, 15, done))
+        self.assertFalse(index.is_covered(11, 21, done))
+
+    def test_lru_cache(self):
+        from unalog2.base.lru import LRUCache
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache.set(key, key.upper())
+        # Getting a refreshes it, so b is the oldest when d comes in
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('d', 'D')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 3)
+        cache.set_many({'e': 'E', 'a': 'A2'})
+        self.assertEqual(cache.get_many(['a', 'b', 'c', 'd', 'e']),
+            {'a': 'A2', 'd': 'D', 'e': 'E'})
+        self.assertEqual(cache.stats(), {'size': 3, 'max_size': 3, 
+            'hits': 4, 'misses': 3})
+        cache.delete('a')
+        self.assertEqual(cache.get('a', 'gone'), 'gone')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get_many(['d', 'e']), {})
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_name_cache(self):
+        user = m.User.objects.get(username='unalog')
+        m.USER_CACHE.forget('unalog')
+        # As if outside a transaction; loading the fixture dirtied this one
+        transaction.set_clean()
+        hits = m.USER_CACHE.stats()['hits']
+        self.assertEqual(m.USER_CACHE.get('unalog').id, user.id)
+        self.assertEqual(m.USER_CACHE.get('unalog').id, user.id)
+        self.assertEqual(m.USER_CACHE.stats()['hits'], hits + 1)
+        self.assertEqual(m.USER_CACHE.get('unalog').is_active, True)
+        self.assertEqual(m.USER_CACHE.get('nobody'), None)
+        # Another process changing a user drops what this one cached
+        cache.set(m.USER_CACHE.stamp_key, 'elsewhere')
+        misses = m.USER_CACHE.stats()['misses']
+        self.assertEqual(m.USER_CACHE.get('unalog').id, user.id)
+        self.assertEqual(m.USER_CACHE.stats()['misses'], misses + 1)
+        # A save that leaves the cached fields alone keeps them
+        user.last_login = datetime.datetime.now()
+        user.save()
+        hits = m.USER_CACHE.stats()['hits']
+        self.assertEqual(m.USER_CACHE.get('unalog').id, user.id)
+        self.assertEqual(m.USER_CACHE.stats()['hits'], hits + 1)
+        user.username = 'renamed'
+        user.save()
+        self.assertEqual(m.USER_CACHE.get('unalog'), None)
+        self.assertEqual(m.USER_CACHE.get('renamed').id, user.id)
+        # Read after a write in this transaction, so not cached
+        misses = m.USER_CACHE.stats()['misses']
+        m.USER_CACHE.get('renamed')
+        self.assertEqual(m.USER_CACHE.stats()['misses'], misses + 1)
+        group = m.Group.objects.create(name='doomed')
+        transaction.set_clean()
+        self.assertEqual(m.GROUP_CACHE.get('doomed').id, group.id)
+        group.delete()
+        self.assertEqual(m.GROUP_CACHE.get('doomed'), None)
+        url, created = m.Url.get_or_create_by_value(u'http://example.net/')
+        self.assertEqual(m.Url.get_or_create_by_value(u'http://example.net/'),
+            (url, False))
+
+    def test_add_entries_bulk(self):
+        client = Client()
+        self.assertTrue(client.login(username='unalog', password='unalog'))
+        entry = dict(self.test_entry, date_created='2009-12-05T14:10:00Z')
+        body = '\n'.join([json.dumps(entry), '{"url": ', '', 
+            json.dumps(entry), json.dumps(dict(entry, url='not a url'))])
+        response = client.post('/entry/bulk/', body, 
+            content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        results = [json.loads(l) for l in response.content.splitlines()]
+        self.assertEqual([(r['line'], r['status']) for r in results],
+            [(1, 'created'), (2, 'error'), (4, 'duplicate'), (5, 'error')])
+        e = m.Entry.objects.get(id=results[0]['id'])
+        self.assertEqual(e.date_created.year, 2009)
+        self.assertEqual(m.SolrQueue.objects.filter(entry_id=e.id).count(), 1)
+
+    def test_import_zodb_json_bulk(self):
+        from unalog2.base.management.commands import import_zodb_json
+        datadump_dir = tempfile.mkdtemp()
+        os.mkdir('%s/users' % datadump_dir)
+        json.dump({'bulkgroup': {'id': 'bulkgroup', 'desc': '', 
+            'is_private': False}}, open('%s/group.json' % datadump_dir, 'w'))
+        entries = [{'url': 'http://example.com/%s' % (i % 2), 
+            'title': 'bulk %s' % i, 'date': '2008-01-0%sT12:00:00Z' % (i + 1),
+            'tags': ['b', 'a', 'b'], 'groups': ['bulkgroup']} 
+            for i in range(3)]
+        json.dump({'id': 'bulkuser', 'new_password': 'x', 'groups': [], 
+            'group_invites': [], 'filters': [], 'entries': entries}, 
+            open('%s/users/bulkuser.json' % datadump_dir, 'w'))
+        try:
+            import_zodb_json.main_bulk({'directory': datadump_dir, 
+                'index': True, 'processes': 1, 'batch_size': 2})
+            # As if the second batch had failed; a rerun finishes it
+            m.Entry.objects.get(title='bulk 2').delete(solr_delete=False)
+            group_ids = dict(m.Group.objects.values_list('name', 'id'))
+            self.assertEqual(import_zodb_json.bulk_add_user(
+                '%s/users/bulkuser.json' % datadump_dir, group_ids, True, 2),
+                1)
+            m.TagCount.recount()
+        finally:
+            shutil.rmtree(datadump_dir)
+        user = m.User.objects.get(username='bulkuser')
+        qs = m.Entry.objects.filter(user=user).order_by('date_created')
+        self.assertEqual([e.title for e in qs], ['bulk 0', 'bulk 1', 'bulk 2'])
+        self.assertEqual(qs[0].date_created, datetime.datetime(2008, 1, 1, 12))
+        self.assertEqual(user.date_joined, qs[0].date_created)
+        self.assertEqual(m.Url.objects.filter(
+            value__startswith='http://example.com/').count(), 2)
+        self.assertEqual([t.tag.name for t in qs[2].tags.all()], ['b', 'a'])
+        self.assertEqual(qs[2].groups.all()[0].name, 'bulkgroup')
+        self.assertEqual(m.TagCount.objects.get(user=user, 
+            tag__name='a').count, 3)
+        self.assertEqual(m.SolrQueue.objects.filter(
+            entry_id__in=[e.id for e in qs]).count(), 3)
+
+    def test_json_stream(self):
+        from unalog2.base.jsonstream import JSONStream
+        doc = {'id': 'u', 'entries': [{'content': 'a "quoted" \\ ]}' * 20, 
+            'n': 12345}, [], 1.5e10, None], 'groups': ['g']}
+        for chunk_size in [1, 7, 4096]:
+            stream = JSONStream(StringIO(json.dumps(doc)), chunk_size)
+            members = dict(stream.members(skip=['entries']))
+            entries_at = members.pop('entries')
+            self.assertEqual(members, {'id': 'u', 'groups': ['g']})
+            self.assertEqual(list(stream.items(entries_at)), doc['entries'])
+
+    def test_entry_content(self):
+        user = m.User.objects.get(username='unalog')
+        url, created = m.Url.objects.get_or_create(value='http://example.com/')
+        content = u'<p>caf\xe9</p>' * 1000
+        e = m.Entry(user=user, url=url, title='content', content=content,
+            date_created=datetime.datetime.now())
+        e.save(solr_index=False)
+        self.assertEqual(m.EntryContent.objects.get(entry=e).data, content)
+        e = m.Entry.objects.get(id=e.id)
+        self.assertEqual(e._content, None)
+        self.assertEqual(e.content, content)
+        self.assertEqual(m.Entry.solr_docs([e.id])[0]['content'], content)
+        e.content = ''
+        e.save(solr_index=False)
+        self.assertEqual(m.EntryContent.objects.filter(entry=e).count(), 0)
+        self.assertEqual(m.Entry.objects.get(id=e.id).content, u'')
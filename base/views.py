@@ -1,32 +1,39 @@
 import datetime
+import hashlib
 import math
 import re
 import time
+import urllib
 
 from django.conf import settings
 from django.contrib.auth import authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import login
+from django.core.cache import cache
 from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.db.models import Count
 from django import forms
 from django.forms.models import modelformset_factory
 from django.http import Http404, HttpResponse, HttpResponseRedirect, \
-    HttpResponseBadRequest
+    HttpResponseBadRequest, HttpResponseNotAllowed
 from django.http import HttpResponsePermanentRedirect
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext, loader
 from django.utils import feedgenerator
 from django.utils import simplejson as json
+from django.utils.functional import wraps
 from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 
 
 import feedparser
-import solr
 
 from basicauth import logged_in_or_basicauth
+from lru import LRUCache
+from solrpool import SOLR_ERRORS, solr_client
 
 from base import models as m
 from settings import REALM, SOLR_URL
@@ -40,47 +47,38 @@ class EntryForm (forms.Form):
     comment = forms.CharField(required=False, widget=forms.Textarea)
     content = forms.CharField(required=False, widget=forms.Textarea)
 
+def user_filter_set (request):
+    """
+    The logged-in user's compiled filters, looked up once per request.
+    """
+    if not hasattr(request, '_filter_set'):
+        request._filter_set = m.FilterSet.for_user(request.user)
+    return request._filter_set
+
+
+def apply_filter_set (qs, filter_set, prefix=''):
+    """
+    Exclude whatever a compiled FilterSet excludes from a queryset of 
+    entries, or (with prefix='entry__') of things that point at entries.
+    """
+    for kind, lookup in [('user', 'user__in'), ('tag', 'tags__tag__in'),
+        ('url', 'url__in')]:
+        ids = filter_set.ids(kind)
+        if ids:
+            qs = qs.exclude(**{prefix + lookup: ids})
+        for subquery in filter_set.subqueries(kind):
+            qs = qs.exclude(**{prefix + lookup: subquery})
+    return qs
+
+
 def apply_user_filters_to_entries (request, qs):
     # Assume the user's already been authenticated.
-    for f in request.user.filters.filter(is_active=True):
-        if f.attr_name == 'user':
-            if f.is_exact:
-                qs = qs.exclude(user__username=f.value)
-            else:
-                qs = qs.exclude(user__username__icontains=f.value)
-        elif f.attr_name == 'tag':
-            if f.is_exact:
-                qs = qs.exclude(tags__tag__name=f.value)
-            else:
-                qs = qs.exclude(tags__tag__name__icontains=f.value)
-        elif f.attr_name == 'url':
-            if f.is_exact:
-                qs = qs.exclude(url__value=f.value)
-            else:
-                qs = qs.exclude(url__value__icontains=f.value)
-    return qs
+    return apply_filter_set(qs, user_filter_set(request))
 
 
 def apply_user_filters_to_entry_tags (request, qs):
     # Assume the user's already been authenticated.
-    # FIXME: DRY.
-    for f in request.user.filters.filter(is_active=True):
-        if f.attr_name == 'user':
-            if f.is_exact:
-                qs = qs.exclude(entry__user__username=f.value)
-            else:
-                qs = qs.exclude(entry__user__username__icontains=f.value)
-        elif f.attr_name == 'tag':
-            if f.is_exact:
-                qs = qs.exclude(entry__tags__tag__name=f.value)
-            else:
-                qs = qs.exclude(entry__tags__tag__name__icontains=f.value)
-        elif f.attr_name == 'url':
-            if f.is_exact:
-                qs = qs.exclude(entry__url__value=f.value)
-            else:
-                qs = qs.exclude(entry__url__value__icontains=f.value)
-    return qs
+    return apply_filter_set(qs, user_filter_set(request), 'entry__')
 
 
 def constrained_entries (request, requested_user=None, requested_group=None, 
@@ -130,12 +128,100 @@ def constrained_entries (request, requested_user=None, requested_group=None,
     return qs
 
 
-# Hmm, what's the best way to do this?  Punt for now and do 
-# something simple.
-SOLR_CONNECTION = solr.SolrConnection(settings.SOLR_URL)
-
-def solr_connection ():
-    return SOLR_CONNECTION
+def preload_entries (request, entries):
+    """
+    Load everything entry.html needs for a list of entries in a fixed number
+    of queries, no matter how many entries there are.  Results are attached
+    to each entry:  tag_names (in order) and group_list (name and visibility 
+    to this request's user).  Returns the entries as a list.
+    """
+    entries = list(entries)
+    if not entries:
+        return entries
+    entry_ids = [e.id for e in entries]
+
+    tag_names = {}
+    qs = m.EntryTag.objects.filter(entry__in=entry_ids)
+    qs = qs.order_by('entry', 'sequence_num')
+    for entry_id, tag_name in qs.values_list('entry', 'tag__name'):
+        tag_names.setdefault(entry_id, []).append(tag_name)
+
+    member_group_ids = set()
+    if request.user.is_authenticated():
+        member_group_ids = set(request.user.groups.values_list('id', 
+            flat=True))
+    group_lists = {}
+    qs = m.Entry.groups.through.objects.filter(entry__in=entry_ids)
+    qs = qs.order_by('group__name')
+    for entry_id, group_id, group_name, is_private in qs.values_list('entry', 
+        'group', 'group__name', 'group__profile__is_private'):
+        group_lists.setdefault(entry_id, []).append({
+            'name': group_name,
+            'is_visible': not is_private or group_id in member_group_ids,
+            })
+
+    for e in entries:
+        e.tag_names = tag_names.get(e.id, [])
+        e.group_list = group_lists.get(e.id, [])
+    return entries
+
+
+def entries_from_solr (request, docs):
+    """
+    Build unsaved entries, ready for entry.html and atom_feed, straight from
+    solr's stored fields, without going to the database.  Only what solr
+    doesn't store is looked up:  comments for docs indexed before comments
+    were stored, group privacy if any entry is in a group, and the urls'
+    counts for "and N others", all in one query each.
+    """
+    entries = []
+    missing_comments = []
+    for doc in docs:
+        user = m.User(id=int(doc['user_id']), username=doc['user'])
+        url = m.Url(value=doc['url'], 
+            md5sum=hashlib.md5(doc['url'].encode('utf8')).hexdigest())
+        e = m.Entry(id=int(doc['id']), user=user, url=url, 
+            title=doc['title'], comment=doc.get('comment', u''),
+            is_private=doc['is_private_entry'],
+            date_created=doc['date_created'].replace(tzinfo=None))
+        e.tag_names = doc.get('tag', [])
+        e.group_list = [{'name': name, 'is_visible': True} 
+            for name in doc.get('group', [])]
+        if not 'comment' in doc:
+            missing_comments.append(e.id)
+        entries.append(e)
+
+    if entries:
+        counts = dict(m.Url.objects.filter(md5sum__in=set([e.url.md5sum 
+            for e in entries])).values_list('md5sum', 'public_entry_count'))
+        for e in entries:
+            e.url.public_entry_count = counts.get(e.url.md5sum, 0)
+
+    if missing_comments:
+        comments = dict(m.Entry.objects.filter(
+            id__in=missing_comments).values_list('id', 'comment'))
+        for e in entries:
+            if e.id in comments:
+                e.comment = comments[e.id]
+
+    group_names = set()
+    for e in entries:
+        group_names.update([g['name'] for g in e.group_list])
+    if group_names:
+        member_group_ids = set()
+        if request.user.is_authenticated():
+            member_group_ids = set(request.user.groups.values_list('id', 
+                flat=True))
+        hidden = set()
+        for group_id, name, is_private in m.Group.objects.filter(
+            name__in=group_names).values_list('id', 'name', 
+            'profile__is_private'):
+            if is_private and not group_id in member_group_ids:
+                hidden.add(name)
+        for e in entries:
+            for g in e.group_list:
+                g['is_visible'] = not g['name'] in hidden
+    return entries
 
 
 def get_page (request, paginator):
@@ -161,8 +247,210 @@ def pagify (request, qs, num_items=50):
     return paginator, page
 
 
+def encode_cursor (entry):
+    # strftime has no %f before python 2.6
+    return '%s.%06d-%s' % (entry.date_created.strftime('%Y%m%d%H%M%S'), 
+        entry.date_created.microsecond, entry.id)
+
+
+def decode_cursor (cursor):
+    """
+    Turn a cursor from a url back into (date_created, id), or None if
+    it doesn't parse.
+    """
+    try:
+        date_str, entry_id = cursor.split('-')
+        seconds, microseconds = date_str.split('.')
+        date = datetime.datetime.strptime(seconds, '%Y%m%d%H%M%S')
+        return (date.replace(microsecond=int(microseconds)), int(entry_id))
+    except (AttributeError, ValueError):
+        return None
+
+
+class EntryPage (object):
+    """
+    One page of entries, found by seeking from a (date_created, id) cursor
+    instead of counting and OFFSETting.  Pages link to each other with
+    ?after= (newer) and ?before= (older) cursors.
+    """
+    def __init__ (self, qs, object_list=[], has_previous=False, 
+        has_next=False, redirect=None):
+        self.qs = qs
+        self.object_list = object_list
+        self.has_previous = has_previous
+        self.has_next = has_next
+        self.redirect = redirect
+
+    def has_other_pages (self):
+        return self.has_previous or self.has_next
+
+    def previous_cursor (self):
+        return encode_cursor(self.object_list[0])
+
+    def next_cursor (self):
+        return encode_cursor(self.object_list[-1])
+
+    def estimated_count (self):
+        """
+        How many entries there are in all, counted at most every few 
+        minutes per query.
+        """
+        key = 'entry_count:%s' % hashlib.md5(
+            unicode(self.qs.query).encode('utf8')).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = self.qs.count()
+            cache.set(key, count, getattr(settings, 
+                'ENTRY_COUNT_CACHE_SECONDS', 600))
+        return count
+
+
+def pagify_entries (request, qs, num_items=50):
+    """
+    Seek out one page of an entry query set, newest first, preloading 
+    everything needed to render the page's entries.  Old ?p= page links
+    come back as a page with a redirect to the equivalent cursor.
+    """
+    qs = qs.select_related('user', 'url')
+    newest_first = qs.order_by('-date_created', '-id')
+    if 'p' in request.GET:
+        try:
+            page_num = int(request.GET['p'])
+        except ValueError:
+            page_num = 1
+        redirect = request.path
+        if page_num > 1:
+            offset = (page_num - 1) * num_items
+            last = list(newest_first.values_list('date_created', 
+                'id')[offset-1:offset])
+            if last:
+                redirect += '?before=%s' % encode_cursor(m.Entry(
+                    date_created=last[0][0], id=last[0][1]))
+        return EntryPage(qs, redirect=redirect)
+
+    # Row-value comparisons, so postgres walks the (date_created, id) 
+    # index from the cursor rather than sorting everything before it
+    after = decode_cursor(request.GET.get('after'))
+    before = decode_cursor(request.GET.get('before'))
+    if after:
+        rows = list(qs.extra(where=['(base_entry.date_created, base_entry.id)'
+            ' > (%s, %s)'], params=list(after)).order_by(
+            'date_created', 'id')[:num_items+1])
+        has_previous = len(rows) > num_items
+        rows = rows[:num_items]
+        rows.reverse()
+        has_next = True
+    else:
+        if before:
+            newest_first = newest_first.extra(where=['(base_entry.'
+                'date_created, base_entry.id) < (%s, %s)'], 
+                params=list(before))
+        rows = list(newest_first[:num_items+1])
+        has_next = len(rows) > num_items
+        rows = rows[:num_items]
+        has_previous = bool(before)
+    if not rows:
+        has_previous = has_next = False
+    return EntryPage(qs, preload_entries(request, rows), has_previous, 
+        has_next)
+
+
+class SolrEntryPage (EntryPage):
+    """
+    A page of entries found in solr; the total comes from solr too.
+    """
+    def __init__ (self, results, object_list=[], has_previous=False, 
+        has_next=False):
+        super(SolrEntryPage, self).__init__(None, object_list, has_previous,
+            has_next)
+        self.results = results
+
+    def estimated_count (self):
+        if self.results is None:
+            return 0
+        return self.results.count()
+
+
+def solr_browse_page (request, requested_user=None, requested_group=None,
+    tag=None, num_items=50):
+    """
+    Find the same page of entries constrained_entries() and pagify_entries()
+    would, using solr filter queries instead of joins.
+    """
+    # As in constrained_entries(), only your own page shows your private
+    # entries; everywhere else you see what everybody else sees
+    see_private = requested_user is not None and \
+        requested_user == request.user
+    groups = []
+    if requested_group:
+        groups = [requested_group.name]
+        if requested_group.get_profile().is_private:
+            # Members see everything; nobody else sees anything
+            if request.user in requested_group.user_set.all():
+                see_private = True
+            else:
+                return SolrEntryPage(None)
+    results = SolrResults(request, '', rows=0, groups=groups,
+        tags=tag and [tag.name] or [], 
+        users=requested_user and [requested_user.username] or [],
+        see_private=see_private, see_own=False)
+    docs, has_previous, has_next = results.seek(
+        decode_cursor(request.GET.get('before')), 
+        decode_cursor(request.GET.get('after')), num_items)
+    return SolrEntryPage(results, entries_from_solr(request, docs), 
+        has_previous, has_next)
+
+
+def browse_entries (request, requested_user=None, requested_group=None,
+    tag=None):
+    """
+    One page of entries for a browse page, from the database or, if 
+    settings.BROWSE_BACKEND is 'solr', from solr.  Falls back to the 
+    database if solr fails, and for old ?p= links, which only the database
+    knows how to redirect.
+    """
+    if getattr(settings, 'BROWSE_BACKEND', 'db') == 'solr' \
+        and not 'p' in request.GET:
+        try:
+            return solr_browse_page(request, requested_user, 
+                requested_group, tag)
+        except SOLR_ERRORS:
+            pass
+    qs = constrained_entries(request, requested_user, requested_group, tag)
+    return pagify_entries(request, qs)
+
+
+def parse_entry_json (entry_json, date_created):
+    """
+    Validate one entry posted as json.  Returns (form, date_created, error),
+    where error is a plain text explanation, or None if the entry is good.
+    """
+    if not isinstance(entry_json, dict):
+        return (None, date_created, "invalid json: expected an object")
+    form = EntryForm(entry_json)
+    if not form.is_valid():
+        error_msg = ["There was a problem with your JSON:\n"]
+        for k, v in form.errors.items():
+            for e in v:
+                error_msg.append("  %s: %s" % (k, e))
+        return (form, date_created, "\n".join(error_msg))
+
+    # json allows you to post date_created
+    if entry_json.has_key('date_created'):
+        try:
+            # parse the rfc3339 datetime
+            t = entry_json['date_created']
+            t = time.mktime(feedparser._parse_date(t))
+            date_created = datetime.datetime.fromtimestamp(t)
+        except TypeError, e:
+            return (form, date_created, "invalid date_created, should be RFC3339 compatible, e.g.  1985-04-12T23:20:50.52Z")
+    return (form, date_created, None)
+
+
 @csrf_exempt # to allow javascript bookmarklet to post
 @logged_in_or_basicauth(REALM)
+@m.touch_feeds_after_commit
+@transaction.commit_on_success
 def entry_new (request):
     """
     Save a new URL entry. Can either come from an html form, or via some json.
@@ -180,26 +468,13 @@ def entry_new (request):
             # try to parse the json
             try:
                 entry_json = json.loads(request.raw_post_data)
-                form = EntryForm(entry_json)
+                form, date_created, error = parse_entry_json(entry_json,
+                    date_created)
                 # if the json isn't right respond with an text error message
                 # that explains the problem
-                if not form.is_valid():
-                    error_msg = ["There was a problem with your JSON:\n"]
-                    for k, v in form.errors.items():
-                        for e in v:
-                            error_msg.append("  %s: %s" % (k, e))
-                    return HttpResponseBadRequest("\n".join(error_msg),
-                            mimetype="text/plain")
-
-                # json allows you to post date_created
-                if entry_json.has_key('date_created'):
-                    try:
-                        # parse the rfc3339 datetime
-                        t = entry_json['date_created']
-                        t = time.mktime(feedparser._parse_date(t))
-                        date_created = datetime.datetime.fromtimestamp(t)
-                    except TypeError, e:
-                        return HttpResponseBadRequest("invalid date_created, should be RFC3339 compatible, e.g.  1985-04-12T23:20:50.52Z", mimetype="text/plain")
+                if error:
+                    return HttpResponseBadRequest(error, 
+                        mimetype="text/plain")
             except ValueError, e:
 
                 return HttpResponseBadRequest("invalid json: %s" % e, 
@@ -221,6 +496,8 @@ def entry_new (request):
             # Maybe they saved this one before?  Check by url
             old_entries = m.Entry.objects.filter(user=request.user, 
                 url__value=url_str)
+            old_entries = preload_entries(request, 
+                old_entries.select_related('user', 'url'))
             if old_entries:
                 # If it's not 'Save anyway', they haven't confirmed yet
                 if not submit == 'Save anyway':
@@ -234,7 +511,7 @@ def entry_new (request):
                 is_private=is_private, comment=comment, content=content,
                 date_created=date_created)
             
-            url, was_created = m.Url.objects.get_or_create(value=url_str)
+            url, was_created = m.Url.get_or_create_by_value(url_str)
             new_entry.url = url
             
             # Save that sucker before adding many-to-manys
@@ -260,8 +537,107 @@ def entry_new (request):
         {'form': form}, context)
 
 
+# Bulk uploads are written this many entries to a transaction
+BULK_BATCH_SIZE = 100
+
+@csrf_exempt
+@logged_in_or_basicauth(REALM)
+@m.touch_feeds_after_commit
+@transaction.commit_manually
+def entry_bulk (request):
+    """
+    Save many entries at once, posted as newline-delimited json:  one
+    entry per line, each just like the json entry_new takes, except that
+    is_private is honored.  Entries are saved a batch at a time, each batch
+    in its own transaction, and reach solr through the queue like any 
+    other, so the solr worker adds them in bulk and commits once.  A url 
+    the user already saved counts as a duplicate and is skipped, unless 
+    its line says "submit": "Save anyway".
+
+    Responds with newline-delimited json too, one result per non-blank 
+    line, in order:  a 'status' of 'created' (with 'id' and 'location'), 
+    'duplicate' or 'error' (with 'error'), and the 'line' number.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    request.encoding = 'utf-8'
+    results = []
+    batch = []
+    seen_urls = set()
+    try:
+        for line_num, line in enumerate(request.raw_post_data.splitlines()):
+            if not line.strip():
+                continue
+            try:
+                entry_json = json.loads(line)
+                form, date_created, error = parse_entry_json(entry_json, 
+                    datetime.datetime.now())
+            except ValueError, e:
+                error = "invalid json: %s" % e
+            if error:
+                results.append({'line': line_num + 1, 'status': 'error', 
+                    'error': error})
+                continue
+            batch.append((line_num + 1, entry_json, form, date_created))
+            if len(batch) == BULK_BATCH_SIZE:
+                results.extend(save_entry_batch(request, batch, seen_urls))
+                batch = []
+        if batch:
+            results.extend(save_entry_batch(request, batch, seen_urls))
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    results.sort(key=lambda r: r['line'])
+    return HttpResponse(''.join([json.dumps(r) + '\n' for r in results]),
+        mimetype='application/x-ndjson')
+
+
+def save_entry_batch (request, batch, seen_urls):
+    """
+    Save one batch of validated entries for entry_bulk(), and commit.  
+    seen_urls collects the urls saved so far, to catch duplicates within
+    one upload.  Returns a result for each entry.
+    """
+    urls = [form.cleaned_data['url'] for line_num, entry_json, form, 
+        date_created in batch]
+    seen_urls.update(m.Entry.objects.filter(user=request.user, 
+        url__value__in=urls).values_list('url__value', flat=True))
+    default_to_private = request.user.get_profile().default_to_private_entry
+    results = []
+    for line_num, entry_json, form, date_created in batch:
+        data = form.cleaned_data
+        if data['url'] in seen_urls \
+            and not entry_json.get('submit') == 'Save anyway':
+            results.append({'line': line_num, 'status': 'duplicate'})
+            continue
+        sid = transaction.savepoint()
+        try:
+            entry = m.Entry(user=request.user, title=data['title'], 
+                is_private=data['is_private'] or default_to_private, 
+                comment=data['comment'], content=data['content'],
+                date_created=date_created)
+            entry.url, was_created = m.Url.get_or_create_by_value(
+                data['url'])
+            entry.save()
+            entry.add_tags(data['tags'])
+            transaction.savepoint_commit(sid)
+        except Exception, e:
+            transaction.savepoint_rollback(sid)
+            results.append({'line': line_num, 'status': 'error', 
+                'error': str(e)})
+            continue
+        seen_urls.add(data['url'])
+        results.append({'line': line_num, 'status': 'created', 
+            'id': entry.id, 'location': reverse('entry', args=[entry.id])})
+    transaction.commit()
+    return results
+
+
 @logged_in_or_basicauth(REALM)
 @cache_control(no_cache=True)
+@m.touch_feeds_after_commit
+@transaction.commit_on_success
 def entry_delete (request, entry_id):
     """
     Let a user choose to delete an entry.
@@ -279,6 +655,7 @@ def entry_delete (request, entry_id):
             message = 'Deleted entry %s' % entry_id
             request.user.message_set.create(message=message)
             return HttpResponseRedirect(reverse('index'))
+    preload_entries(request, [e])
     return render_to_response('entry_delete.html', 
         {'entry': e}, context)
 
@@ -291,15 +668,19 @@ def entry (request, entry_id):
     # First use the shortcut to bounce to 404 if nec.; a cheat!
     e = get_object_or_404(m.Entry, id=entry_id)
     qs = constrained_entries(request, candidate_ids=[entry_id])
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
         'title': 'link %s from %s' % (entry_id, e.user.username), 
-        'paginator': paginator, 'page': page,
+        'page': page,
         }, context)
 
 
 @logged_in_or_basicauth(REALM)
 @cache_control(no_cache=True)
+@m.touch_feeds_after_commit
+@transaction.commit_on_success
 def entry_edit (request, entry_id):
     context = RequestContext(request)
     e = get_object_or_404(m.Entry, id=entry_id)
@@ -316,11 +697,11 @@ def entry_edit (request, entry_id):
             e.comment = form.cleaned_data['comment']
             e.content = form.cleaned_data['content']
             
-            url, was_created = m.Url.objects.get_or_create(value=url_str)
+            url, was_created = m.Url.get_or_create_by_value(url_str)
             e.url = url
             
             # Remove original tags
-            m.EntryTag.objects.filter(entry=e).delete()
+            e.clear_tags()
             
             e.add_tags(tags_orig)
             e.save()
@@ -374,11 +755,53 @@ def atom_feed (page, **kwargs):
         feed.add_item(title=entry.title, link=entry.url.value, 
             id=reverse('entry', args=[entry.id]),
             description=entry.comment, pubdate=entry.date_created,
-            categories=[entry_tag.tag.name for entry_tag in entry.tags.all()])
+            categories=entry.tag_names)
     return HttpResponse(feed.writeString('utf8'), 
         mimetype='application/xml')
 
 
+def conditional_feed (scopes):
+    """
+    Decorator for feed views.  scopes(request, *args, **kwargs) names the
+    feed scopes the view's entries come from (see models.touch_feeds); as 
+    long as none of them has been written to, conditional GETs get a 304,
+    and anything else gets the body cached from the last render.
+    """
+    def stamps (request, *args, **kwargs):
+        if not hasattr(request, '_feed_stamps'):
+            names = scopes(request, *args, **kwargs)
+            if request.user.is_authenticated():
+                names.append(('filters', request.user.id))
+            request._feed_stamps = m.feed_stamps(names)
+        return request._feed_stamps
+
+    def etag (request, *args, **kwargs):
+        viewer = None
+        if request.user.is_authenticated():
+            viewer = request.user.id
+        return hashlib.md5(repr((request.get_full_path(), viewer, 
+            stamps(request, *args, **kwargs)))).hexdigest()
+
+    def last_modified (request, *args, **kwargs):
+        return datetime.datetime.utcfromtimestamp(
+            max(stamps(request, *args, **kwargs)))
+
+    def decorator (view):
+        def cached_view (request, *args, **kwargs):
+            key = 'feed_body:%s' % etag(request, *args, **kwargs)
+            body = cache.get(key)
+            if body is not None:
+                return HttpResponse(body, mimetype='application/xml')
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 \
+                and response['Content-Type'] == 'application/xml':
+                cache.set(key, response.content, 
+                    getattr(settings, 'FEED_CACHE_SECONDS', 3600))
+            return response
+        return condition(etag, last_modified)(wraps(view)(cached_view))
+    return decorator
+
+
 def about (request):
     context = RequestContext(request)
     return render_to_response('about.html', 
@@ -404,52 +827,83 @@ def register_view (request):
 
 def index (request):
     context = RequestContext(request)
-    qs = constrained_entries(request)
-    paginator, page = pagify(request, qs)
+    page = browse_entries(request)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
         'title': 'home', 
-        'paginator': paginator, 'page': page, 
+        'page': page, 
         'feed_url': reverse('feed'),
+        'tag_cloud': browse_tag_cloud(request),
+        'drill_down_param': drill_down_param(),
         }, context)
 
 
+@conditional_feed(lambda request: [('site',)])
 def feed (request):
     context = RequestContext(request)
     qs = constrained_entries(request)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return atom_feed(page=page, title='latest from everybody')
 
         
 def tag (request, tag_name):
     context = RequestContext(request)
-    t = get_object_or_404(m.Tag, name=tag_name)
-    qs = constrained_entries(request, tag=t)
-    paginator, page = pagify(request, qs)
+    t = m.TAG_CACHE.get_or_404(tag_name)
+    page = browse_entries(request, tag=t)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
         'browse_type': 'tag', 'tag': t,
-        'paginator': paginator, 'page': page, 
+        'page': page, 
         'feed_url': reverse('tag_feed', args=[tag_name]),
+        'tag_cloud': browse_tag_cloud(request, tag=t),
+        'drill_down_param': drill_down_param(tags=[t.name]),
         }, context)
 
 
+@conditional_feed(lambda request, tag_name: [('tag', tag_name)])
 def tag_feed (request, tag_name):
     context = RequestContext(request)
-    t = get_object_or_404(m.Tag, name=tag_name)
+    t = m.TAG_CACHE.get_or_404(tag_name)
     qs = constrained_entries(request, tag=t)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return atom_feed(page=page, 
         title='latest from everybody for tag "%s"' % tag_name,
         link=reverse('tag', args=[tag_name]))
 
 
+def tag_counts (request, requested_user=None):
+    """
+    Return a values query set of tag names and counts ('tag__name' and
+    'tag_count') visible to this request, site-wide or for one user.  Reads
+    the materialized counts unless the viewer's filters have to be applied 
+    entry by entry.
+    """
+    if request.user.is_authenticated() and request.user != requested_user \
+        and user_filter_set(request):
+        if requested_user:
+            qs = m.EntryTag.objects.filter(entry__user=requested_user)
+        else:
+            # Inactive users are left out, as SiteTagCount leaves them out
+            qs = m.EntryTag.objects.filter(
+                entry__user__userprofile__is_private=False,
+                entry__user__is_active=True)
+        qs = qs.exclude(entry__is_private=True)
+        qs = apply_user_filters_to_entry_tags(request, qs)
+        return qs.values('tag__name').annotate(tag_count=Count('tag'))
+    qs = m.TagCount.visible(requested_user, request.user)
+    return qs.values('tag__name', 'tag_count')
+
+
 def tags (request):
     context = RequestContext(request)
-    qs = m.EntryTag.objects.filter(entry__user__userprofile__is_private=False)
-    qs = qs.exclude(entry__is_private=True)
-    if request.user.is_authenticated():
-        qs = apply_user_filters_to_entry_tags(request, qs)
-    qs = qs.values('tag__name').annotate(Count('tag'))
-    qs_count = qs.order_by('-tag__count')
+    qs = tag_counts(request)
+    qs_count = qs.order_by('-tag_count', 'tag__name')
     count_paginator, count_page = pagify(request, qs_count)
     qs_alpha = qs.order_by('tag__name')
     alpha_paginator, alpha_page = pagify(request, qs_alpha)
@@ -479,19 +933,24 @@ def may_see_user (request, entry_user):
 
 def user (request, user_name):
     context = RequestContext(request)
-    u = get_object_or_404(m.User, username=user_name)
-    qs = constrained_entries(request, requested_user=u)
-    paginator, page = pagify(request, qs)
+    u = m.USER_CACHE.get_or_404(user_name)
+    page = browse_entries(request, requested_user=u)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
-        'paginator': paginator, 'page': page,
+        'page': page,
         'browse_type': 'user', 'browse_user': u, 
         'browse_user_name': u.username,
         'feed_url': reverse('user_feed', args=[user_name]),
+        'tag_cloud': browse_tag_cloud(request, requested_user=u),
+        'drill_down_param': drill_down_param(users=[u.username]),
         }, context)
 
 
 @logged_in_or_basicauth(REALM)
 @cache_control(no_cache=True)
+@m.touch_feeds_after_commit
+@transaction.commit_on_success
 def prefs (request):
     context = RequestContext(request)
     if request.method == 'POST':
@@ -502,11 +961,15 @@ def prefs (request):
             form.save()
             if form.cleaned_data['is_private'] != is_private_before:
                 form.instance.solr_reindex()
+                request.user.message_set.create(
+                    message='Updated!  Search will catch up shortly.')
+                return HttpResponseRedirect(reverse('prefs'))
             request.user.message_set.create(message='Updated!')
             return HttpResponseRedirect(reverse('index'))
         else:
             request.user.message_set.create(message='Something went wrong, please try again.')
-    profile_form = m.UserProfileForm(instance=request.user.get_profile())
+    profile = request.user.get_profile()
+    profile_form = m.UserProfileForm(instance=profile)
     has_lotsa_entries = False
     # Warning, arbitrary constant
     if request.user.entries.count() > 50:
@@ -515,37 +978,49 @@ def prefs (request):
         'title': 'preferences',
         #'user_form': user_form,
         'profile_form': profile_form,
-        'has_lotsa_entries': has_lotsa_entries
+        'has_lotsa_entries': has_lotsa_entries,
+        'reindex_pending': profile.solr_reindex_pending(),
         }, context)
 
+@conditional_feed(lambda request, user_name: [('user', user_name)])
 def user_feed (request, user_name):
     context = RequestContext(request)
-    u = get_object_or_404(m.User, username=user_name)
+    u = m.USER_CACHE.get_or_404(user_name)
     qs = constrained_entries(request, requested_user=u)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return atom_feed(page=page, title='latest from %s' % user_name,
         link=reverse('user_feed', args=[user_name]))
 
 
 def user_tag (request, user_name, tag_name=''):
     context = RequestContext(request)
-    u = get_object_or_404(m.User, username=user_name)
-    t = get_object_or_404(m.Tag, name=tag_name)
-    qs = constrained_entries(request, requested_user=u, tag=t)
-    paginator, page = pagify(request, qs)
+    u = m.USER_CACHE.get_or_404(user_name)
+    t = m.TAG_CACHE.get_or_404(tag_name)
+    page = browse_entries(request, requested_user=u, tag=t)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
-        'paginator': paginator, 'page': page,
+        'page': page,
         'browse_type': 'tag', 'browse_user': u, 'tag': t,
         'feed_url': reverse('user_tag_feed', args=[user_name, tag_name]),
+        'tag_cloud': browse_tag_cloud(request, requested_user=u, tag=t),
+        'drill_down_param': drill_down_param(tags=[t.name], 
+            users=[u.username]),
         }, context)
 
 
+@conditional_feed(lambda request, user_name, tag_name='':
+    [('user', user_name), ('tag', tag_name)])
 def user_tag_feed (request, user_name, tag_name=''):
     context = RequestContext(request)
-    u = get_object_or_404(m.User, username=user_name)
-    t = get_object_or_404(m.Tag, name=tag_name)
+    u = m.USER_CACHE.get_or_404(user_name)
+    t = m.TAG_CACHE.get_or_404(tag_name)
     qs = constrained_entries(request, requested_user=u, tag=t)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return atom_feed(page=page, 
         title='latest from %s - tag "%s"' % (user_name, tag_name),
         link=reverse('user_tag', args=[user_name, tag_name]))
@@ -560,15 +1035,8 @@ def user_tags (request, user_name):
         return render_to_response('index.html', {
             'message': message,
             }, context)
-    qs = m.EntryTag.objects.filter(entry__user=u)
-    if request.user != u:
-        qs = qs.exclude(entry__is_private=True)
-        # I *think* we should do this here. You might be interested in some other
-        # user's tags on stuff that you haven't filtered out, right?
-        if request.user.is_authenticated():
-            qs = apply_user_filters_to_entry_tags(request, qs)
-    qs = qs.values('tag__name').annotate(Count('tag'))
-    qs_count = qs.order_by('-tag__count')
+    qs = tag_counts(request, requested_user=u)
+    qs_count = qs.order_by('-tag_count', 'tag__name')
     count_paginator, count_page = pagify(request, qs_count)
     qs_alpha = qs.order_by('tag__name')
     alpha_paginator, alpha_page = pagify(request, qs_alpha)
@@ -618,21 +1086,26 @@ def url (request, md5sum=''):
     url = get_object_or_404(m.Url, md5sum=md5sum)
     qs = constrained_entries(request)
     qs = qs.filter(url=url)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
         'view_hidden': False,
-        'paginator': paginator, 'page': page,
+        'page': page,
         'browse_type': 'url', 'browse_url': url,
         'feed_url': reverse('url_feed', args=[md5sum]),
         }, context)
 
 
+@conditional_feed(lambda request, md5sum='': [('url', md5sum)])
 def url_feed (request, md5sum=''):
     context = RequestContext(request)
-    u = get_object_or_404(m.Url, md5sum=md5sum)
+    u = m.URL_CACHE.get_or_404(md5sum)
     qs = constrained_entries(request)
     qs = qs.filter(url=u)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return atom_feed(page=page, title='latest for url',
         link=reverse('url', args=[md5sum]))
 
@@ -652,21 +1125,26 @@ def may_see_group (request_user, group):
     
 def group (request, group_name=''):
     context = RequestContext(request)
-    g = get_object_or_404(m.Group, name=group_name)
-    qs = constrained_entries(request, requested_group=g)
-    paginator, page = pagify(request, qs)
+    g = m.GROUP_CACHE.get_or_404(group_name)
+    page = browse_entries(request, requested_group=g)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
-        'paginator': paginator, 'page': page,
+        'page': page,
         'browse_type': 'group', 'browse_group': g, 
         'feed_url': reverse('group_feed', args=[group_name]),
         }, context)
         
         
+@conditional_feed(lambda request, group_name='':
+    [('group', group_name)])
 def group_feed (request, group_name=''):
     context = RequestContext(request)
-    g = get_object_or_404(m.Group, name=group_name)
+    g = m.GROUP_CACHE.get_or_404(group_name)
     qs = constrained_entries(request, requested_group=g)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return atom_feed(page=page, title='latest from group "%s"' % group_name,
         link=reverse('group', args=[group_name]))
     
@@ -689,10 +1167,12 @@ def group_tag (request, group_name, tag_name=''):
     # If they're not a member, don't let them see private stuff
     if not request.user in group.user_set.all():
         qs.exclude(is_private=True)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return render_to_response('index.html', {
         'title': "Group %s's tag %s" % (group_name, tag_name),
-        'paginator': paginator, 'page': page,
+        'page': page,
         'browse_type': 'group', 'browse_group': group, 'tag': tag_name,
         'feed_url': reverse('group_tag_feed', args=[group_name, tag_name]),
         }, context)
@@ -711,7 +1191,9 @@ def group_tag_feed (request, group_name):
     # If they're not a member, don't let them see private stuff
     if not request.user in group.user_set.all():
         qs.exclude(is_private=True)
-    paginator, page = pagify(request, qs)
+    page = pagify_entries(request, qs)
+    if page.redirect:
+        return HttpResponseRedirect(page.redirect)
     return atom_feed(page=page, 
         title='latest from group "%s" tag "%s"' % (group_name, tag_name),
         link=reverse('group_tag_feed', args=[group_name, tag_name]))
@@ -722,66 +1204,303 @@ COMMON_FACET_PARAMS = {
     'facet': 'true',
     'facet.field': 'tag',
     'facet.mincount': 2,
+    'facet.limit': 50,
     }        
 
 
         
-def _fill_out_query (request, q=''):
-    # always encode first
-    full_query = q.encode('utf8') 
+# Solr limits how many clauses one query may have (maxBooleanClauses)
+MAX_FILTER_CLAUSES = 1000
+
+def solr_phrase (value):
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return '"%s"' % value.encode('utf8')
+
+
+# Characters solr's query parser treats specially outside a phrase
+RE_SOLR_SPECIAL = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/\s])')
+
+def solr_wildcard (value):
+    """
+    A query term matching any value with value in it.  Unlike icontains 
+    it's case sensitive, so try it as given and in lower case.
+    """
+    terms = []
+    for v in [value, value.lower()]:
+        term = '*%s*' % RE_SOLR_SPECIAL.sub(r'\\\1', v).encode('utf8')
+        if not term in terms:
+            terms.append(term)
+    return ' OR '.join(terms)
+
+
+def search_filters (request, see_private=False, see_own=True):
+    """
+    Return the solr filter queries (fq) that limit a search to what this
+    request may see:  visibility first, then one or more per active filter.
+    Kept apart from the user's query so solr can cache each on its own and 
+    reuse it across queries and users.  see_private skips the privacy 
+    checks, as for members browsing a private group.  see_own=False 
+    leaves out a logged-in user's own private entries too, as browse 
+    pages other than their own do.
+    """
     # don't show inactive user entries
-    full_query += ' is_active_user:true'
-    # check for logged-in user's own entries in case they're private
-    if request.user.is_authenticated():
-        full_query += ' (user:%s OR (is_private_entry:false AND is_private_user:false))' \
-            % request.user.username
-    else:
-        full_query += ' (is_private_entry:false AND is_private_user:false)'
-    return full_query
+    fqs = ['is_active_user:true']
+    public = 'is_private_entry:false AND is_private_user:false'
+    if not request.user.is_authenticated():
+        if not see_private:
+            fqs.append(public)
+        return fqs
+    # a logged-in user's own entries show up even if they're private
+    if not see_private:
+        if see_own:
+            fqs.append('user:%s OR (%s)' % (
+                solr_phrase(request.user.username), public))
+        else:
+            fqs.append(public)
+    filter_set = user_filter_set(request)
+    for (kind, value, is_exact), matches in zip(filter_set.filters,
+        filter_set.matches):
+        if matches is None:
+            # Too broad to list; match the names in solr instead
+            if is_exact:
+                fqs.append('-%s:%s' % (kind, solr_phrase(value)))
+            else:
+                fqs.append('-%s:(%s)' % (kind, solr_wildcard(value)))
+            continue
+        if kind == 'user':
+            field = 'user_id'
+            terms = [str(i) for i in sorted(matches.keys())]
+        else:
+            field = kind
+            terms = [solr_phrase(v) for v in sorted(matches.values())]
+        for i in range(0, len(terms), MAX_FILTER_CLAUSES):
+            fqs.append('-%s:(%s)' % (field, 
+                ' OR '.join(terms[i:i+MAX_FILTER_CLAUSES])))
+    return fqs
         
+
+# Search results are cached per process until the next solr commit.
+SEARCH_CACHE = LRUCache(getattr(settings, 'SEARCH_CACHE_SIZE', 1000))
+_search_cache_generation = [None]
+
+class SolrResults (object):
+    """
+    One search's results, sliceable so django's Paginator can page through
+    them.  Each page is one solr query, cached by normalized query, viewer,
+    filters, sort and position, for as long as the index generation (the 
+    time of the last solr commit) stays the same.  Every query also facets 
+    on tag, so the related-tag cloud comes along in the same request and is
+    cached with the results.
+
+    tags, users and groups narrow the results down to entries with all of
+    those tags, from any of those users, in all of those groups; an empty q
+    then matches everything.
+    """
+    def __init__ (self, request, q, sort='date_created', sort_order='desc',
+        rows=50, tags=[], users=[], groups=[], see_private=False, 
+        see_own=True, timeout=None):
+        # always encode first
+        self.q = (q.strip() or '*:*').encode('utf8')
+        self.tags = tags
+        self.filter_queries = search_filters(request, see_private, see_own)
+        self.filter_queries.extend(['tag:%s' % solr_phrase(t) for t in tags])
+        if users:
+            self.filter_queries.append('user:(%s)' % 
+                ' OR '.join([solr_phrase(u) for u in users]))
+        self.filter_queries.extend(['group:%s' % solr_phrase(g) 
+            for g in groups])
+        self.sort = sort
+        self.sort_order = sort_order
+        self.rows = rows
+        # The pool's read timeout, unless given
+        self.params = {}
+        if timeout:
+            self.params['timeout'] = timeout
+        viewer = None
+        if request.user.is_authenticated():
+            viewer = request.user.username
+        generation = m.IndexMark.generation()
+        if generation != _search_cache_generation[0]:
+            SEARCH_CACHE.clear()
+            _search_cache_generation[0] = generation
+        self.key = (generation, ' '.join(q.split()), viewer,
+            hashlib.md5('\n'.join(self.filter_queries)).hexdigest(), sort, 
+            sort_order, rows)
+        self.total = None
+        self.facets = None
+
+    def query (self, start):
+        key = self.key + (start,)
+        cached = SEARCH_CACHE.get(key)
+        if cached is None:
+            params = dict(COMMON_FACET_PARAMS, **self.params)
+            response = solr_client().query(self.q, fq=self.filter_queries,
+                start=start, rows=self.rows, sort=self.sort, 
+                sort_order=self.sort_order, **params)
+            cached = (int(response.numFound), list(response.results),
+                tag_facets(response))
+            SEARCH_CACHE.set(key, cached)
+        self.total = cached[0]
+        self.facets = cached[2]
+        return cached[1]
+
+    def count (self):
+        if self.total is None:
+            self.query(0)
+        return self.total
+
+    def seek (self, before=None, after=None, num_items=50):
+        """
+        Return one page of results, newest first, seeking from a 
+        (date_created, id) cursor just as pagify_entries() does, as (docs, 
+        has_previous, has_next).  Cached like any other page.
+        """
+        key = self.key + ('seek', before, after, num_items)
+        cached = SEARCH_CACHE.get(key)
+        if cached is None:
+            q = self.q
+            sort_order = 'desc'
+            # The index keeps date_created to the second
+            if before:
+                date_str = before[0].strftime('%Y-%m-%dT%H:%M:%SZ')
+                q = '(%s) AND (date_created:[* TO %s-1SECOND] OR ' \
+                    '(date_created:"%s" AND id:[* TO %s]))' % (q, date_str, 
+                    date_str, before[1] - 1)
+            elif after:
+                date_str = after[0].strftime('%Y-%m-%dT%H:%M:%SZ')
+                q = '(%s) AND (date_created:[%s+1SECOND TO *] OR ' \
+                    '(date_created:"%s" AND id:[%s TO *]))' % (q, date_str, 
+                    date_str, after[1] + 1)
+                sort_order = 'asc'
+            response = solr_client().query(q, fq=self.filter_queries,
+                rows=num_items + 1, sort='date_created,id', 
+                sort_order=sort_order, **self.params)
+            cached = list(response.results)
+            SEARCH_CACHE.set(key, cached)
+        docs = cached[:num_items]
+        more = len(cached) > num_items
+        if after:
+            docs.reverse()
+            return (docs, more, True)
+        return (docs, bool(before), more)
+
+    def tag_cloud (self):
+        """
+        Return the tags most used in these results, as dicts of 'name' and 
+        'count', most used first, leaving out the ones already narrowed to.
+        """
+        if self.facets is None:
+            self.query(0)
+        return [f for f in self.facets if not f['name'] in self.tags]
+
+    def __len__ (self):
+        return self.count()
+
+    def __getitem__ (self, k):
+        if isinstance(k, slice):
+            start = k.start or 0
+            return self.query(start)[:k.stop - start]
+        return self.query(k)[0]
+
+
+def tag_facets (response):
+    try:
+        counts = response.facet_counts['facet_fields']['tag']
+    except (AttributeError, KeyError):
+        return []
+    pairs = sorted(counts.items(), key=lambda (name, count): (-count, name))
+    return [{'name': name, 'count': count} for name, count in pairs]
+
+
+def browse_tag_cloud (request, requested_user=None, tag=None):
+    """
+    The related-tag cloud for a browse page, from one solr facet query over
+    the same entries the page lists, kept in the django cache until the 
+    next solr commit.  Browsing goes on fine without it if solr is down or
+    slow; the empty cloud is then kept for a minute, so pages don't each
+    wait on solr in turn.
+    """
+    users = requested_user and [requested_user.username] or []
+    tags = tag and [tag.name] or []
+    see_private = requested_user is not None and \
+        requested_user == request.user
+    results = SolrResults(request, '', rows=0, tags=tags, users=users,
+        see_private=see_private, see_own=False, 
+        timeout=getattr(settings, 'TAG_CLOUD_TIMEOUT', 2))
+    key = 'tag_cloud:%s' % hashlib.md5(repr(results.key)).hexdigest()
+    cloud = cache.get(key)
+    if cloud is None:
+        try:
+            cloud = results.tag_cloud()
+            seconds = getattr(settings, 'TAG_CLOUD_CACHE_SECONDS', 3600)
+        except SOLR_ERRORS:
+            cloud = []
+            seconds = 60
+        cache.set(key, cloud, seconds)
+    return cloud
+
+
+def drill_down_param (q='', tags=[], users=[]):
+    """
+    The query string, ending in '&', that repeats a search (or the browse
+    page standing in for one) so a tag can be added on.
+    """
+    params = [('q', q.encode('utf8'))]
+    params.extend([('user', u.encode('utf8')) for u in users])
+    params.extend([('tag', t.encode('utf8')) for t in tags])
+    return urllib.urlencode(params) + '&'
+
+
+def search_params (request):
+    request.encoding = 'utf-8'
+    return (request.GET.get('q', ''), request.GET.getlist('tag'), 
+        request.GET.getlist('user'))
+
         
 def search (request):
-    request.encoding = 'utf-8'
     context = RequestContext(request)
-    q = request.GET.get('q', '')
-    if q:
-        full_query = _fill_out_query(request, q)
-        s = solr_connection()
-        results = s.query(full_query.encode('utf8'), rows=50, 
-            sort='date_created', sort_order='desc')
-        paginator = solr.SolrPaginator(results)
+    q, tags, users = search_params(request)
+    if q or tags or users:
+        results = SolrResults(request, q, tags=tags, users=users)
+        paginator = Paginator(results, 50)
         try:
             page = get_page(request, paginator)
-            page.object_list = m.Entry.objects.filter(id__in=[r['id'] for r in page.object_list])
-        except:
+            page.object_list = entries_from_solr(request, page.object_list)
+            tag_cloud = results.tag_cloud()
+        except SOLR_ERRORS:
             page = None
+            tag_cloud = []
+        title = q and 'Search for "%s"' % q or 'Search'
+        if users:
+            title += ' by %s' % ', '.join(users)
+        if tags:
+            title += ' tagged %s' % ', '.join(tags)
+        query_param = drill_down_param(q, tags, users)
         return render_to_response('index.html', {
-            'q': q, 'title': 'Search for "%s"' % q,
-            'page': page, 'query_param': 'q=%s&' % q,
+            'q': q, 'title': title,
+            'page': page, 'query_param': query_param,
+            'tag_cloud': tag_cloud, 'drill_down_param': query_param,
             }, context)
     return render_to_response('index.html', context)
 
 
+@conditional_feed(lambda request: [('search',)])
 def search_feed (request):
     """
     FIXME: doesn't do opensearch right
     """
-    request.encoding = 'utf-8'
     context = RequestContext(request)
-    q = request.GET.get('q', '')
-    if q:
-        full_query = _fill_out_query(request, q)
-        s = solr_connection()
-        results = s.query(full_query.encode('utf8'), rows=50, 
-            sort='date_created', sort_order='desc')
-        paginator = solr.SolrPaginator(results)
+    q, tags, users = search_params(request)
+    if q or tags or users:
+        paginator = Paginator(SolrResults(request, q, tags=tags, 
+            users=users), 50)
         try:
             page = get_page(request, paginator)
-            page.object_list = m.Entry.objects.filter(id__in=[r['id'] for r in page.object_list])
+            page.object_list = entries_from_solr(request, page.object_list)
             return atom_feed(page=page, 
                 title='latest for search "%s"' % q,
                 link=reverse('search_feed'))
-        except: 
+        except SOLR_ERRORS:
             page = None
     return render_to_response('index.html', context)
 
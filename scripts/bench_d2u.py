@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Benchmark reading a big delicious export the way d2u.py does.  Writes a
+synthetic export (100,000 bookmarks by default, see d2u_standin.py) and
+reads it in a fresh process for each reader, reporting peak RSS, the time
+until the first bookmark comes out (nothing can be posted before that) and
+the time to read them all:
+
+  ./bench_d2u.py
+  ./bench_d2u.py --bookmarks 10000 --keep bookmarks.htm
+
+The 'stream' reader is d2u.read_bookmarks.  If html5lib and lxml are
+installed, the 'tree' reader -- parsing the whole export into a tree and
+walking its dt elements, as d2u.py used to -- is measured alongside it.
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import d2u_standin
+
+opt_parser = optparse.OptionParser()
+opt_parser.add_option('--bookmarks', type=int, dest='bookmarks',
+                      default=100000, help='bookmarks in the export')
+opt_parser.add_option('--keep', dest='keep',
+                      help='write the export here and leave it')
+opt_parser.add_option('--child', dest='child', help=optparse.SUPPRESS_HELP)
+
+XHTML = "http://www.w3.org/1999/xhtml"
+
+
+def tree_bookmarks(path):
+    from html5lib import HTMLParser, treebuilders
+    parser = HTMLParser(tree=treebuilders.getTreeBuilder("lxml"))
+    doc = parser.parse(open(path))
+    for dt in doc.findall(".//{%s}dt" % XHTML):
+        e = dt.getnext()
+        if e is not None and e.tag == "{%s}dd" % XHTML:
+            dd = e.text
+        else:
+            dd = None
+        yield dt.find('{%s}a' % XHTML).attrib, dd
+
+
+def stream_bookmarks(path):
+    import d2u
+    return d2u.read_bookmarks(open(path))
+
+
+def child(reader, path):
+    """
+    Read every bookmark, printing the times to the first and the last.
+    """
+    start = time.time()
+    first = None
+    count = 0
+    for dt, dd in reader(path):
+        if first is None:
+            first = time.time() - start
+        count += 1
+    print json.dumps({'count': count, 'first': first,
+        'total': time.time() - start})
+
+
+def measure(mode, path):
+    """
+    Run one reader in its own process, returning its report along with
+    its peak RSS in MB.
+    """
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+        '--child', mode, path], stdout=subprocess.PIPE)
+    out = proc.stdout.read()
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    if status:
+        return None
+    result = json.loads(out)
+    # ru_maxrss is in kilobytes on linux, bytes on os x
+    if sys.platform == 'darwin':
+        result['rss'] = rusage.ru_maxrss / 1048576.0
+    else:
+        result['rss'] = rusage.ru_maxrss / 1024.0
+    return result
+
+
+def main():
+    opts, args = opt_parser.parse_args()
+    if opts.child:
+        readers = {'stream': stream_bookmarks, 'tree': tree_bookmarks}
+        child(readers[opts.child], args[0])
+        return
+
+    path = opts.keep or tempfile.mktemp(suffix='.htm')
+    d2u_standin.write_export(path, opts.bookmarks, 4, 8765)
+    print 'export: %s bookmarks, %.1f MB' % (opts.bookmarks,
+        os.path.getsize(path) / 1048576.0)
+    try:
+        modes = ['stream']
+        try:
+            import html5lib, lxml
+            modes.append('tree')
+        except ImportError:
+            print '(html5lib or lxml not installed, skipping tree reader)'
+        print '%-8s %10s %12s %12s %10s' % ('reader', 'bookmarks',
+            'first (s)', 'total (s)', 'peak MB')
+        for mode in modes:
+            result = measure(mode, path)
+            if result is None:
+                print '%-8s %10s' % (mode, 'failed')
+                continue
+            print '%-8s %10s %12.3f %12.1f %10.1f' % (mode, result['count'],
+                result['first'], result['total'], result['rss'])
+    finally:
+        if not opts.keep:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
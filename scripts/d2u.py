@@ -3,95 +3,196 @@
 """
 This is a delicious to unalog import tool. You'll need to export your
 delicious links and save them as a file ... it should be html. Then
-you run this script with your unalog username and password with the 
+you run this script with your unalog username and password with the
 delicious export file:
 
   ./d2u.py --username me --password secret delicious-20101216.htm
 
 Use --unalog if you want to target another unalog instance.
 
-You will need lxml, html5lib and httplib2 installed:
+Page content is fetched by a pool of --workers threads, at most --per-host
+at a time from any one host, while bookmarks already fetched are posted to
+unalog.  Each bookmark posted is recorded in a checkpoint file (by default
+the export file's name plus '.checkpoint'); run the same command again
+after an interruption and it picks up with whatever wasn't posted yet.
+
+To try it out without touching the real thing, see d2u_standin.py.
+
+The export is read as a stream, so posting starts with the first bookmarks
+and memory stays flat however big it is (see bench_d2u.py).
+
+You will need httplib2 installed:
 
-    easy_install lxml
-    easy_install html5lib
     easy_install httplib2
 
 """
 
+import codecs
+import htmlentitydefs
+import HTMLParser
 import httplib2
 import json
 import optparse
 import os
+import Queue
 import socket
 import sys
+import threading
 import time
 import urllib2
-
-from html5lib import HTMLParser, treebuilders
-from lxml import etree
+import urlparse
 
 socket.setdefaulttimeout(10)
 
 opt_parser = optparse.OptionParser()
 opt_parser.add_option('-u', '--username', dest='username')
 opt_parser.add_option('-p', '--password', dest='password')
-opt_parser.add_option('-n', '--unalog', dest='unalog', 
+opt_parser.add_option('-n', '--unalog', dest='unalog',
                       default="http://unalog.com")
 opt_parser.add_option('-s', '--skip', type=int, dest='skip', default=0)
 opt_parser.add_option('-c', '--check', action='store_true', dest='check')
+opt_parser.add_option('-w', '--workers', type=int, dest='workers',
+                      default=8, help='pages to fetch at once')
+opt_parser.add_option('--per-host', type=int, dest='per_host', default=2,
+                      help='pages to fetch at once from any one host')
+opt_parser.add_option('--checkpoint', dest='checkpoint',
+                      help='file recording bookmarks already posted')
 
-opts, args = opt_parser.parse_args()
 
-if len(args) != 1:
-    opt_parser.error("must supply delicious bookmarks html file")
-elif not os.path.isfile(args[0]):
-    opt_parser.error("no such file: %s" % args[0])
-else:
-    delicious = args[0]
+class ExportReader(HTMLParser.HTMLParser):
+    """
+    Picks (dt, dd) bookmark pairs out of a delicious html export as it is
+    fed, without building a tree: dt is a dict of the link's attributes
+    plus its 'title', dd the comment that follows it, or None.  The export
+    leaves dt and dd unclosed, so a bookmark is done when the next dt
+    starts or the list ends.
+    """
 
-if not opts.username or not opts.password:
-    opt_parser.error("must supply --username or --password")
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.done = []
+        self.dt = None
+        self.dd = None
+        self.text = None
 
-# parse the delicious html bookmarks export 
-xhtml = "http://www.w3.org/1999/xhtml"
-parser = HTMLParser(tree=treebuilders.getTreeBuilder("lxml"))
-doc = parser.parse(open(delicious))
+    def finish(self):
+        if self.dt is not None:
+            if self.dd is not None:
+                self.dd = u''.join(self.dd).strip() or None
+            self.done.append((self.dt, self.dd))
+        self.dt = self.dd = self.text = None
 
-# create http client
-h = httplib2.Http()
-h.add_credentials(opts.username, opts.password)
-unalog = opts.unalog.rstrip("/") + "/entry/new"
+    def handle_starttag(self, tag, attrs):
+        if tag == 'dt':
+            self.finish()
+        elif tag == 'a' and self.dt is None:
+            self.dt = dict(attrs)
+            self.text = []
+        elif tag == 'dd' and self.dt is not None:
+            self.dd = self.text = []
 
-summary = {}
-count = 0
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.dt is not None and self.dd is None:
+            self.dt['title'] = u''.join(self.text)
+            self.text = None
+        elif tag == 'dl':
+            self.finish()
 
-for dt in doc.findall(".//{%s}dt" % xhtml):
-    count += 1
-    if opts.skip > 1 and count < opts.skip:
-        continue
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
 
-    # get the bookmark from the dt
-    a = dt.find('{%s}a' % xhtml)
-    b  = a.attrib
+    def handle_entityref(self, name):
+        if name in htmlentitydefs.name2codepoint:
+            self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+        else:
+            self.handle_data(u'&%s;' % name)
 
-    # see if there's a comment in the next element
-    e = dt.getnext()
-    if e is not None and e.tag == "{%s}dd" % xhtml:
-        comment = e.text
-    else:
-        comment = None
+    def handle_charref(self, name):
+        try:
+            if name[0] in 'xX':
+                self.handle_data(unichr(int(name[1:], 16)))
+            else:
+                self.handle_data(unichr(int(name)))
+        except ValueError:
+            self.handle_data(u'&#%s;' % name)
+
+
+def read_bookmarks(f, chunk_size=65536):
+    """
+    Yield (dt, dd) pairs from a delicious html export file as it is read,
+    so memory stays flat and the first ones come out right away.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    reader = ExportReader()
+    while True:
+        chunk = f.read(chunk_size)
+        reader.feed(decoder.decode(chunk, not chunk))
+        if not chunk:
+            reader.close()
+            reader.finish()
+        for pair in reader.done:
+            yield pair
+        reader.done = []
+        if not chunk:
+            return
+
+
+def bookmarks(delicious):
+    """
+    Yield (count, entry) for each bookmark in a delicious html export,
+    counting from 1, with everything but the page content filled in.
+    """
+    count = 0
+    for dt, dd in read_bookmarks(open(delicious)):
+        count += 1
+
+        # convert the epoch time into rfc 3339 time
+        t = time.localtime(int(dt["add_date"]))
+        t = time.strftime('%Y-%m-%dT%H:%M:%S%z', t)
+
+        # build the bookmark entry
+        yield count, {
+            "url": dt["href"],
+            "title": dt.get("title"),
+            "tags": dt.get("tags", "").replace(',', ' '),
+            "private": dt.get("private") == 1,
+            "date_created": t,
+            "comment": dd,
+            "content": None
+        }
+
+
+class HostLimits:
+    """
+    Hands out at most per_host fetch slots for each host.
+    """
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def slot(self, url):
+        host = urlparse.urlparse(url)[1].lower()
+        self.lock.acquire()
+        try:
+            if host not in self.hosts:
+                self.hosts[host] = threading.Semaphore(self.per_host)
+            return self.hosts[host]
+        finally:
+            self.lock.release()
 
-    # convert the epoch time into rfc 3339 time
-    t = time.localtime(int(b["add_date"]))
-    t = time.strftime('%Y-%m-%dT%H:%M:%S%z', t)
 
-    # get the content at the url only if it looks like html or text
-    url = b["href"]
+def fetch(url):
+    """
+    Get the content at the url only if it looks like html or text.
+    Returns (content, status).
+    """
     try:
         resp = urllib2.urlopen(url)
         content = resp.read()
-        status = resp.code 
-        summary[status] = summary.get(status, 0) + 1
+        status = resp.code
         content_type = resp.headers['content-type']
         if 'html' in content_type or 'text' in content_type:
             content = content.decode('utf-8', 'replace')
@@ -106,33 +207,151 @@ for dt in doc.findall(".//{%s}dt" % xhtml):
     except Exception, e:
         content = None
         status = str(type(e))
+    return content, status
+
+
+def read_checkpoint(path):
+    """
+    Return the set of bookmark counts already posted.
+    """
+    done = set()
+    if os.path.exists(path):
+        for line in open(path):
+            if line.strip():
+                done.add(int(line))
+    return done
+
+
+def put(q, item):
+    # Block in short waits, so ^C still gets through
+    while True:
+        try:
+            q.put(item, True, 1)
+            return
+        except Queue.Full:
+            pass
+
+
+def fetcher(todo, fetched, limits, summary, lock):
+    """
+    Fetch page content for bookmarks from todo until a None comes along,
+    handing them on to fetched.
+    """
+    while True:
+        item = todo.get()
+        if item is None:
+            return
+        count, entry = item
+        slot = limits.slot(entry["url"])
+        slot.acquire()
+        try:
+            entry["content"], status = fetch(entry["url"])
+        finally:
+            slot.release()
+        lock.acquire()
+        try:
+            summary[status] = summary.get(status, 0) + 1
+            print "\t".join([entry["url"], str(status)])
+        finally:
+            lock.release()
+        put(fetched, item)
+
+
+def poster(fetched, unalog, opts, checkpoint, lock):
+    """
+    Post fetched bookmarks to unalog until a None comes along, noting each
+    one that makes it in the checkpoint file.
+    """
+    # create http client
+    h = httplib2.Http()
+    h.add_credentials(opts.username, opts.password)
+    while True:
+        item = fetched.get()
+        if item is None:
+            return
+        count, entry = item
+
+        # don't bother posting to unalog if we're just checking
+        if opts.check:
+            continue
+
+        # send the bookmark to unalog as json
+        try:
+            resp, content = h.request(unalog, "POST",
+                body=json.dumps(entry),
+                headers={"content-type": "application/json"})
+            status = resp.status
+        except Exception, e:
+            status = str(e)
+
+        if status not in [200, 201, 302]:
+            lock.acquire()
+            try:
+                print "post to unalog failed! %s" % entry["url"]
+            finally:
+                lock.release()
+            continue
+        checkpoint.write("%s\n" % count)
+        checkpoint.flush()
+
+
+def main():
+    opts, args = opt_parser.parse_args()
+
+    if len(args) != 1:
+        opt_parser.error("must supply delicious bookmarks html file")
+    elif not os.path.isfile(args[0]):
+        opt_parser.error("no such file: %s" % args[0])
+    else:
+        delicious = args[0]
 
-    summary[status] = summary.get(status, 0) + 1
-    print "\t".join([url, str(status)])
+    if not opts.check and (not opts.username or not opts.password):
+        opt_parser.error("must supply --username or --password")
 
-    # don't bother posting to unalog if we're just checking
-    if opts.check:
-        continue
+    unalog = opts.unalog.rstrip("/") + "/entry/new"
+    checkpoint_path = opts.checkpoint or delicious + ".checkpoint"
+    posted = read_checkpoint(checkpoint_path)
+    checkpoint = open(checkpoint_path, "a")
 
-    # build the bookmark entry
-    entry = {
-        "url": b["href"],
-        "title": a.text,
-        "tags": b["tags"].replace(',', ' '),
-        "private": b["private"] == 1,
-        "date_created": t,
-        "comment": comment,
-        "content": content
-    }
+    summary = {}
+    lock = threading.Lock()
+    # Keep the queues short, so bookmarks are read only as fast as they go
+    todo = Queue.Queue(opts.workers * 2)
+    fetched = Queue.Queue(opts.workers * 2)
+    limits = HostLimits(opts.per_host)
+    fetchers = []
+    for i in range(opts.workers):
+        t = threading.Thread(target=fetcher,
+            args=(todo, fetched, limits, summary, lock))
+        t.setDaemon(True)
+        t.start()
+        fetchers.append(t)
+    post_thread = threading.Thread(target=poster,
+        args=(fetched, unalog, opts, checkpoint, lock))
+    post_thread.setDaemon(True)
+    post_thread.start()
 
-    # send the bookmark to unalog as json
-    resp, content = h.request(unalog, "POST", body=json.dumps(entry),
-            headers={"content-type": "application/json"})
+    count = 0
+    for count, entry in bookmarks(delicious):
+        if opts.skip > 1 and count < opts.skip:
+            continue
+        if count in posted:
+            continue
+        put(todo, (count, entry))
 
-    if resp.status not in [200, 201, 302]:
-        print "post to unalog failed! %s" % url
+    for t in fetchers:
+        put(todo, None)
+    for t in fetchers:
+        while t.isAlive():
+            t.join(1)
+    put(fetched, None)
+    while post_thread.isAlive():
+        post_thread.join(1)
+    checkpoint.close()
 
+    print "imported %s bookmarks" % count
+    print "response summary: %s" % summary
 
 
-print "imported %s bookmarks" % count
-print "response summary: %s" % summary
+if __name__ == "__main__":
+    main()
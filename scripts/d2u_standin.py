@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for both the web and unalog, for trying out d2u.py
+without fetching real pages or posting to a real unalog.  Write a
+synthetic export whose bookmarks all point at the stand-in, then serve:
+
+  ./d2u_standin.py --export test.htm --bookmarks 1000
+  ./d2u_standin.py --delay 0.5 &
+  ./d2u.py --username me --password secret \\
+      --unalog http://localhost:8765 test.htm
+
+Every GET is answered with a small html page after --delay seconds, and
+every POST to /entry/new is answered 201 and logged, so an interrupted
+import can be checked for bookmarks posted twice or not at all.  The
+bookmarks are spread over --hosts host names (127.0.0.1, 127.0.0.2, ...,
+which all reach the stand-in on linux) so the per-host limits show.
+"""
+
+import BaseHTTPServer
+import json
+import optparse
+import SocketServer
+import sys
+import threading
+import time
+
+opt_parser = optparse.OptionParser()
+opt_parser.add_option('--port', type=int, dest='port', default=8765)
+opt_parser.add_option('--delay', type=float, dest='delay', default=0.2,
+                      help='seconds to wait before answering a GET')
+opt_parser.add_option('--export', dest='export',
+                      help='write a synthetic export here and exit')
+opt_parser.add_option('--bookmarks', type=int, dest='bookmarks',
+                      default=1000, help='bookmarks in the export')
+opt_parser.add_option('--hosts', type=int, dest='hosts', default=4,
+                      help='distinct hosts the bookmarks point at')
+
+lock = threading.Lock()
+posted = {}
+
+
+def write_export(path, bookmarks, hosts, port):
+    """
+    Write a delicious style html export of bookmarks pointing at the
+    stand-in, with a comment on every other one.
+    """
+    out = open(path, 'w')
+    out.write('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+        '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+        '<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n')
+    now = int(time.time())
+    for i in range(bookmarks):
+        out.write('<DT><A HREF="http://127.0.0.%s:%s/page/%s" '
+            'ADD_DATE="%s" PRIVATE="0" TAGS="standin,tag%s">Page %s</A>\n' %
+            (i % hosts + 1, port, i, now - i * 60, i % 50, i))
+        if i % 2 == 0:
+            out.write('<DD>comment on page %s\n' % i)
+    out.write('</DL><p>\n')
+    out.close()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = '<html><head><title>%s</title></head>' \
+            '<body>stand-in page %s</body></html>' % (self.path, self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        if self.path != '/entry/new':
+            self.send_error(404)
+            return
+        entry = json.loads(body)
+        lock.acquire()
+        try:
+            posted[entry['url']] = posted.get(entry['url'], 0) + 1
+            times = posted[entry['url']]
+        finally:
+            lock.release()
+        if times > 1:
+            print 'POSTED AGAIN (%s times): %s' % (times, entry['url'])
+        self.send_response(201)
+        self.send_header('Location', '/entry/%s/' % len(posted))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    opts, args = opt_parser.parse_args()
+    if opts.export:
+        write_export(opts.export, opts.bookmarks, opts.hosts, opts.port)
+        print 'wrote %s bookmarks to %s' % (opts.bookmarks, opts.export)
+        return
+    server = Server(('', opts.port), Handler)
+    server.delay = opts.delay
+    print 'serving on port %s, ^C to stop' % opts.port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print 'received %s distinct bookmarks, %s posts' % (len(posted),
+        sum(posted.values()))
+
+
+if __name__ == '__main__':
+    main()
@@ -110,6 +110,44 @@ UNALOG_URL = 'http://localhost:8000'
 
 SOLR_URL = 'http://localhost:8983/solr'
 
+# Persistent solr connections kept per process, and socket timeouts (seconds)
+SOLR_POOL_SIZE = 4
+SOLR_CONNECT_TIMEOUT = 2
+SOLR_READ_TIMEOUT = 10
+
+# How many pages of search results each process keeps cached
+SEARCH_CACHE_SIZE = 1000
+
+# Browse pages' related-tag clouds come from solr; how long to wait for one
+# (seconds), and how long to keep one, though a solr commit starts afresh
+TAG_CLOUD_TIMEOUT = 2
+TAG_CLOUD_CACHE_SECONDS = 3600
+
+# How many tag, user, group and url names each process keeps resolved, and
+# for how long (seconds) at most.  Renames and deletes reach every process
+# sooner through a stamp in the django cache, if they share one.
+NAME_CACHE_SIZE = 10000
+NAME_CACHE_SECONDS = 300
+
+# How long to cache entry counts shown alongside listing pages
+ENTRY_COUNT_CACHE_SECONDS = 600
+
+# How long to keep rendered atom feeds.  Feeds are invalidated through
+# stamps kept in the django cache, so with more than one server process set
+# CACHE_BACKEND to something they share, like memcached, in local_settings.
+FEED_CACHE_SECONDS = 3600
+
+# Where the home, user, tag and group pages find their entries:  'db', or
+# 'solr' to answer them from the index (falling back to the database if
+# solr has trouble).  With solr, new entries show up once solr_worker 
+# commits them.  Compare the two with 'manage.py bench_browse'.
+BROWSE_BACKEND = 'db'
+
+# Entry content now lives in base_entrycontent.  Upgrading an existing 
+# database, set this True in local_settings while 'manage.py move_content'
+# moves the old base_entry.content over; see UPGRADING in README.txt.
+LEGACY_ENTRY_CONTENT = False
+
 # Be sure to create your own 'local_settings.py' file as described in README.txt
 try:
     from local_settings import *
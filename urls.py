@@ -33,6 +33,7 @@ urlpatterns += patterns('base.views',
     # Entries
     url(r'^entry/(?P<entry_id>[0-9]+)/$', 'entry', name='entry'),
     url(r'^entry/new', 'entry_new', name='entry_new'),
+    url(r'^entry/bulk/$', 'entry_bulk', name='entry_bulk'),
     url(r'^entry/(?P<entry_id>[0-9]+)/edit/$', 'entry_edit', 
         name='entry_edit'),
     url(r'^entry/(?P<entry_id>[0-9]+)/delete/$', 'entry_delete', 